@@ -1,19 +1,60 @@
+import asyncio
+import logging
 import os
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query
 from pydantic import BaseModel
 from datetime import datetime, timezone, timedelta
 import json
 from api.db import engine, SessionLocal, Base
 import api.models
-from api.models import User, Channel, Post
-from sqlalchemy import desc, update, select, text, func
+from api.models import User, Channel, Post, DeadLetter, PaymentIntent, BroadcastJob, BroadcastRecipient
+from sqlalchemy import case, delete, desc, insert, literal, update, select, text, func, or_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from fastapi import Body
 import re
+from common.notify import listen_new_posts, publish_new_posts
+from common.sharding import FEED_SHARDS, shard_for_user
+from api.notifications import NotificationIndex
+from common.summary_queue import BATCH_DELAY_SEC, push_pending, release_flush_async
+from worker.celery_app import celery
 
 
+log = logging.getLogger(__name__)
+
 app = FastAPI(title="MyFeed API")
 OWNER_TG_USER_ID = int(os.getenv("OWNER_TG_USER_ID", "0"))
+STREAM_MAX_TIMEOUT_SEC = 60.0
+SHORT_FEED_ENGINES = {"llm", "local"}
+BUNDLE_MODES = {"off", "all", "channel"}
+# Неоплаченное намерение истекает через TTL; завершённые и истёкшие
+# намерения хранятся RETENTION дней, затем удаляются
+PAYMENT_INTENT_TTL_SEC = int(os.getenv("PAYMENT_INTENT_TTL_SEC", "86400"))
+PAYMENT_INTENT_RETENTION_DAYS = int(os.getenv("PAYMENT_INTENT_RETENTION_DAYS", "90"))
+# Переключение настройки — одно выражение в UPDATE, без чтения строки в приложение
+TOGGLE_SETTINGS = {
+    "forwarding": (User.forwarding_on, ~User.forwarding_on),
+    "spam_filter": (User.spam_filter_on, ~User.spam_filter_on),
+    "short_feed": (User.short_feed_on, ~User.short_feed_on),
+    "short_feed_engine": (
+        User.short_feed_engine,
+        case((User.short_feed_engine == "llm", "local"), else_="llm"),
+    ),
+    "bundle_mode": (
+        User.bundle_mode,
+        case((User.bundle_mode == "off", "all"), (User.bundle_mode == "all", "channel"), else_="off"),
+    ),
+}
+# Исходящая очередь доставки: временные ошибки повторяются с растущей
+# паузой, после MAX_DELIVERY_ATTEMPTS (или сразу при постоянной ошибке)
+# пост уходит в dead_letters и больше не выбирается.
+MAX_DELIVERY_ATTEMPTS = int(os.getenv("MAX_DELIVERY_ATTEMPTS", "5"))
+DELIVERY_RETRY_BASE_SEC = 30
+DELIVERY_RETRY_MAX_SEC = 3600
+DELIVERY_FAILURE_KINDS = {"transient", "permanent", "blocked"}
+DIGEST_TEXT_MAX_LEN = 800
+notifications = NotificationIndex()
+_background_tasks: set[asyncio.Task] = set()
 
 class AddChannelIn(BaseModel):
     tg_user_id: int
@@ -66,13 +107,58 @@ class UserProfileIn(BaseModel):
     first_name: str | None = None
     last_name: str | None = None
 
+class SetPostSummaryIn(BaseModel):
+    post_id: int
+    summary: str
+
+class SetPostSummariesIn(BaseModel):
+    summaries: list[SetPostSummaryIn]
+
+class DeliveryFailedIn(BaseModel):
+    tg_user_id: int
+    post_ids: list[int]
+    kind: str  # transient|permanent|blocked
+    error: str = ""
+    retry_after: float | None = None
+
+class PaymentIntentIn(BaseModel):
+    payload: str
+    tg_user_id: int
+    provider: str
+    plan: str
+    days: int | None = None
+    ttl_sec: int | None = None
+
+class CompletePaymentIntentIn(BaseModel):
+    payload: str
+    tx_id: str | None = None
+
+class ToggleSettingIn(BaseModel):
+    tg_user_id: int
+    setting: str
+    require_vip: bool = False
+
 class FirstStartIn(BaseModel):
     tg_user_id: int
     trial_days: int = 7
 
 class AdminBroadcastQuery(BaseModel):
     admin_tg_user_id: int
-    group: str | None = None  # vip|free|active|all
+    group: str | None = None  # vip|free|active|forwarding|all
+
+class BroadcastCreateIn(BaseModel):
+    admin_tg_user_id: int
+    group: str | None = None
+    text: str | None = None
+    source_chat_id: int | None = None
+    source_message_id: int | None = None
+    status_chat_id: int | None = None
+    status_message_id: int | None = None
+
+class BroadcastResultsIn(BaseModel):
+    sent: list[int] = []
+    failed: list[int] = []
+    blocked: list[int] = []
 
 
 AD_PATTERNS = [
@@ -119,6 +205,24 @@ async def on_startup():
                 "ADD COLUMN IF NOT EXISTS short_feed_on BOOLEAN NOT NULL DEFAULT FALSE"
             )
         )
+        await conn.execute(
+            text(
+                "ALTER TABLE users "
+                "ADD COLUMN IF NOT EXISTS short_feed_engine VARCHAR(16) NOT NULL DEFAULT 'llm'"
+            )
+        )
+        await conn.execute(
+            text(
+                "ALTER TABLE users "
+                "ADD COLUMN IF NOT EXISTS bundle_mode VARCHAR(16) NOT NULL DEFAULT 'off'"
+            )
+        )
+        await conn.execute(
+            text(
+                "ALTER TABLE users "
+                "ADD COLUMN IF NOT EXISTS channels_rev INTEGER NOT NULL DEFAULT 0"
+            )
+        )
         await conn.execute(
             text(
                 "ALTER TABLE users "
@@ -173,17 +277,93 @@ async def on_startup():
                 "ADD COLUMN IF NOT EXISTS media_group_id BIGINT NULL"
             )
         )
+        await conn.execute(
+            text(
+                "ALTER TABLE posts "
+                "ADD COLUMN IF NOT EXISTS summary TEXT NULL"
+            )
+        )
+        await conn.execute(
+            text(
+                "ALTER TABLE posts "
+                "ADD COLUMN IF NOT EXISTS send_attempts INTEGER NOT NULL DEFAULT 0"
+            )
+        )
+        await conn.execute(
+            text(
+                "ALTER TABLE posts "
+                "ADD COLUMN IF NOT EXISTS next_attempt_at TIMESTAMPTZ NULL"
+            )
+        )
+        await conn.execute(
+            text(
+                "ALTER TABLE posts "
+                "ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ NOT NULL DEFAULT now()"
+            )
+        )
         await conn.execute(
             text(
                 "ALTER TABLE channels "
                 "ADD COLUMN IF NOT EXISTS title VARCHAR(255) NULL"
             )
         )
+        await conn.execute(
+            text(
+                "ALTER TABLE payment_intents "
+                "ADD COLUMN IF NOT EXISTS expires_at TIMESTAMPTZ NULL"
+            )
+        )
+        await conn.execute(
+            text(
+                "CREATE INDEX IF NOT EXISTS ix_payment_intents_expires_at "
+                "ON payment_intents (expires_at)"
+            )
+        )
+        await conn.execute(
+            text(
+                "ALTER TABLE payment_intents "
+                "ADD COLUMN IF NOT EXISTS days INTEGER NULL"
+            )
+        )
+        # намерениям, созданным до появления days, срок берётся из тарифов бота
+        await conn.execute(
+            text(
+                "UPDATE payment_intents SET days = CASE plan "
+                "WHEN '7d' THEN 7 WHEN '1m' THEN 30 WHEN '12m' THEN 365 END "
+                "WHERE days IS NULL AND status IN ('pending', 'expired')"
+            )
+        )
+        await conn.execute(
+            text(
+                "CREATE INDEX IF NOT EXISTS ix_posts_channel_published "
+                "ON posts (channel_id, published_at)"
+            )
+        )
+    task = asyncio.create_task(follow_new_posts())
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+async def follow_new_posts():
+    # уведомления от всех реплик API (и от самого процесса) попадают в общий индекс
+    async for user_ids in listen_new_posts():
+        notifications.mark(user_ids)
 
 @app.get("/health")
 def health():
     return {"status": "ok"}
 
+async def _bump_channels_rev(session, user_id: int) -> int:
+    res = await session.execute(
+        update(User)
+        .where(User.id == user_id)
+        .values(channels_rev=User.channels_rev + 1)
+        .returning(User.channels_rev)
+        .execution_options(synchronize_session=False)
+    )
+    return int(res.scalar_one())
+
+
 @app.post("/channels/add")
 async def add_channel(payload: AddChannelIn):
     username = payload.username.strip()
@@ -205,15 +385,16 @@ async def add_channel(payload: AddChannelIn):
         )
         channel_count = int(res.scalar() or 0)
         if channel_count >= limit:
-            return {"ok": False, "message": "limit reached", "limit": limit}
+            return {"ok": False, "message": "limit reached", "limit": limit, "rev": user.channels_rev}
         res = await session.execute(
             select(Channel).where(Channel.user_id == user.id, Channel.username == username)
         )
         if res.scalar_one_or_none():
-            return {"ok": True, "message": "already added"}
+            return {"ok": True, "message": "already added", "rev": user.channels_rev}
         session.add(Channel(user_id=user.id, username=username))
+        rev = await _bump_channels_rev(session, user.id)
         await session.commit()
-    return {"ok": True}
+    return {"ok": True, "rev": rev}
 
 # Получаем список каналов пользователя
 @app.get("/channels/list")
@@ -222,10 +403,13 @@ async def list_channels(tg_user_id: int):
         res = await session.execute(select(User).where(User.tg_user_id == tg_user_id))
         user = res.scalar_one_or_none()
         if not user:
-            return {"channels": []}
-        res = await session.execute(select(Channel.username).where(Channel.user_id == user.id))
+            return {"channels": [], "rev": 0}
+        # порядок добавления: от него зависит стабильная пагинация в боте
+        res = await session.execute(
+            select(Channel.username).where(Channel.user_id == user.id).order_by(Channel.id)
+        )
         channels = [row[0] for row in res.all()]
-        return {"channels": channels}
+        return {"channels": channels, "rev": user.channels_rev}
     
 @app.get("/channels/cursor")
 async def get_channel_cursor(tg_user_id: int, username: str):
@@ -311,12 +495,13 @@ async def delete_channel(payload: DeleteChannelIn):
         )
         channel = res.scalar_one_or_none()
         if not channel:
-            return {"ok": True, "deleted": False, "message": "channel not found"}
+            return {"ok": True, "deleted": False, "message": "channel not found", "rev": user.channels_rev}
 
         await session.delete(channel)
+        rev = await _bump_channels_rev(session, user.id)
         await session.commit()
 
-    return {"ok": True, "deleted": True}
+    return {"ok": True, "deleted": True, "rev": rev}
 
 
 @app.post("/channels/delete_all")
@@ -325,16 +510,17 @@ async def delete_all_channels(payload: DeleteAllChannelsIn):
         res = await session.execute(select(User).where(User.tg_user_id == payload.tg_user_id))
         user = res.scalar_one_or_none()
         if not user:
-            return {"ok": True, "deleted": 0}
+            return {"ok": True, "deleted": 0, "rev": 0}
         res = await session.execute(select(Channel).where(Channel.user_id == user.id))
         channels = res.scalars().all()
         deleted = 0
         for ch in channels:
             await session.delete(ch)
             deleted += 1
+        rev = await _bump_channels_rev(session, user.id)
         await session.commit()
 
-    return {"ok": True, "deleted": deleted}
+    return {"ok": True, "deleted": deleted, "rev": rev}
 
 
 
@@ -360,7 +546,7 @@ async def add_post(payload: AddPostIn):
         if res.scalar_one_or_none():
             return {"ok": True, "message": "already exists"}
         media_paths = json.dumps(payload.media_paths) if payload.media_paths else None
-        session.add(Post(
+        post = Post(
             channel_id=channel.id,
             tg_message_id=payload.tg_message_id,
             text=payload.text or "",
@@ -368,11 +554,62 @@ async def add_post(payload: AddPostIn):
             media_paths=media_paths,
             media_group_id=payload.media_group_id,
             published_at=payload.published_at,
+            created_at=datetime.now(timezone.utc),
             is_sent=False,
-        ))
+        )
+        session.add(post)
         await session.commit()
+        needs_summary = (
+            bool(user.short_feed_on)
+            and user.short_feed_engine == "llm"
+            and bool(post.text.strip())
+        )
+    if needs_summary:
+        await enqueue_post_summary(post.id, post.text)
+    await publish_new_posts([payload.tg_user_id])
     return {"ok": True}
 
+
+async def enqueue_post_summary(post_id: int, text_value: str) -> None:
+    # Сжатие для краткой ленты считается сразу при приёме поста, чтобы доставка
+    # не ждала LLM; посты копятся в очереди и сжимаются пачкой
+    try:
+        if await push_pending(post_id, text_value):
+            try:
+                await asyncio.to_thread(
+                    celery.send_task, "worker.tasks.summarize_pending", countdown=BATCH_DELAY_SEC
+                )
+            except Exception:
+                await release_flush_async()
+                raise
+    except Exception as e:
+        log.warning(f"Failed to enqueue summary for post {post_id}: {e}")
+
+
+@app.post("/posts/summaries")
+async def set_post_summaries(payload: SetPostSummariesIn):
+    summaries = {item.post_id: item.summary.strip() or None for item in payload.summaries}
+    if not summaries:
+        return {"ok": True, "updated": 0}
+    async with SessionLocal() as session:
+        res = await session.execute(
+            select(Post, User.tg_user_id)
+            .join(Channel, Post.channel_id == Channel.id)
+            .join(User, Channel.user_id == User.id)
+            .where(Post.id.in_(list(summaries)))
+        )
+        pending_users = set()
+        updated = 0
+        for post, tg_user_id in res.all():
+            post.summary = summaries[post.id]
+            updated += 1
+            if not post.is_sent:
+                pending_users.add(tg_user_id)
+        await session.commit()
+    if pending_users:
+        await publish_new_posts(pending_users)
+    return {"ok": True, "updated": updated}
+
 @app.get("/posts/latest")
 async def latest_posts(tg_user_id: int, limit: int = 20):
     limit = max(1, min(limit, 100))
@@ -404,6 +641,100 @@ async def latest_posts(tg_user_id: int, limit: int = 20):
             })
         return {"posts": posts}
 
+def digest_candidates_query(
+    user_id: int, cutoff: datetime, per_channel: int, char_budget: int, max_text_len: int, limit: int
+):
+    text_value = func.substr(Post.text, 1, max_text_len)
+    ranked = (
+        select(
+            Post.id,
+            Post.tg_message_id,
+            Post.published_at,
+            text_value.label("text"),
+            func.length(text_value).label("text_len"),
+            Channel.username.label("channel"),
+            Channel.title.label("channel_title"),
+            func.row_number()
+            .over(partition_by=Post.channel_id, order_by=desc(Post.published_at))
+            .label("rn"),
+        )
+        .join(Channel, Post.channel_id == Channel.id)
+        .where(
+            Channel.user_id == user_id,
+            Post.is_sent == True,
+            ~select(DeadLetter.id).where(DeadLetter.post_id == Post.id).exists(),
+            Post.published_at >= cutoff,
+            func.length(func.trim(Post.text)) > 0,
+        )
+        .subquery()
+    )
+    budgeted = (
+        select(
+            ranked,
+            func.sum(ranked.c.text_len)
+            .over(order_by=(ranked.c.rn, desc(ranked.c.published_at), ranked.c.id))
+            .label("used"),
+        )
+        .where(ranked.c.rn <= per_channel)
+        .subquery()
+    )
+    return (
+        select(
+            budgeted.c.id,
+            budgeted.c.channel,
+            budgeted.c.channel_title,
+            budgeted.c.tg_message_id,
+            budgeted.c.text,
+            budgeted.c.published_at,
+        )
+        .where(budgeted.c.used <= char_budget)
+        .order_by(desc(budgeted.c.published_at))
+        .limit(limit)
+    )
+
+
+@app.get("/posts/digest_candidates")
+async def digest_candidates(
+    tg_user_id: int,
+    hours: int = 12,
+    per_channel: int = 15,
+    char_budget: int = 90000,
+    max_text_len: int = DIGEST_TEXT_MAX_LEN,
+    limit: int = 300,
+):
+    """
+    Посты для сводки, отобранные в SQL: окно по времени, только доставленные
+    (без ушедших в dead_letters),
+    не больше per_channel свежих постов с канала и суммарно не больше
+    char_budget символов текста. Бюджет набирается по кругу — сначала самый
+    свежий пост каждого канала, затем второй и т.д., — чтобы шумные каналы
+    не вытесняли остальные.
+    """
+    hours = max(1, min(hours, 72))
+    per_channel = max(1, min(per_channel, 100))
+    max_text_len = max(100, min(max_text_len, 4000))
+    limit = max(1, min(limit, 500))
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=hours)
+    async with SessionLocal() as session:
+        res = await session.execute(select(User).where(User.tg_user_id == tg_user_id))
+        user = res.scalar_one_or_none()
+        if not user:
+            return {"posts": []}
+        res = await session.execute(
+            digest_candidates_query(user.id, cutoff, per_channel, char_budget, max_text_len, limit)
+        )
+        posts = []
+        for row in res.all():
+            posts.append({
+                "id": row.id,
+                "channel": row.channel,
+                "channel_title": row.channel_title,
+                "tg_message_id": row.tg_message_id,
+                "text": row.text,
+                "published_at": row.published_at.isoformat(),
+            })
+        return {"posts": posts}
+
 @app.get("/posts/unsent")
 async def unsent_posts(tg_user_id: int, limit: int = 10):
     limit = max(1, min(limit, 50))
@@ -414,10 +745,15 @@ async def unsent_posts(tg_user_id: int, limit: int = 10):
             return {"posts": []}
         if not bool(user.forwarding_on):
             return {"posts": []}
+        now = datetime.now(timezone.utc)
         res = await session.execute(
             select(Post, Channel.username, Channel.title)
             .join(Channel, Post.channel_id == Channel.id)
-            .where(Channel.user_id == user.id, Post.is_sent == False)
+            .where(
+                Channel.user_id == user.id,
+                Post.is_sent == False,
+                or_(Post.next_attempt_at.is_(None), Post.next_attempt_at <= now),
+            )
             .order_by(Post.published_at)
             .limit(limit * 3)
         )
@@ -436,6 +772,9 @@ async def unsent_posts(tg_user_id: int, limit: int = 10):
                 "media_type": post.media_type,
                 "media_paths": json.loads(post.media_paths) if post.media_paths else None,
                 "media_group_id": post.media_group_id,
+                "published_at": post.published_at.isoformat(),
+                "created_at": post.created_at.isoformat(),
+                "summary": post.summary,
             })
             if len(posts) >= limit:
                 break
@@ -446,6 +785,30 @@ async def unsent_posts(tg_user_id: int, limit: int = 10):
             await session.commit()
         return {"posts": posts}
 
+@app.get("/posts/stream")
+async def stream_posts(
+    tg_user_id: int | None = None,
+    shard: list[int] | None = Query(None),
+    shards: int = FEED_SHARDS,
+    since: int | None = None,
+    epoch: str | None = None,
+    timeout: float = 25.0,
+    limit: int = 10,
+):
+    timeout = max(0.0, min(timeout, STREAM_MAX_TIMEOUT_SEC))
+    if tg_user_id is not None:
+        res = await notifications.wait(since, epoch, lambda uid: uid == tg_user_id, timeout)
+        posts = []
+        if res["users"] or res["resync"]:
+            posts = (await unsent_posts(tg_user_id, limit=limit))["posts"]
+        return {"posts": posts, "cursor": res["cursor"], "epoch": res["epoch"]}
+    if shard:
+        wanted = set(shard)
+        user_filter = lambda uid: shard_for_user(uid, shards) in wanted
+    else:
+        user_filter = lambda uid: True
+    return await notifications.wait(since, epoch, user_filter, timeout)
+
 @app.post("/posts/mark_sent")
 async def mark_posts_sent(post_ids: list[int]):
     if not post_ids:
@@ -457,6 +820,67 @@ async def mark_posts_sent(post_ids: list[int]):
         await session.commit()
     return {"ok": True}
 
+def delivery_backoff(attempts: int) -> float:
+    return min(DELIVERY_RETRY_MAX_SEC, DELIVERY_RETRY_BASE_SEC * 2 ** max(0, attempts - 1))
+
+
+def next_delivery_attempt(attempts: int, kind: str, retry_after: float | None = None) -> tuple[int, float | None]:
+    """
+    Новое число попыток и пауза до следующей; пауза None — пост уходит в
+    dead_letters. Flood control (retry_after) попыткой не считается: Telegram
+    отклонил сообщение из-за лимита бота, а не из-за самого поста.
+    """
+    if kind == "permanent":
+        return attempts + 1, None
+    if retry_after:
+        return attempts, float(retry_after)
+    attempts += 1
+    if attempts >= MAX_DELIVERY_ATTEMPTS:
+        return attempts, None
+    return attempts, delivery_backoff(attempts)
+
+@app.post("/posts/delivery_failed")
+async def delivery_failed(payload: DeliveryFailedIn):
+    if payload.kind not in DELIVERY_FAILURE_KINDS:
+        raise HTTPException(400, "unknown failure kind")
+    async with SessionLocal() as session:
+        if payload.kind == "blocked":
+            # пользователь заблокировал бота — не тратим на него проходы доставки
+            await session.execute(
+                update(User).where(User.tg_user_id == payload.tg_user_id).values(forwarding_on=False)
+            )
+            await session.commit()
+            log.info(f"Forwarding disabled for {payload.tg_user_id}: bot is blocked")
+            return {"ok": True, "dead_lettered": []}
+
+        if not payload.post_ids:
+            return {"ok": True, "dead_lettered": []}
+        now = datetime.now(timezone.utc)
+        res = await session.execute(select(Post).where(Post.id.in_(payload.post_ids)))
+        dead_ids = []
+        for post in res.scalars().all():
+            post.send_attempts, delay = next_delivery_attempt(
+                post.send_attempts or 0, payload.kind, payload.retry_after
+            )
+            if delay is None:
+                # is_sent снимает пост с доставки; сводка исключает его по dead_letters
+                post.is_sent = True
+                post.next_attempt_at = None
+                session.add(DeadLetter(
+                    post_id=post.id,
+                    tg_user_id=payload.tg_user_id,
+                    error=payload.error[:2000],
+                    attempts=post.send_attempts,
+                    created_at=now,
+                ))
+                dead_ids.append(post.id)
+            else:
+                post.next_attempt_at = now + timedelta(seconds=delay)
+        await session.commit()
+    if dead_ids:
+        log.warning(f"Dead-lettered posts {dead_ids} for {payload.tg_user_id}: {payload.error[:200]}")
+    return {"ok": True, "dead_lettered": dead_ids}
+
 @app.get("/users/forwarding")
 async def get_user_forwarding(tg_user_id: int):
     async with SessionLocal() as session:
@@ -480,26 +904,196 @@ async def set_user_forwarding(tg_user_id: int, enabled: bool = Body(...)):
 
         user.forwarding_on = bool(enabled)
         await session.commit()
-        return {"ok": True, "enabled": bool(user.forwarding_on)}
+    if enabled:
+        await publish_new_posts([tg_user_id])
+    return {"ok": True, "enabled": bool(enabled)}
 
 
 @app.post("/users/profile")
 async def upsert_user_profile(payload: UserProfileIn):
+    username = (payload.username or "").strip() or None
+    if username and not username.startswith("@"):
+        username = f"@{username}"
+    # Один запрос вместо SELECT + UPDATE; строка переписывается только если
+    # что-то изменилось, иначе нет ни записи, ни новой версии строки
+    stmt = pg_insert(User).values(
+        tg_user_id=payload.tg_user_id,
+        username=username,
+        first_name=payload.first_name or None,
+        last_name=payload.last_name or None,
+    )
+    first_name = func.coalesce(stmt.excluded.first_name, User.first_name)
+    last_name = func.coalesce(stmt.excluded.last_name, User.last_name)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[User.tg_user_id],
+        set_={"username": stmt.excluded.username, "first_name": first_name, "last_name": last_name},
+        where=or_(
+            User.username.is_distinct_from(stmt.excluded.username),
+            User.first_name.is_distinct_from(first_name),
+            User.last_name.is_distinct_from(last_name),
+        ),
+    )
     async with SessionLocal() as session:
-        res = await session.execute(select(User).where(User.tg_user_id == payload.tg_user_id))
-        user = res.scalar_one_or_none()
-        if not user:
-            user = User(tg_user_id=payload.tg_user_id)
-            session.add(user)
-            await session.flush()
-        username = (payload.username or "").strip() or None
-        if username and not username.startswith("@"):
-            username = f"@{username}"
-        user.username = username
-        user.first_name = payload.first_name or user.first_name
-        user.last_name = payload.last_name or user.last_name
+        res = await session.execute(stmt)
         await session.commit()
-        return {"ok": True}
+    return {"ok": True, "changed": res.rowcount > 0}
+
+
+def _payment_intent_dict(intent: PaymentIntent) -> dict:
+    return {
+        "id": intent.id,
+        "payload": intent.payload,
+        "tg_user_id": intent.tg_user_id,
+        "provider": intent.provider,
+        "plan": intent.plan,
+        "status": intent.status,
+        "created_at": intent.created_at.isoformat(),
+        "expires_at": intent.expires_at.isoformat() if intent.expires_at else None,
+    }
+
+
+@app.post("/payments/intents")
+async def create_payment_intent(payload: PaymentIntentIn):
+    now = datetime.now(timezone.utc)
+    async with SessionLocal() as session:
+        session.add(PaymentIntent(
+            payload=payload.payload,
+            tg_user_id=payload.tg_user_id,
+            provider=payload.provider,
+            plan=payload.plan,
+            days=payload.days,
+            status="pending",
+            created_at=now,
+            expires_at=now + timedelta(seconds=payload.ttl_sec or PAYMENT_INTENT_TTL_SEC),
+        ))
+        await session.commit()
+    return {"ok": True}
+
+
+@app.get("/payments/intents")
+async def list_payment_intents(
+    provider: str,
+    status: str = "pending",
+    tg_user_id: int | None = None,
+    plan: str | None = None,
+    limit: int = 500,
+    after_id: int | None = None,
+    expired_within_sec: int = 0,
+):
+    """
+    status="" — намерения в любом статусе; новые идут первыми.
+    after_id — постраничный обход по id по возрастанию (для сверки).
+    expired_within_sec — к ожидающим добавляются истёкшие не раньше этого
+    срока: поздно пришедшую оплату по ним ещё можно зачесть.
+    """
+    limit = max(1, min(limit, 1000))
+    stmt = select(PaymentIntent).where(PaymentIntent.provider == provider)
+    if status == "pending":
+        grace = timedelta(seconds=max(expired_within_sec, 0))
+        stmt = stmt.where(
+            PaymentIntent.status.in_(("pending", "expired") if grace else ("pending",)),
+            or_(PaymentIntent.expires_at.is_(None), PaymentIntent.expires_at > func.now() - grace),
+        )
+    elif status:
+        stmt = stmt.where(PaymentIntent.status == status)
+    if tg_user_id is not None:
+        stmt = stmt.where(PaymentIntent.tg_user_id == tg_user_id)
+    if plan:
+        stmt = stmt.where(PaymentIntent.plan == plan)
+    if after_id is not None:
+        stmt = stmt.where(PaymentIntent.id > after_id).order_by(PaymentIntent.id)
+    else:
+        stmt = stmt.order_by(PaymentIntent.created_at.desc())
+    async with SessionLocal() as session:
+        res = await session.execute(stmt.limit(limit))
+        return {"intents": [_payment_intent_dict(intent) for intent in res.scalars().all()]}
+
+
+@app.get("/payments/intent")
+async def get_payment_intent(payload: str):
+    async with SessionLocal() as session:
+        res = await session.execute(select(PaymentIntent).where(PaymentIntent.payload == payload))
+        intent = res.scalar_one_or_none()
+        return {"intent": _payment_intent_dict(intent) if intent else None}
+
+
+def complete_intent_stmt(payload: str, tx_id: str | None, now: datetime):
+    # Условный UPDATE: из бота и воркеров платежей начислит только тот, кто успел первым.
+    # Истёкшее намерение тоже завершается: оплату, пришедшую поздно, всё равно зачитываем.
+    return (
+        update(PaymentIntent)
+        .where(
+            PaymentIntent.payload == payload,
+            PaymentIntent.status.in_(("pending", "expired")),
+        )
+        .values(status="paid", tx_id=tx_id, paid_at=now)
+        .returning(PaymentIntent.tg_user_id, PaymentIntent.plan, PaymentIntent.days)
+    )
+
+
+def vip_extended_until(vip_until: datetime | None, days: int, now: datetime) -> datetime:
+    """Активный VIP продлевается с его конца, истёкший — с текущего момента."""
+    base = vip_until if vip_until and vip_until > now else now
+    return base + timedelta(days=days)
+
+
+@app.post("/payments/intents/complete")
+async def complete_payment_intent(payload: CompletePaymentIntentIn):
+    # VIP продлевается в той же транзакции — оплаченное намерение без VIP невозможно
+    now = datetime.now(timezone.utc)
+    async with SessionLocal() as session:
+        res = await session.execute(complete_intent_stmt(payload.payload, payload.tx_id, now))
+        row = res.first()
+        if not row:
+            return {"completed": False}
+        vip_until = None
+        if row.days:
+            vip_until = await _extend_vip(session, row.tg_user_id, row.days)
+        else:
+            log.warning(f"Payment {payload.payload}: plan {row.plan} has no duration")
+        await session.commit()
+    return {
+        "completed": True,
+        "tg_user_id": row.tg_user_id,
+        "plan": row.plan,
+        "vip_until": vip_until.isoformat() if vip_until else None,
+    }
+
+
+@app.post("/payments/intents/cancel")
+async def cancel_payment_intent(payload: CompletePaymentIntentIn):
+    async with SessionLocal() as session:
+        res = await session.execute(
+            update(PaymentIntent)
+            .where(
+                PaymentIntent.payload == payload.payload,
+                PaymentIntent.status.in_(("pending", "expired")),
+            )
+            .values(status="canceled")
+        )
+        await session.commit()
+    return {"ok": True, "canceled": res.rowcount > 0}
+
+
+@app.post("/payments/intents/cleanup")
+async def cleanup_payment_intents():
+    now = datetime.now(timezone.utc)
+    async with SessionLocal() as session:
+        res = await session.execute(
+            update(PaymentIntent)
+            .where(PaymentIntent.status == "pending", PaymentIntent.expires_at <= now)
+            .values(status="expired")
+        )
+        expired = res.rowcount
+        res = await session.execute(
+            delete(PaymentIntent).where(
+                PaymentIntent.status.in_(("paid", "expired", "canceled")),
+                PaymentIntent.created_at < now - timedelta(days=PAYMENT_INTENT_RETENTION_DAYS),
+            )
+        )
+        deleted = res.rowcount
+        await session.commit()
+    return {"ok": True, "expired": expired, "deleted": deleted}
 
 
 @app.post("/users/first_start")
@@ -548,28 +1142,196 @@ async def resolve_user_id(username: str):
 async def get_broadcast_targets(payload: AdminBroadcastQuery):
     if OWNER_TG_USER_ID and payload.admin_tg_user_id != OWNER_TG_USER_ID:
         raise HTTPException(403, "forbidden")
-    group = (payload.group or "all").lower()
-    now = datetime.now(timezone.utc)
     async with SessionLocal() as session:
-        stmt = select(User.tg_user_id)
-        if group == "vip":
-            stmt = stmt.where(User.vip_until.is_not(None), User.vip_until > now)
-        elif group == "free":
-            stmt = stmt.where((User.vip_until.is_(None)) | (User.vip_until <= now))
-        elif group == "active":
-            cutoff = now - timedelta(days=7)
-            active_ids = (
-                select(func.distinct(Channel.user_id))
-                .select_from(Post)
-                .join(Channel, Post.channel_id == Channel.id)
-                .where(Post.is_sent == True, Post.published_at >= cutoff)
-            )
-            stmt = stmt.where(User.id.in_(active_ids))
-        res = await session.execute(stmt)
+        res = await session.execute(
+            select(User.tg_user_id).where(*_broadcast_conditions(payload.group))
+        )
         ids = [row[0] for row in res.all()]
         return {"targets": ids}
 
 
+def _broadcast_conditions(group: str | None) -> list:
+    group = (group or "all").lower()
+    now = datetime.now(timezone.utc)
+    if group == "vip":
+        return [User.vip_until.is_not(None), User.vip_until > now]
+    if group == "free":
+        return [(User.vip_until.is_(None)) | (User.vip_until <= now)]
+    if group == "forwarding":
+        return [User.forwarding_on == True]
+    if group == "active":
+        cutoff = now - timedelta(days=7)
+        active_ids = (
+            select(func.distinct(Channel.user_id))
+            .select_from(Post)
+            .join(Channel, Post.channel_id == Channel.id)
+            .where(Post.is_sent == True, Post.published_at >= cutoff)
+        )
+        return [User.id.in_(active_ids)]
+    return []
+
+
+def _broadcast_job_dict(job: BroadcastJob) -> dict:
+    return {
+        "id": job.id,
+        "group": job.group,
+        "text": job.text,
+        "source_chat_id": job.source_chat_id,
+        "source_message_id": job.source_message_id,
+        "status_chat_id": job.status_chat_id,
+        "status_message_id": job.status_message_id,
+        "status": job.status,
+        "total": job.total,
+        "sent": job.sent,
+        "failed": job.failed,
+    }
+
+
+@app.post("/admin/broadcasts")
+async def create_broadcast(payload: BroadcastCreateIn):
+    """
+    Создаёт задание рассылки и сразу фиксирует список получателей:
+    рассылка, продолженная после перезапуска, идёт по тому же списку.
+    """
+    if OWNER_TG_USER_ID and payload.admin_tg_user_id != OWNER_TG_USER_ID:
+        raise HTTPException(403, "forbidden")
+    if not payload.text and not (payload.source_chat_id and payload.source_message_id):
+        raise HTTPException(400, "text or source message is required")
+    async with SessionLocal() as session:
+        job = BroadcastJob(
+            admin_tg_user_id=payload.admin_tg_user_id,
+            group=(payload.group or "all").lower(),
+            text=payload.text,
+            source_chat_id=payload.source_chat_id,
+            source_message_id=payload.source_message_id,
+            status_chat_id=payload.status_chat_id,
+            status_message_id=payload.status_message_id,
+            status="running",
+            total=0,
+            sent=0,
+            failed=0,
+            created_at=datetime.now(timezone.utc),
+        )
+        session.add(job)
+        await session.flush()
+        res = await session.execute(
+            insert(BroadcastRecipient).from_select(
+                ["job_id", "tg_user_id", "status"],
+                select(literal(job.id), User.tg_user_id, literal("pending"))
+                .where(*_broadcast_conditions(payload.group)),
+            )
+        )
+        job.total = res.rowcount
+        if not job.total:
+            job.status = "done"
+            job.finished_at = datetime.now(timezone.utc)
+        await session.commit()
+        return _broadcast_job_dict(job)
+
+
+@app.get("/broadcasts/active")
+async def list_active_broadcasts():
+    async with SessionLocal() as session:
+        res = await session.execute(
+            select(BroadcastJob).where(BroadcastJob.status == "running").order_by(BroadcastJob.id)
+        )
+        return {"jobs": [_broadcast_job_dict(job) for job in res.scalars().all()]}
+
+
+@app.post("/broadcasts/{job_id}/recover")
+async def recover_broadcast(job_id: int):
+    # Получатели, взятые в работу до падения, могли уже получить сообщение:
+    # повторно им не шлём, а помечаем как unknown
+    async with SessionLocal() as session:
+        res = await session.execute(
+            update(BroadcastRecipient)
+            .where(BroadcastRecipient.job_id == job_id, BroadcastRecipient.status == "sending")
+            .values(status="unknown")
+        )
+        unknown = res.rowcount
+        if unknown:
+            await session.execute(
+                update(BroadcastJob)
+                .where(BroadcastJob.id == job_id)
+                .values(failed=BroadcastJob.failed + unknown)
+            )
+        await session.commit()
+    return {"ok": True, "unknown": unknown}
+
+
+@app.post("/broadcasts/{job_id}/claim")
+async def claim_broadcast_recipients(job_id: int, limit: int = 200):
+    limit = max(1, min(limit, 1000))
+    async with SessionLocal() as session:
+        batch = (
+            select(BroadcastRecipient.tg_user_id)
+            .where(BroadcastRecipient.job_id == job_id, BroadcastRecipient.status == "pending")
+            .order_by(BroadcastRecipient.tg_user_id)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        )
+        res = await session.execute(
+            update(BroadcastRecipient)
+            .where(
+                BroadcastRecipient.job_id == job_id,
+                BroadcastRecipient.tg_user_id.in_(batch.scalar_subquery()),
+            )
+            .values(status="sending")
+            .returning(BroadcastRecipient.tg_user_id)
+        )
+        ids = sorted(row[0] for row in res.all())
+        await session.commit()
+    return {"tg_user_ids": ids}
+
+
+@app.post("/broadcasts/{job_id}/results")
+async def report_broadcast_results(job_id: int, payload: BroadcastResultsIn):
+    async with SessionLocal() as session:
+        counts = {}
+        for status, ids in (("sent", payload.sent), ("failed", payload.failed), ("blocked", payload.blocked)):
+            if not ids:
+                counts[status] = 0
+                continue
+            # только из sending: повторный отчёт о той же пачке не задвоит счётчики
+            res = await session.execute(
+                update(BroadcastRecipient)
+                .where(
+                    BroadcastRecipient.job_id == job_id,
+                    BroadcastRecipient.tg_user_id.in_(ids),
+                    BroadcastRecipient.status == "sending",
+                )
+                .values(status=status)
+            )
+            counts[status] = res.rowcount
+        res = await session.execute(
+            select(func.count()).select_from(BroadcastRecipient).where(
+                BroadcastRecipient.job_id == job_id,
+                BroadcastRecipient.status.in_(("pending", "sending")),
+            )
+        )
+        remaining = int(res.scalar() or 0)
+        values = {
+            "sent": BroadcastJob.sent + counts["sent"],
+            "failed": BroadcastJob.failed + counts["failed"] + counts["blocked"],
+        }
+        if not remaining:
+            values["status"] = "done"
+            values["finished_at"] = datetime.now(timezone.utc)
+        res = await session.execute(
+            update(BroadcastJob)
+            .where(BroadcastJob.id == job_id)
+            .values(**values)
+            .returning(BroadcastJob)
+            .execution_options(synchronize_session=False)
+        )
+        job = res.scalar_one_or_none()
+        if not job:
+            raise HTTPException(404, "broadcast not found")
+        data = _broadcast_job_dict(job)
+        await session.commit()
+    return data
+
+
 @app.get("/users/spam_filter")
 async def get_user_spam_filter(tg_user_id: int):
     async with SessionLocal() as session:
@@ -625,6 +1387,60 @@ async def set_user_short_feed(tg_user_id: int, enabled: bool = Body(...)):
         return {"ok": True, "enabled": bool(user.short_feed_on)}
 
 
+@app.get("/users/short_feed_engine")
+async def get_user_short_feed_engine(tg_user_id: int):
+    async with SessionLocal() as session:
+        res = await session.execute(select(User).where(User.tg_user_id == tg_user_id))
+        user = res.scalar_one_or_none()
+        return {"engine": user.short_feed_engine if user else "llm"}
+
+
+@app.post("/users/short_feed_engine")
+async def set_user_short_feed_engine(tg_user_id: int, engine: str = Body(...)):
+    if engine not in SHORT_FEED_ENGINES:
+        raise HTTPException(400, "unknown engine")
+    async with SessionLocal() as session:
+        res = await session.execute(select(User).where(User.tg_user_id == tg_user_id))
+        user = res.scalar_one_or_none()
+
+        if not user:
+            user = User(tg_user_id=tg_user_id, short_feed_engine=engine)
+            session.add(user)
+            await session.commit()
+            return {"ok": True, "engine": user.short_feed_engine}
+
+        user.short_feed_engine = engine
+        await session.commit()
+        return {"ok": True, "engine": user.short_feed_engine}
+
+
+@app.get("/users/bundle_mode")
+async def get_user_bundle_mode(tg_user_id: int):
+    async with SessionLocal() as session:
+        res = await session.execute(select(User).where(User.tg_user_id == tg_user_id))
+        user = res.scalar_one_or_none()
+        return {"mode": user.bundle_mode if user else "off"}
+
+
+@app.post("/users/bundle_mode")
+async def set_user_bundle_mode(tg_user_id: int, mode: str = Body(...)):
+    if mode not in BUNDLE_MODES:
+        raise HTTPException(400, "unknown bundle mode")
+    async with SessionLocal() as session:
+        res = await session.execute(select(User).where(User.tg_user_id == tg_user_id))
+        user = res.scalar_one_or_none()
+
+        if not user:
+            user = User(tg_user_id=tg_user_id, bundle_mode=mode)
+            session.add(user)
+            await session.commit()
+            return {"ok": True, "mode": user.bundle_mode}
+
+        user.bundle_mode = mode
+        await session.commit()
+        return {"ok": True, "mode": user.bundle_mode}
+
+
 @app.get("/admin/stats")
 async def get_admin_stats(tg_user_id: int):
     if OWNER_TG_USER_ID and tg_user_id != OWNER_TG_USER_ID:
@@ -730,6 +1546,63 @@ async def admin_revoke_vip(payload: AdminVipRevokeIn):
         return {"ok": True, "revoked": True}
 
 
+def _user_settings(user: User | None) -> dict:
+    vip_until = user.vip_until if user else None
+    return {
+        "vip_active": bool(vip_until and vip_until > datetime.now(timezone.utc)),
+        "vip_until": vip_until.isoformat() if vip_until else None,
+        "forwarding": bool(user.forwarding_on) if user else True,
+        "spam_filter": bool(user.spam_filter_on) if user else False,
+        "short_feed": bool(user.short_feed_on) if user else False,
+        "short_feed_engine": user.short_feed_engine if user else "llm",
+        "bundle_mode": user.bundle_mode if user else "off",
+    }
+
+
+@app.get("/users/settings")
+async def get_user_settings(tg_user_id: int):
+    async with SessionLocal() as session:
+        res = await session.execute(select(User).where(User.tg_user_id == tg_user_id))
+        return _user_settings(res.scalar_one_or_none())
+
+
+@app.post("/users/settings/toggle")
+async def toggle_user_setting(payload: ToggleSettingIn):
+    """
+    Атомарно переключает настройку и возвращает все настройки пользователя.
+    С require_vip проверка подписки входит в тот же UPDATE: без активной
+    подписки строка не меняется и в ответе ok=False.
+    """
+    if payload.setting not in TOGGLE_SETTINGS:
+        raise HTTPException(400, "unknown setting")
+    column, toggled = TOGGLE_SETTINGS[payload.setting]
+    conditions = [User.tg_user_id == payload.tg_user_id]
+    if payload.require_vip:
+        conditions.append(User.vip_until > func.now())
+    async with SessionLocal() as session:
+        if not payload.require_vip:
+            await session.execute(
+                pg_insert(User).values(tg_user_id=payload.tg_user_id).on_conflict_do_nothing()
+            )
+        res = await session.execute(
+            update(User)
+            .where(*conditions)
+            .values({column: toggled})
+            .returning(User)
+            .execution_options(synchronize_session=False)
+        )
+        user = res.scalar_one_or_none()
+        ok = user is not None
+        if not ok:
+            res = await session.execute(select(User).where(User.tg_user_id == payload.tg_user_id))
+            user = res.scalar_one_or_none()
+        settings = _user_settings(user)
+        await session.commit()
+    if ok and payload.setting == "forwarding" and settings["forwarding"]:
+        await publish_new_posts([payload.tg_user_id])
+    return {"ok": ok, "settings": settings}
+
+
 @app.get("/users/vip_status")
 async def get_user_vip_status(tg_user_id: int):
     async with SessionLocal() as session:
@@ -744,20 +1617,24 @@ async def get_user_vip_status(tg_user_id: int):
         }
 
 
+async def _extend_vip(session, tg_user_id: int, days: int) -> datetime:
+    # строка пользователя блокируется: параллельные продления не теряют дни
+    res = await session.execute(select(User).where(User.tg_user_id == tg_user_id).with_for_update())
+    user = res.scalar_one_or_none()
+    if not user:
+        user = User(tg_user_id=tg_user_id)
+        session.add(user)
+        await session.flush()
+
+    user.vip_until = vip_extended_until(user.vip_until, days, datetime.now(timezone.utc))
+    return user.vip_until
+
+
 @app.post("/users/vip_extend")
 async def extend_user_vip(payload: VipExtendIn):
     if payload.days <= 0:
         raise HTTPException(400, "days must be > 0")
     async with SessionLocal() as session:
-        res = await session.execute(select(User).where(User.tg_user_id == payload.tg_user_id))
-        user = res.scalar_one_or_none()
-        if not user:
-            user = User(tg_user_id=payload.tg_user_id)
-            session.add(user)
-            await session.flush()
-
-        now = datetime.now(timezone.utc)
-        base = user.vip_until if user.vip_until and user.vip_until > now else now
-        user.vip_until = base + timedelta(days=payload.days)
+        vip_until = await _extend_vip(session, payload.tg_user_id, payload.days)
         await session.commit()
-        return {"ok": True, "vip_until": user.vip_until.isoformat()}
+        return {"ok": True, "vip_until": vip_until.isoformat()}
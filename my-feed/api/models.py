@@ -1,6 +1,6 @@
 from sqlalchemy.orm import Mapped, mapped_column
 from datetime import datetime
-from sqlalchemy import DateTime, Text, BigInteger, ForeignKey, UniqueConstraint, Boolean, String, Integer
+from sqlalchemy import DateTime, Text, BigInteger, ForeignKey, UniqueConstraint, Boolean, String, Integer, Index
 from api.db import Base
 
 # Table users
@@ -14,6 +14,10 @@ class User(Base):
     forwarding_on: Mapped[bool] = mapped_column(Boolean, default=True, nullable=False)
     spam_filter_on: Mapped[bool] = mapped_column(Boolean, default=False, nullable=False)
     short_feed_on: Mapped[bool] = mapped_column(Boolean, default=False, nullable=False)
+    short_feed_engine: Mapped[str] = mapped_column(String(16), default="llm", nullable=False)
+    bundle_mode: Mapped[str] = mapped_column(String(16), default="off", nullable=False)
+    # растёт при каждом изменении списка каналов; по нему бот сверяет свой кэш
+    channels_rev: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
     welcome_sent: Mapped[bool] = mapped_column(Boolean, default=False, nullable=False)
     trial_vip_granted: Mapped[bool] = mapped_column(Boolean, default=False, nullable=False)
     vip_until: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
@@ -42,6 +46,65 @@ class Post(Base):
     media_group_id: Mapped[int | None] = mapped_column(BigInteger, nullable=True)
     published_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), index=True)
     is_sent: Mapped[bool] = mapped_column(Boolean, default=False, index=True)
+    summary: Mapped[str | None] = mapped_column(Text, nullable=True)
+    send_attempts: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    next_attempt_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
+    # время приёма поста API; от него доставка отсчитывает ожидание сжатия
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True))
     __table_args__ = (
         UniqueConstraint("channel_id", "tg_message_id", name="uq_channel_msg"),
     )
+
+# Posts that could not be delivered and will not be retried
+class DeadLetter(Base):
+    __tablename__ = "dead_letters"
+    id: Mapped[int] = mapped_column(primary_key=True)
+    post_id: Mapped[int] = mapped_column(ForeignKey("posts.id", ondelete="CASCADE"), index=True)
+    tg_user_id: Mapped[int] = mapped_column(BigInteger, index=True)
+    error: Mapped[str] = mapped_column(Text)
+    attempts: Mapped[int] = mapped_column(Integer)
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True))
+
+# Payment intents shared between the bot and background payment workers
+class PaymentIntent(Base):
+    __tablename__ = "payment_intents"
+    id: Mapped[int] = mapped_column(primary_key=True)
+    payload: Mapped[str] = mapped_column(String(255), unique=True, index=True)
+    tg_user_id: Mapped[int] = mapped_column(BigInteger, index=True)
+    provider: Mapped[str] = mapped_column(String(16), index=True)
+    plan: Mapped[str] = mapped_column(String(32))
+    # срок VIP по тарифу на момент создания; начисляется вместе с переводом в paid
+    days: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    status: Mapped[str] = mapped_column(String(16), default="pending", index=True)
+    tx_id: Mapped[str | None] = mapped_column(String(255), nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True))
+    paid_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
+    expires_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True, index=True)
+
+# Admin broadcasts: the job and a per-recipient row, so a broadcast survives restarts
+class BroadcastJob(Base):
+    __tablename__ = "broadcast_jobs"
+    id: Mapped[int] = mapped_column(primary_key=True)
+    admin_tg_user_id: Mapped[int] = mapped_column(BigInteger)
+    group: Mapped[str] = mapped_column(String(16))
+    text: Mapped[str | None] = mapped_column(Text, nullable=True)
+    source_chat_id: Mapped[int | None] = mapped_column(BigInteger, nullable=True)
+    source_message_id: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    status_chat_id: Mapped[int | None] = mapped_column(BigInteger, nullable=True)
+    status_message_id: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    status: Mapped[str] = mapped_column(String(16), default="running", index=True)
+    total: Mapped[int] = mapped_column(Integer, default=0)
+    sent: Mapped[int] = mapped_column(Integer, default=0)
+    failed: Mapped[int] = mapped_column(Integer, default=0)
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True))
+    finished_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
+
+class BroadcastRecipient(Base):
+    __tablename__ = "broadcast_recipients"
+    job_id: Mapped[int] = mapped_column(ForeignKey("broadcast_jobs.id", ondelete="CASCADE"), primary_key=True)
+    tg_user_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    # pending -> sending -> sent | failed | blocked; rows left in sending after a crash become unknown
+    status: Mapped[str] = mapped_column(String(16), default="pending")
+    __table_args__ = (
+        Index("ix_broadcast_recipients_job_status", "job_id", "status"),
+    )
@@ -0,0 +1,66 @@
+import asyncio
+import uuid
+from collections import deque
+from typing import Callable, Iterable
+
+
+class NotificationIndex:
+    """
+    In-memory журнал уведомлений о новых постах для long-poll /posts/stream.
+    Каждое уведомление получает порядковый номер (cursor); клиент передаёт
+    последний увиденный cursor и epoch процесса. Если журнал уже не покрывает
+    запрошенный cursor или API перезапускался, клиенту возвращается resync,
+    и он сам делает полный проход по БД.
+    """
+
+    def __init__(self, maxlen: int = 10000):
+        self.epoch = uuid.uuid4().hex
+        self.seq = 0
+        self._log: deque[tuple[int, int]] = deque(maxlen=maxlen)
+        self._changed = asyncio.Event()
+
+    def mark(self, tg_user_ids: Iterable[int]) -> None:
+        for uid in tg_user_ids:
+            self.seq += 1
+            self._log.append((self.seq, int(uid)))
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def collect(self, since: int, user_filter: Callable[[int], bool]) -> tuple[list[int], bool]:
+        if since > self.seq:
+            return [], True
+        oldest = self._log[0][0] if self._log else self.seq + 1
+        resync = since < oldest - 1
+        users = set()
+        for seq, uid in reversed(self._log):
+            if seq <= since:
+                break
+            if user_filter(uid):
+                users.add(uid)
+        return sorted(users), resync
+
+    async def wait(
+        self,
+        since: int | None,
+        epoch: str | None,
+        user_filter: Callable[[int], bool],
+        timeout: float,
+    ) -> dict:
+        if since is None or epoch != self.epoch:
+            return self._response([], resync=True)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            users, resync = self.collect(since, user_filter)
+            if users or resync:
+                return self._response(users, resync=resync)
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return self._response([], resync=False)
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout=remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    def _response(self, users: list[int], resync: bool) -> dict:
+        return {"users": users, "resync": resync, "cursor": self.seq, "epoch": self.epoch}
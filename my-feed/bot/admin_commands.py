@@ -3,7 +3,7 @@ from datetime import datetime
 from aiogram.filters import Command
 from aiogram.types import Message
 
-from bot.api_client import get_admin_stats, admin_grant_vip, admin_revoke_vip, resolve_user_id, get_broadcast_targets
+from bot.api_client import get_admin_stats, admin_grant_vip, admin_revoke_vip, resolve_user_id, create_broadcast
 
 
 def _format_date(iso_value: str | None) -> str:
@@ -146,20 +146,20 @@ def register_admin_commands(dp, owner_tg_user_id: int) -> None:
             await msg.answer("Использование: /broadcast [vip|free|active] <текст> или ответом на сообщение.")
             return
 
-        targets = await get_broadcast_targets(msg.from_user.id, group=group)
-        if not targets:
-            await msg.answer("Нет получателей для рассылки.")
+        # Рассылку ведёт bot.broadcast_worker: задание и список получателей
+        # сохраняются в API, прогресс обновляется в этом сообщении
+        status_msg = await msg.answer("⏳ Рассылка поставлена в очередь...")
+        source = msg.reply_to_message if not text else None
+        job = await create_broadcast(
+            msg.from_user.id,
+            group=group,
+            text=text,
+            source_chat_id=source.chat.id if source else None,
+            source_message_id=source.message_id if source else None,
+            status_chat_id=status_msg.chat.id,
+            status_message_id=status_msg.message_id,
+        )
+        if not job.get("total"):
+            await status_msg.edit_text("Нет получателей для рассылки.")
             return
-
-        sent = 0
-        failed = 0
-        for uid in targets:
-            try:
-                if text:
-                    await msg.bot.send_message(uid, text)
-                else:
-                    await msg.reply_to_message.copy_to(uid)
-                sent += 1
-            except Exception:
-                failed += 1
-        await msg.answer(f"✅ Рассылка завершена. Успешно: {sent}, ошибок: {failed}.")
+        await status_msg.edit_text(f"⏳ Рассылка #{job['id']}: 0/{job['total']}")
@@ -19,15 +19,57 @@ async def list_channels(tg_user_id: int) -> list[str]:
         data = r.json()
         return data.get("channels", [])
 
+async def get_channel_list(tg_user_id: int) -> dict:
+    async with httpx.AsyncClient(timeout=10) as client:
+        r = await client.get(f"{API_URL}/channels/list", params={"tg_user_id": tg_user_id})
+        r.raise_for_status()
+        return r.json()
+
 async def get_unsent_posts(tg_user_id: int, limit: int = 10) -> list[dict]:
     async with httpx.AsyncClient(timeout=20) as client:
         r = await client.get(f"{API_URL}/posts/unsent", params={"tg_user_id": tg_user_id, "limit": limit})
         r.raise_for_status()
         return r.json().get("posts", [])
 
-async def get_latest_posts(tg_user_id: int, limit: int = 50) -> list[dict]:
+async def wait_pending_users(
+    since: int | None = None,
+    epoch: str | None = None,
+    shards: list[int] | None = None,
+    shard_count: int | None = None,
+    timeout: float = 25.0,
+) -> dict:
+    params = {"timeout": timeout}
+    if since is not None:
+        params["since"] = since
+    if epoch:
+        params["epoch"] = epoch
+    if shards:
+        params["shard"] = shards
+    if shard_count:
+        params["shards"] = shard_count
+    async with httpx.AsyncClient(timeout=timeout + 10) as client:
+        r = await client.get(f"{API_URL}/posts/stream", params=params)
+        r.raise_for_status()
+        return r.json()
+
+async def get_digest_candidates(
+    tg_user_id: int,
+    hours: int,
+    per_channel: int,
+    char_budget: int,
+    limit: int,
+) -> list[dict]:
     async with httpx.AsyncClient(timeout=20) as client:
-        r = await client.get(f"{API_URL}/posts/latest", params={"tg_user_id": tg_user_id, "limit": limit})
+        r = await client.get(
+            f"{API_URL}/posts/digest_candidates",
+            params={
+                "tg_user_id": tg_user_id,
+                "hours": hours,
+                "per_channel": per_channel,
+                "char_budget": char_budget,
+                "limit": limit,
+            },
+        )
         r.raise_for_status()
         return r.json().get("posts", [])
 
@@ -36,6 +78,24 @@ async def mark_posts_sent(post_ids: list[int]) -> None:
         r = await client.post(f"{API_URL}/posts/mark_sent", json=post_ids)
         r.raise_for_status()
 
+async def report_delivery_failure(
+    tg_user_id: int,
+    post_ids: list[int],
+    kind: str,
+    error: str,
+    retry_after: float | None = None,
+) -> dict:
+    async with httpx.AsyncClient(timeout=20) as client:
+        r = await client.post(f"{API_URL}/posts/delivery_failed", json={
+            "tg_user_id": tg_user_id,
+            "post_ids": post_ids,
+            "kind": kind,
+            "error": error,
+            "retry_after": retry_after,
+        })
+        r.raise_for_status()
+        return r.json()
+
 async def set_forwarding(tg_user_id: int, enabled: bool) -> dict:
     async with httpx.AsyncClient(timeout=20) as client:
         r = await client.post(f"{API_URL}/users/forwarding", params={"tg_user_id": tg_user_id}, json=enabled)
@@ -69,15 +129,21 @@ async def set_spam_filter(tg_user_id: int, enabled: bool) -> dict:
         r.raise_for_status()
         return r.json()
 
-async def get_short_feed(tg_user_id: int) -> bool:
+async def set_short_feed(tg_user_id: int, enabled: bool) -> dict:
     async with httpx.AsyncClient(timeout=20) as client:
-        r = await client.get(f"{API_URL}/users/short_feed", params={"tg_user_id": tg_user_id})
+        r = await client.post(f"{API_URL}/users/short_feed", params={"tg_user_id": tg_user_id}, json=enabled)
         r.raise_for_status()
-        return bool(r.json().get("enabled", False))
+        return r.json()
 
-async def set_short_feed(tg_user_id: int, enabled: bool) -> dict:
+async def set_short_feed_engine(tg_user_id: int, engine: str) -> dict:
     async with httpx.AsyncClient(timeout=20) as client:
-        r = await client.post(f"{API_URL}/users/short_feed", params={"tg_user_id": tg_user_id}, json=enabled)
+        r = await client.post(f"{API_URL}/users/short_feed_engine", params={"tg_user_id": tg_user_id}, json=engine)
+        r.raise_for_status()
+        return r.json()
+
+async def set_bundle_mode(tg_user_id: int, mode: str) -> dict:
+    async with httpx.AsyncClient(timeout=20) as client:
+        r = await client.post(f"{API_URL}/users/bundle_mode", params={"tg_user_id": tg_user_id}, json=mode)
         r.raise_for_status()
         return r.json()
 
@@ -134,12 +200,83 @@ async def get_broadcast_targets(admin_tg_user_id: int, group: str | None = None)
         r.raise_for_status()
         return r.json().get("targets", [])
 
+async def create_broadcast(
+    admin_tg_user_id: int,
+    group: str,
+    text: str | None = None,
+    source_chat_id: int | None = None,
+    source_message_id: int | None = None,
+    status_chat_id: int | None = None,
+    status_message_id: int | None = None,
+) -> dict:
+    async with httpx.AsyncClient(timeout=60) as client:
+        r = await client.post(f"{API_URL}/admin/broadcasts", json={
+            "admin_tg_user_id": admin_tg_user_id,
+            "group": group,
+            "text": text,
+            "source_chat_id": source_chat_id,
+            "source_message_id": source_message_id,
+            "status_chat_id": status_chat_id,
+            "status_message_id": status_message_id,
+        })
+        r.raise_for_status()
+        return r.json()
+
+async def list_active_broadcasts() -> list[dict]:
+    async with httpx.AsyncClient(timeout=20) as client:
+        r = await client.get(f"{API_URL}/broadcasts/active")
+        r.raise_for_status()
+        return r.json().get("jobs", [])
+
+async def recover_broadcast(job_id: int) -> dict:
+    async with httpx.AsyncClient(timeout=20) as client:
+        r = await client.post(f"{API_URL}/broadcasts/{job_id}/recover")
+        r.raise_for_status()
+        return r.json()
+
+async def claim_broadcast_recipients(job_id: int, limit: int = 200) -> list[int]:
+    async with httpx.AsyncClient(timeout=20) as client:
+        r = await client.post(f"{API_URL}/broadcasts/{job_id}/claim", params={"limit": limit})
+        r.raise_for_status()
+        return r.json().get("tg_user_ids", [])
+
+async def report_broadcast_results(
+    job_id: int,
+    sent: list[int] | None = None,
+    failed: list[int] | None = None,
+    blocked: list[int] | None = None,
+) -> dict:
+    async with httpx.AsyncClient(timeout=20) as client:
+        r = await client.post(f"{API_URL}/broadcasts/{job_id}/results", json={
+            "sent": sent or [],
+            "failed": failed or [],
+            "blocked": blocked or [],
+        })
+        r.raise_for_status()
+        return r.json()
+
 async def get_vip_status(tg_user_id: int) -> dict:
     async with httpx.AsyncClient(timeout=20) as client:
         r = await client.get(f"{API_URL}/users/vip_status", params={"tg_user_id": tg_user_id})
         r.raise_for_status()
         return r.json()
 
+async def get_user_settings(tg_user_id: int) -> dict:
+    async with httpx.AsyncClient(timeout=20) as client:
+        r = await client.get(f"{API_URL}/users/settings", params={"tg_user_id": tg_user_id})
+        r.raise_for_status()
+        return r.json()
+
+async def toggle_user_setting(tg_user_id: int, setting: str, require_vip: bool = False) -> dict:
+    async with httpx.AsyncClient(timeout=20) as client:
+        r = await client.post(f"{API_URL}/users/settings/toggle", json={
+            "tg_user_id": tg_user_id,
+            "setting": setting,
+            "require_vip": require_vip,
+        })
+        r.raise_for_status()
+        return r.json()
+
 async def extend_vip(tg_user_id: int, days: int) -> dict:
     async with httpx.AsyncClient(timeout=20) as client:
         r = await client.post(f"{API_URL}/users/vip_extend", json={
@@ -149,6 +286,76 @@ async def extend_vip(tg_user_id: int, days: int) -> dict:
         r.raise_for_status()
         return r.json()
 
+async def create_payment_intent(
+    payload: str,
+    tg_user_id: int,
+    provider: str,
+    plan: str,
+    days: int | None = None,
+    ttl_sec: int | None = None,
+) -> dict:
+    async with httpx.AsyncClient(timeout=20) as client:
+        r = await client.post(f"{API_URL}/payments/intents", json={
+            "payload": payload,
+            "tg_user_id": tg_user_id,
+            "provider": provider,
+            "plan": plan,
+            "days": days,
+            "ttl_sec": ttl_sec,
+        })
+        r.raise_for_status()
+        return r.json()
+
+async def list_payment_intents(
+    provider: str,
+    status: str = "pending",
+    tg_user_id: int | None = None,
+    plan: str | None = None,
+    limit: int = 500,
+    after_id: int | None = None,
+    expired_within_sec: int = 0,
+) -> list[dict]:
+    params = {"provider": provider, "status": status, "limit": limit}
+    if after_id is not None:
+        params["after_id"] = after_id
+    if expired_within_sec:
+        params["expired_within_sec"] = expired_within_sec
+    if tg_user_id is not None:
+        params["tg_user_id"] = tg_user_id
+    if plan:
+        params["plan"] = plan
+    async with httpx.AsyncClient(timeout=20) as client:
+        r = await client.get(f"{API_URL}/payments/intents", params=params)
+        r.raise_for_status()
+        return r.json().get("intents", [])
+
+async def cancel_payment_intent(payload: str) -> dict:
+    async with httpx.AsyncClient(timeout=20) as client:
+        r = await client.post(f"{API_URL}/payments/intents/cancel", json={"payload": payload})
+        r.raise_for_status()
+        return r.json()
+
+async def cleanup_payment_intents() -> dict:
+    async with httpx.AsyncClient(timeout=20) as client:
+        r = await client.post(f"{API_URL}/payments/intents/cleanup")
+        r.raise_for_status()
+        return r.json()
+
+async def get_payment_intent(payload: str) -> dict | None:
+    async with httpx.AsyncClient(timeout=20) as client:
+        r = await client.get(f"{API_URL}/payments/intent", params={"payload": payload})
+        r.raise_for_status()
+        return r.json().get("intent")
+
+async def complete_payment_intent(payload: str, tx_id: str | None = None) -> dict:
+    async with httpx.AsyncClient(timeout=20) as client:
+        r = await client.post(f"{API_URL}/payments/intents/complete", json={
+            "payload": payload,
+            "tx_id": tx_id,
+        })
+        r.raise_for_status()
+        return r.json()
+
 async def delete_channel(tg_user_id: int, username: str) -> dict:
     async with httpx.AsyncClient(timeout=10) as client:
         r = await client.post(f"{API_URL}/channels/delete", json={
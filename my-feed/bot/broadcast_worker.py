@@ -0,0 +1,178 @@
+import asyncio
+import logging
+import os
+import time
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+from bot.api_client import (
+    claim_broadcast_recipients,
+    list_active_broadcasts,
+    recover_broadcast,
+    report_broadcast_results,
+)
+from bot.feed_worker import classify_delivery_error
+
+log = logging.getLogger(__name__)
+
+# Задания рассылки и статус каждого получателя хранит API, поэтому рассылка
+# продолжается после перезапуска воркера. Bot API пропускает около 30
+# сообщений в секунду на бота: 100 тысяч получателей — примерно час.
+BROADCAST_RATE_PER_SEC = float(os.getenv("BROADCAST_RATE_PER_SEC", "28"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "30"))
+# Размер пачки — это и окно, которое после падения помечается unknown
+BROADCAST_BATCH = int(os.getenv("BROADCAST_BATCH", "200"))
+BROADCAST_MAX_RETRY_AFTER = int(os.getenv("BROADCAST_MAX_RETRY_AFTER", "5"))
+BROADCAST_POLL_SEC = float(os.getenv("BROADCAST_POLL_SEC", "5"))
+PROGRESS_INTERVAL_SEC = 5.0
+
+
+class RateLimiter:
+    """
+    Токен-бакет на rate отправок в секунду, общий для всех задач рассылки.
+    pause() останавливает всех: flood control Telegram действует на бота целиком.
+    """
+
+    def __init__(self, rate: float, burst: int | None = None) -> None:
+        self.rate = rate
+        self.capacity = float(burst or max(1, int(rate)))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float) -> None:
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+
+
+def progress_text(job: dict) -> str:
+    done = job["sent"] + job["failed"]
+    if job["status"] == "done":
+        return f"✅ Рассылка завершена. Успешно: {job['sent']}, ошибок: {job['failed']}."
+    return (
+        f"⏳ Рассылка #{job['id']}: {done}/{job['total']}\n"
+        f"Успешно: {job['sent']}, ошибок: {job['failed']}."
+    )
+
+
+async def send_one(bot: Bot, job: dict, tg_user_id: int, limiter: RateLimiter) -> str:
+    """
+    sent, blocked или failed. Повторяется только RetryAfter — в этом случае
+    Telegram точно не принял сообщение; после сетевой ошибки сообщение могло
+    дойти, поэтому повтора нет.
+    """
+    for _ in range(BROADCAST_MAX_RETRY_AFTER + 1):
+        await limiter.acquire()
+        try:
+            if job.get("text"):
+                await bot.send_message(tg_user_id, job["text"])
+            else:
+                await bot.copy_message(tg_user_id, job["source_chat_id"], job["source_message_id"])
+            return "sent"
+        except TelegramRetryAfter as e:
+            log.warning(f"Broadcast {job['id']}: flood control, pausing for {e.retry_after}s")
+            limiter.pause(e.retry_after)
+        except Exception as e:
+            kind = classify_delivery_error(e)
+            return "blocked" if kind == "blocked" else "failed"
+    return "failed"
+
+
+class ProgressMessage:
+    def __init__(self, bot: Bot, job: dict) -> None:
+        self.bot = bot
+        self.chat_id = job.get("status_chat_id")
+        self.message_id = job.get("status_message_id")
+        self.last_edit_at = 0.0
+
+    async def update(self, job: dict, force: bool = False) -> None:
+        if not self.chat_id or not self.message_id:
+            return
+        now = time.monotonic()
+        if not force and now - self.last_edit_at < PROGRESS_INTERVAL_SEC:
+            return
+        self.last_edit_at = now
+        try:
+            await self.bot.edit_message_text(
+                progress_text(job), chat_id=self.chat_id, message_id=self.message_id
+            )
+        except TelegramBadRequest as e:
+            if "message is not modified" not in str(e).lower():
+                log.warning(f"Broadcast {job['id']}: progress edit failed: {e}")
+        except TelegramRetryAfter:
+            pass
+
+
+async def run_job(bot: Bot, job: dict, limiter: RateLimiter) -> dict:
+    job_id = job["id"]
+    res = await recover_broadcast(job_id)
+    if res.get("unknown"):
+        log.warning(f"Broadcast {job_id}: {res['unknown']} recipients were in flight before restart, skipped")
+    progress = ProgressMessage(bot, job)
+    sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+
+    async def guarded(tg_user_id: int) -> str:
+        async with sem:
+            return await send_one(bot, job, tg_user_id, limiter)
+
+    started = time.monotonic()
+    while True:
+        ids = await claim_broadcast_recipients(job_id, BROADCAST_BATCH)
+        grouped: dict[str, list[int]] = {"sent": [], "failed": [], "blocked": []}
+        if ids:
+            results = await asyncio.gather(*(guarded(uid) for uid in ids))
+            for uid, result in zip(ids, results):
+                grouped[result].append(uid)
+        job = await report_broadcast_results(job_id, **grouped)
+        if not ids or job["status"] == "done":
+            break
+        await progress.update(job)
+    await progress.update(job, force=True)
+    log.info(
+        f"Broadcast {job_id} {job['status']}: sent {job['sent']}, failed {job['failed']} "
+        f"of {job['total']} in {time.monotonic() - started:.0f}s"
+    )
+    return job
+
+
+async def broadcast_loop(bot: Bot) -> None:
+    limiter = RateLimiter(BROADCAST_RATE_PER_SEC)
+    while True:
+        try:
+            for job in await list_active_broadcasts():
+                await run_job(bot, job, limiter)
+        except Exception as e:
+            log.warning(f"Broadcast loop failed: {e}")
+        await asyncio.sleep(BROADCAST_POLL_SEC)
+
+
+async def main():
+    logging.basicConfig(level=logging.INFO)
+    token = os.getenv("BOT_TOKEN")
+    if not token:
+        raise RuntimeError("BOT_TOKEN is not set in .env")
+    bot = Bot(token=token)
+    try:
+        await broadcast_loop(bot)
+    finally:
+        await bot.session.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,63 @@
+import os
+
+from bot import api_client
+from bot.cache import TTLCache
+
+# Список подписок пользователя кэшируется вместе с ревизией из API. Каждая
+# правка списка возвращает новую ревизию: если она ровно на единицу больше
+# закэшированной, бот применяет правку к кэшу сам, иначе (список менялся
+# где-то ещё) запись сбрасывается и при следующем показе читается заново.
+CHANNELS_CACHE_TTL_SEC = int(os.getenv("CHANNELS_CACHE_TTL_SEC", "300"))
+CHANNELS_CACHE_SIZE = int(os.getenv("CHANNELS_CACHE_SIZE", "20000"))
+channels_cache = TTLCache(maxsize=CHANNELS_CACHE_SIZE, ttl=CHANNELS_CACHE_TTL_SEC)
+
+
+async def get_channels(tg_user_id: int) -> list[str]:
+    entry = channels_cache.get(tg_user_id)
+    if entry is None:
+        data = await api_client.get_channel_list(tg_user_id)
+        entry = (int(data.get("rev") or 0), tuple(data.get("channels", [])))
+        channels_cache.set(tg_user_id, entry)
+    return list(entry[1])
+
+
+def _apply(
+    tg_user_id: int,
+    rev: int | None,
+    added: str | None = None,
+    removed: str | None = None,
+    cleared: bool = False,
+) -> None:
+    entry = channels_cache.get(tg_user_id)
+    if entry is None:
+        return
+    cached_rev, channels = entry
+    if rev is None or rev != cached_rev + 1:
+        if rev != cached_rev:
+            channels_cache.pop(tg_user_id)
+        return
+    if cleared:
+        channels = ()
+    else:
+        channels = tuple(ch for ch in channels if ch != removed)
+        if added and added not in channels:
+            channels = (*channels, added)
+    channels_cache.set(tg_user_id, (rev, channels))
+
+
+async def add_channel(tg_user_id: int, username: str) -> dict:
+    res = await api_client.add_channel(tg_user_id, username)
+    _apply(tg_user_id, res.get("rev"), added=username)
+    return res
+
+
+async def delete_channel(tg_user_id: int, username: str) -> dict:
+    res = await api_client.delete_channel(tg_user_id, username)
+    _apply(tg_user_id, res.get("rev"), removed=username)
+    return res
+
+
+async def delete_all_channels(tg_user_id: int) -> dict:
+    res = await api_client.delete_all_channels(tg_user_id)
+    _apply(tg_user_id, res.get("rev"), cleared=True)
+    return res
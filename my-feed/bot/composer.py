@@ -0,0 +1,171 @@
+import re
+from dataclasses import dataclass
+from functools import lru_cache
+from html import escape, unescape
+
+# Лимиты Telegram считаются в UTF-16 единицах видимого текста (после разбора HTML)
+CAPTION_LIMIT = 1024
+MESSAGE_LIMIT = 4096
+TAG_RE = re.compile(r"<[^>]+>")
+HTML_TOKEN_RE = re.compile(r"(<[^>]+>|&#?\w+;)")
+SPLIT_SEPARATORS = ("\n\n", "\n", ". ", " ")
+COMPOSE_CACHE_SIZE = 4096
+
+
+def utf16_len(text: str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+
+def visible_len(html_text: str) -> int:
+    return utf16_len(unescape(TAG_RE.sub("", html_text)))
+
+
+def build_source_line(p: dict) -> str:
+    channel = (p.get("channel") or "").lstrip("@")
+    channel_title = (p.get("channel_title") or "").strip()
+    msg_id = p.get("tg_message_id")
+    source_url = f"https://t.me/{channel}/{msg_id}" if channel and msg_id else None
+    source_name = escape(channel_title or channel)
+    if source_url:
+        return f'<b>Источник:</b> <a href="{source_url}">{source_name}</a>'
+    return f"<b>Источник:</b> {source_name}"
+
+
+def _fit_prefix(text: str, limit: int) -> int:
+    """Число символов text, которые укладываются в limit UTF-16 единиц."""
+    used = 0
+    for idx, ch in enumerate(text):
+        used += 2 if ord(ch) > 0xFFFF else 1
+        if used > limit:
+            return idx
+    return len(text)
+
+
+def split_text(text: str, limit: int, first_limit: int | None = None) -> list[str]:
+    """
+    Режет простой (неэкранированный) текст на части по limit UTF-16 единиц;
+    первая часть может иметь свой лимит. Резать старается по абзацам,
+    строкам, предложениям и словам.
+    """
+    parts: list[str] = []
+    rest = text.strip()
+    current_limit = limit if first_limit is None else first_limit
+    while rest:
+        if utf16_len(rest) <= current_limit:
+            parts.append(rest)
+            break
+        cut = _fit_prefix(rest, current_limit)
+        if cut == 0:
+            parts.append("")
+            current_limit = limit
+            continue
+        head = rest[:cut]
+        for sep in SPLIT_SEPARATORS:
+            pos = head.rfind(sep)
+            if pos >= cut // 2:
+                cut = pos + len(sep)
+                break
+        parts.append(rest[:cut].rstrip())
+        rest = rest[cut:].lstrip()
+        current_limit = limit
+    return parts
+
+
+def split_html(html_text: str, limit: int) -> list[str]:
+    """
+    Режет HTML на части по limit UTF-16 единиц видимого текста. Теги и
+    сущности не разрываются; теги, открытые на месте разреза, закрываются
+    в конце части и открываются заново в начале следующей.
+    """
+    parts: list[str] = []
+    current: list[str] = []
+    open_tags: list[tuple[str, str]] = []
+    used = 0
+
+    def flush() -> None:
+        nonlocal current, used
+        closing = "".join(f"</{name}>" for name, _ in reversed(open_tags))
+        parts.append("".join(current) + closing)
+        current = [raw for _, raw in open_tags]
+        used = 0
+
+    for token in HTML_TOKEN_RE.split(html_text):
+        if not token:
+            continue
+        if token.startswith("<"):
+            inner = token.strip("</>").split()
+            name = inner[0].lower() if inner else ""
+            if token.startswith("</"):
+                for idx in range(len(open_tags) - 1, -1, -1):
+                    if open_tags[idx][0] == name:
+                        del open_tags[idx]
+                        break
+            elif name and not token.endswith("/>"):
+                open_tags.append((name, token))
+            current.append(token)
+            continue
+        if token.startswith("&"):
+            units = utf16_len(unescape(token))
+            if used and used + units > limit:
+                flush()
+            current.append(token)
+            used += units
+            continue
+        while token:
+            room = limit - used
+            if utf16_len(token) <= room:
+                current.append(token)
+                used += utf16_len(token)
+                break
+            cut = _fit_prefix(token, room)
+            pos = token.rfind(" ", 0, cut)
+            if pos >= cut // 2 and pos > 0:
+                cut = pos + 1
+            elif not cut and not used:
+                # символ шире лимита — отдаём его целиком, иначе цикл не продвинется
+                cut = 1
+            if cut:
+                current.append(token[:cut])
+                token = token[cut:]
+            flush()
+    if used or not parts:
+        parts.append("".join(current))
+    return parts
+
+
+@dataclass(frozen=True)
+class ComposedPost:
+    caption: str | None
+    messages: tuple[str, ...]
+
+
+@lru_cache(maxsize=COMPOSE_CACHE_SIZE)
+def _compose(channel: str, channel_title: str, msg_id: int, text_body: str, with_media: bool) -> ComposedPost:
+    source_line = build_source_line(
+        {"channel": channel, "channel_title": channel_title, "tg_message_id": msg_id}
+    )
+    # "\n\n" между строкой источника и текстом тоже входит в лимит
+    head_limit = (CAPTION_LIMIT if with_media else MESSAGE_LIMIT) - visible_len(source_line) - 2
+    parts = split_text(text_body or "", MESSAGE_LIMIT, first_limit=max(0, head_limit))
+    head = escape(parts[0]) if parts else ""
+    first = f"{source_line}\n\n{head}" if head else source_line
+    follow_ups = tuple(escape(part) for part in parts[1:] if part)
+    if with_media:
+        return ComposedPost(caption=first, messages=follow_ups)
+    return ComposedPost(caption=None, messages=(first, *follow_ups))
+
+
+def compose_post(p: dict, text_body: str, with_media: bool) -> ComposedPost:
+    """
+    Готовые к отправке подпись и сообщения поста: текст экранируется для
+    HTML, не влезающее в подпись или сообщение уходит следующими сообщениями.
+    Результат кэшируется по посту, поэтому рассылка одного поста многим
+    подписчикам рендерит его один раз.
+    """
+    return _compose(
+        p.get("channel") or "",
+        p.get("channel_title") or "",
+        int(p.get("tg_message_id") or 0),
+        text_body or "",
+        with_media,
+    )
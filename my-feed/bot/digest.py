@@ -1,44 +1,74 @@
+import asyncio
+import hashlib
 import json
 import logging
 import os
-from datetime import datetime, timezone, timedelta
 from html import escape
+from typing import AsyncIterator, Awaitable, Callable
 
 import httpx
 
+from common.redis_client import get_async_redis
+from common.textvec import cluster_by_similarity, hashed_counts, shingles, tfidf, tokenize
+
 log = logging.getLogger(__name__)
 
+ProgressCallback = Callable[[str], Awaitable[None]]
+
 MISTRAL_API_KEY = os.getenv("MISTRAL_API_KEY")
 MISTRAL_MODEL = os.getenv("MISTRAL_MODEL", "mistral-small-latest")
 MISTRAL_BASE_URL = os.getenv("MISTRAL_BASE_URL", "https://api.mistral.ai")
+# Map-reduce: посты режутся на куски по бюджету токенов, куски сжимаются
+# параллельно (не больше DIGEST_CONCURRENCY запросов), затем пункты
+# разных каналов про одно событие сливаются одним запросом.
+CHARS_PER_TOKEN = 3
+DIGEST_CHUNK_TOKEN_BUDGET = int(os.getenv("DIGEST_CHUNK_TOKEN_BUDGET", "3000"))
+DIGEST_CONCURRENCY = int(os.getenv("DIGEST_CONCURRENCY", "4"))
+DIGEST_TIMEOUT_SEC = int(os.getenv("DIGEST_TIMEOUT_SEC", "30"))
+DIGEST_HOURS = 12
+DIGEST_MAX_POSTS = int(os.getenv("DIGEST_MAX_POSTS", "300"))
+# Отбор кандидатов делает API: не больше DIGEST_PER_CHANNEL постов с канала
+# и DIGEST_CHAR_BUDGET символов текста на всю сводку
+DIGEST_PER_CHANNEL = int(os.getenv("DIGEST_PER_CHANNEL", "15"))
+DIGEST_CHAR_BUDGET = int(os.getenv("DIGEST_CHAR_BUDGET", "90000"))
+# Почти одинаковые посты (репосты одной новости разными каналами, повторы)
+# схлопываются до LLM: в промпт идёт один представитель, ссылки остальных
+# возвращаются к пункту сводки после разбора ответа.
+DIGEST_DUPLICATE_SIMILARITY = float(os.getenv("DIGEST_DUPLICATE_SIMILARITY", "0.6"))
+# Фрагменты сводки по каналу общие для всех подписчиков: ключ — хэш строк
+# промпта представителей канала (канал, ссылки, тексты), поэтому пользователи
+# с одинаковыми постами канала за окно получают готовый фрагмент без LLM.
+DIGEST_PROMPT_VERSION = "v1"
+DIGEST_FRAGMENT_TTL_SEC = int(os.getenv("DIGEST_FRAGMENT_TTL_SEC", str(6 * 3600)))
+FRAGMENT_KEY_PREFIX = "digest:fragment:"
 
-
-def _parse_dt(value: str) -> datetime | None:
-    if not value:
-        return None
-    try:
-        dt = datetime.fromisoformat(value)
-        if dt.tzinfo is None:
-            dt = dt.replace(tzinfo=timezone.utc)
-        return dt
-    except ValueError:
-        return None
-
-
-def select_recent_posts(posts: list[dict], hours: int = 12, limit: int = 20) -> list[dict]:
-    now = datetime.now(timezone.utc)
-    cutoff = now - timedelta(hours=hours)
-    selected = []
-    for p in posts:
-        if not p.get("is_sent"):
-            continue
-        dt = _parse_dt(p.get("published_at", ""))
-        if not dt or dt < cutoff:
-            continue
-        selected.append(p)
-        if len(selected) >= limit:
-            break
-    return selected
+MAP_SYSTEM_PROMPT = (
+    "Сделай краткую сводку на русском. "
+    "Используй только факты из постов, без выдумок. "
+    "Если несколько постов про одно и то же событие, объединяй в один пункт "
+    "и перечисляй все источники. "
+    "Верни ТОЛЬКО JSON-массив объектов, без пояснений. "
+    "Используй в источниках TITLE (название канала), не @username. "
+    "Формат объекта:\n"
+    "{\n"
+    "  \"summary\": \"одно предложение\",\n"
+    "  \"sources\": [\n"
+    "    {\"title\": \"Название канала\", \"link\": \"https://t.me/channel/123\"}\n"
+    "  ]\n"
+    "}\n"
+    "summary должно быть ОДНИМ предложением. "
+    "Не объединяй в один пункт посты разных каналов."
+)
+REDUCE_SYSTEM_PROMPT = (
+    "Тебе дан JSON-массив пунктов сводки вида {\"id\": номер, \"summary\": текст}. "
+    "Пункты собраны из разных частей ленты, поэтому одно событие может встречаться несколько раз. "
+    "Объедини пункты про одно и то же событие, остальные оставь как есть. "
+    "Используй только факты из пунктов, без выдумок. "
+    "Верни ТОЛЬКО объекты вида "
+    "{\"summary\": \"одно предложение\", \"ids\": [номера исходных пунктов]} "
+    "в формате JSON Lines: по одному объекту на строку, без массива и пояснений. "
+    "Каждый исходный id должен попасть ровно в один объект."
+)
 
 
 def _normalize_text(text: str, max_len: int = 800) -> str:
@@ -55,7 +85,51 @@ def _post_link(channel: str, msg_id: int) -> str:
     return f"https://t.me/{username}/{msg_id}"
 
 
-def _build_prompt(posts: list[dict]) -> str:
+def _post_source(p: dict) -> dict:
+    return {
+        "title": p.get("channel_title") or p.get("channel", ""),
+        "link": _post_link(p.get("channel", ""), int(p.get("tg_message_id") or 0)),
+    }
+
+
+def collapse_duplicates(posts: list[dict], threshold: float = DIGEST_DUPLICATE_SIMILARITY) -> tuple[list[dict], dict[str, list[dict]]]:
+    """
+    Возвращает представителей кластеров (самый длинный пост кластера, в
+    исходном порядке) и словарь: ссылка представителя -> источники остальных.
+    """
+    texts = [_normalize_text(p.get("text", "")) for p in posts]
+    indexed = [i for i, text in enumerate(texts) if text]
+    if len(indexed) < 2:
+        return posts, {}
+    vectors = tfidf(hashed_counts([shingles(tokenize(texts[i])) for i in indexed]))
+    representatives: set[int] = set(range(len(posts))) - set(indexed)
+    extra_sources: dict[str, list[dict]] = {}
+    for group in cluster_by_similarity(vectors, threshold):
+        members = [indexed[i] for i in group]
+        rep = max(members, key=lambda i: len(texts[i]))
+        representatives.add(rep)
+        others = [_post_source(posts[i]) for i in members if i != rep]
+        link = _post_source(posts[rep])["link"]
+        if others and link:
+            extra_sources[link] = others
+    return [posts[i] for i in sorted(representatives)], extra_sources
+
+
+def _expand_sources(items: list[dict], extra_sources: dict[str, list[dict]]) -> list[dict]:
+    if not extra_sources:
+        return items
+    expanded = []
+    for item in items:
+        sources = item.get("sources") or []
+        groups = [sources]
+        for s in sources:
+            if isinstance(s, dict):
+                groups.append(extra_sources.get(str(s.get("link", "")).strip(), []))
+        expanded.append({**item, "sources": _merge_sources(groups)})
+    return expanded
+
+
+def _prompt_lines(posts: list[dict]) -> list[str]:
     lines = []
     for p in posts:
         channel = p.get("channel", "")
@@ -66,7 +140,7 @@ def _build_prompt(posts: list[dict]) -> str:
             continue
         link = _post_link(channel, msg_id)
         lines.append(f"CHANNEL={channel} TITLE={channel_title} LINK={link} TEXT={text}")
-    return "\n".join(lines)
+    return lines
 
 
 def _format_digest(items: list[dict]) -> str:
@@ -110,57 +184,406 @@ def _extract_json(text: str) -> list[dict] | None:
     return None
 
 
-async def generate_digest(posts: list[dict]) -> str:
-    if not MISTRAL_API_KEY:
-        return "Ключ MISTRAL_API_KEY не задан. Добавь его в .env."
+def _chunk_posts(posts: list[dict], token_budget: int) -> list[list[dict]]:
+    chunks: list[list[dict]] = []
+    current: list[dict] = []
+    used = 0
+    for p in posts:
+        lines = _prompt_lines([p])
+        if not lines:
+            continue
+        cost = len(lines[0]) // CHARS_PER_TOKEN + 1
+        if current and used + cost > token_budget:
+            chunks.append(current)
+            current, used = [], 0
+        current.append(p)
+        used += cost
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def _merge_sources(groups: list[list[dict]]) -> list[dict]:
+    merged = []
+    seen = set()
+    for sources in groups:
+        for s in sources or []:
+            if not isinstance(s, dict):
+                continue
+            key = str(s.get("link", "")).strip() or str(s.get("title", "")).strip()
+            if not key or key in seen:
+                continue
+            seen.add(key)
+            merged.append(s)
+    return merged
+
+
+def _dedupe_items(items: list[dict]) -> list[dict]:
+    """Локальный reduce: склеивает пункты с одинаковым текстом."""
+    result: list[dict] = []
+    by_summary: dict[str, dict] = {}
+    for item in items:
+        summary = " ".join(str(item.get("summary", "")).split())
+        if not summary:
+            continue
+        key = summary.lower()
+        if key in by_summary:
+            existing = by_summary[key]
+            existing["sources"] = _merge_sources([existing["sources"], item.get("sources") or []])
+            continue
+        merged = {"summary": summary, "sources": _merge_sources([item.get("sources") or []])}
+        by_summary[key] = merged
+        result.append(merged)
+    return result
+
+
+def _apply_merge_groups(items: list[dict], groups: list[dict], keep_unmerged: bool = True) -> list[dict]:
+    """Собирает итоговые пункты по группам id; источники берутся из исходных пунктов."""
+    result = []
+    used: set[int] = set()
+    for group in groups:
+        if not isinstance(group, dict):
+            continue
+        ids = []
+        for raw in group.get("ids") or []:
+            try:
+                idx = int(raw)
+            except (TypeError, ValueError):
+                continue
+            if 0 <= idx < len(items) and idx not in used:
+                ids.append(idx)
+        if not ids:
+            continue
+        used.update(ids)
+        summary = " ".join(str(group.get("summary", "")).split()) or items[ids[0]]["summary"]
+        result.append({
+            "summary": summary,
+            "sources": _merge_sources([items[i].get("sources") or [] for i in ids]),
+        })
+    # пункты, которые модель потеряла, не выбрасываем
+    if keep_unmerged:
+        result.extend(item for idx, item in enumerate(items) if idx not in used)
+    return result
+
+
+def _parse_stream_line(line: str) -> list[dict]:
+    cleaned = line.strip().strip(",")
+    if not cleaned or cleaned.startswith("```") or cleaned in ("[", "]"):
+        return []
+    cleaned = cleaned.lstrip("[").rstrip("]").strip()
+    try:
+        data = json.loads(f"[{cleaned}]")
+    except json.JSONDecodeError:
+        return []
+    return [item for item in data if isinstance(item, dict)]
+
+
+class JsonObjectStream:
+    """
+    Достаёт объекты верхнего уровня из JSON-массива, который приходит по
+    частям: каждый объект отдаётся, как только закрылась его скобка.
+    """
+
+    def __init__(self) -> None:
+        # глубина вложенности внутри текущего объекта; 0 — между объектами
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.current: list[str] = []
+
+    def feed(self, text: str) -> list[dict]:
+        items = []
+        for ch in text:
+            if not self.depth:
+                if ch == "{":
+                    self.depth = 1
+                    self.current = [ch]
+                continue
+            self.current.append(ch)
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif ch == "\\":
+                    self.escaped = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"':
+                self.in_string = True
+            elif ch in "{[":
+                self.depth += 1
+            elif ch in "}]":
+                self.depth -= 1
+                if not self.depth:
+                    try:
+                        obj = json.loads("".join(self.current))
+                    except json.JSONDecodeError:
+                        obj = None
+                    if isinstance(obj, dict):
+                        items.append(obj)
+                    self.current = []
+        return items
+
+
+def _channel_key(channel: str) -> str:
+    return (channel or "").lstrip("@").lower()
+
+
+def _group_by_channel(posts: list[dict]) -> dict[str, list[dict]]:
+    groups: dict[str, list[dict]] = {}
+    for p in posts:
+        if _normalize_text(p.get("text", "")):
+            groups.setdefault(_channel_key(p.get("channel", "")), []).append(p)
+    return groups
+
+
+def collapse_by_channel(posts: list[dict]) -> tuple[dict[str, list[dict]], dict[str, list[dict]]]:
+    """
+    Схлопывает дубли по всей ленте, в том числе между каналами, и
+    раскладывает представителей по их каналам.
+    """
+    posts = [p for p in posts if _normalize_text(p.get("text", ""))]
+    representatives, extra_sources = collapse_duplicates(posts)
+    return _group_by_channel(representatives), extra_sources
+
+
+def fragment_key(channel: str, posts: list[dict]) -> str:
+    lines = sorted(_prompt_lines(posts))
+    raw = "\n".join([MISTRAL_MODEL, DIGEST_PROMPT_VERSION, *lines])
+    return f"{FRAGMENT_KEY_PREFIX}{channel}:{hashlib.sha256(raw.encode('utf-8')).hexdigest()}"
+
+
+def split_items_by_channel(items: list[dict], channels: list[str]) -> dict[str, list[dict]]:
+    """Раскладывает пункты куска по каналам первого источника."""
+    result: dict[str, list[dict]] = {ch: [] for ch in channels}
+    for item in items:
+        channel = channels[0]
+        for s in item.get("sources") or []:
+            link = str(s.get("link", "")) if isinstance(s, dict) else ""
+            parts = link.removeprefix("https://t.me/").split("/")
+            if parts and _channel_key(parts[0]) in result:
+                channel = _channel_key(parts[0])
+                break
+        result[channel].append(item)
+    return result
+
+
+async def _load_fragments(keys: dict[str, str]) -> dict[str, list[dict]]:
+    if not keys:
+        return {}
+    try:
+        raw = await get_async_redis().mget(list(keys.values()))
+    except Exception as e:
+        log.warning(f"Digest fragment cache read failed: {e}")
+        return {}
+    fragments = {}
+    for channel, value in zip(keys, raw):
+        if value is None:
+            continue
+        try:
+            fragments[channel] = json.loads(value)
+        except json.JSONDecodeError:
+            continue
+    return fragments
 
+
+async def _store_fragments(fragments: dict[str, tuple[str, list[dict]]]) -> None:
+    if not fragments:
+        return
+    try:
+        async with get_async_redis().pipeline(transaction=False) as pipe:
+            for key, items in fragments.values():
+                pipe.set(key, json.dumps(items, ensure_ascii=False), ex=DIGEST_FRAGMENT_TTL_SEC)
+            await pipe.execute()
+    except Exception as e:
+        log.warning(f"Digest fragment cache write failed: {e}")
+
+
+async def _chat_json(client: httpx.AsyncClient, system: str, user: str) -> list | None:
     payload = {
         "model": MISTRAL_MODEL,
         "temperature": 0.2,
         "messages": [
-            {
-                "role": "system",
-                "content": (
-                    "Сделай краткую сводку на русском. "
-                    "Используй только факты из постов, без выдумок. "
-                    "Если несколько постов про одно и то же событие, объединяй в один пункт "
-                    "и перечисляй все источники. "
-                    "Верни ТОЛЬКО JSON-массив объектов, без пояснений. "
-                    "Используй в источниках TITLE (название канала), не @username. "
-                    "Формат объекта:\n"
-                    "{\n"
-                    "  \"summary\": \"одно предложение\",\n"
-                    "  \"sources\": [\n"
-                    "    {\"title\": \"Название канала\", \"link\": \"https://t.me/channel/123\"}\n"
-                    "  ]\n"
-                    "}\n"
-                    "summary должно быть ОДНИМ предложением."
-                ),
-            },
-            {
-                "role": "user",
-                "content": (
-                    "Сделай сводку по этим постам за последние 12 часов:\n\n"
-                    f"{_build_prompt(posts)}"
-                ),
-            },
+            {"role": "system", "content": system},
+            {"role": "user", "content": user},
         ],
     }
+    url = f"{MISTRAL_BASE_URL}/v1/chat/completions"
+    headers = {"Authorization": f"Bearer {MISTRAL_API_KEY}"}
+    r = await client.post(url, json=payload, headers=headers)
+    r.raise_for_status()
+    content = r.json()["choices"][0]["message"]["content"].strip()
+    items = _extract_json(content)
+    if not isinstance(items, list):
+        log.error(f"Digest JSON parse failed. Raw content: {content[:500]}")
+        return None
+    return items
+
 
+async def _stream_chat_lines(client: httpx.AsyncClient, system: str, user: str) -> AsyncIterator[str]:
+    """Потоковый chat completion: отдаёт ответ модели построчно по мере генерации."""
+    payload = {
+        "model": MISTRAL_MODEL,
+        "temperature": 0.2,
+        "stream": True,
+        "messages": [
+            {"role": "system", "content": system},
+            {"role": "user", "content": user},
+        ],
+    }
     url = f"{MISTRAL_BASE_URL}/v1/chat/completions"
     headers = {"Authorization": f"Bearer {MISTRAL_API_KEY}"}
+    buffer = ""
+    async with client.stream("POST", url, json=payload, headers=headers) as r:
+        r.raise_for_status()
+        async for raw in r.aiter_lines():
+            if not raw.startswith("data:"):
+                continue
+            data = raw[5:].strip()
+            if data == "[DONE]":
+                break
+            try:
+                buffer += json.loads(data)["choices"][0]["delta"].get("content") or ""
+            except (json.JSONDecodeError, KeyError, IndexError, TypeError):
+                continue
+            while "\n" in buffer:
+                line, buffer = buffer.split("\n", 1)
+                if line.strip():
+                    yield line
+    if buffer.strip():
+        yield buffer
+
 
-    async with httpx.AsyncClient(timeout=30) as client:
+async def _summarize_chunk(
+    client: httpx.AsyncClient,
+    sem: asyncio.Semaphore,
+    posts: list[dict],
+    on_item: Callable[[dict], Awaitable[None]] | None = None,
+) -> list[dict] | None:
+    """С on_item ответ читается потоком и каждый готовый пункт отдаётся сразу."""
+    prompt = (
+        f"Сделай сводку по этим постам за последние {DIGEST_HOURS} часов:\n\n"
+        + "\n".join(_prompt_lines(posts))
+    )
+    async with sem:
         try:
-            r = await client.post(url, json=payload, headers=headers)
-            r.raise_for_status()
-            data = r.json()
-            content = data["choices"][0]["message"]["content"].strip()
-            items = _extract_json(content)
-            if not items:
-                log.error(f"Digest JSON parse failed. Raw content: {content[:500]}")
-                return "Сводка не сформировалась (ошибка формата). Попробуй еще раз."
-            return _format_digest(items)
+            if on_item is None:
+                items = await _chat_json(client, MAP_SYSTEM_PROMPT, prompt)
+            else:
+                items = []
+                parser = JsonObjectStream()
+                async for line in _stream_chat_lines(client, MAP_SYSTEM_PROMPT, prompt):
+                    for item in parser.feed(line + "\n"):
+                        items.append(item)
+                        await on_item(item)
+                items = items or None
         except Exception as e:
-            log.exception(f"Digest generation failed: {e}")
-            return "Не удалось сгенерировать сводку. Попробуй позже."
+            log.warning(f"Digest chunk failed: {e}")
+            return None
+    if items is None:
+        return None
+    return [item for item in items if isinstance(item, dict)]
+
+
+async def _reduce_items(
+    client: httpx.AsyncClient,
+    items: list[dict],
+    on_progress: ProgressCallback | None = None,
+    extra_sources: dict[str, list[dict]] | None = None,
+) -> list[dict]:
+    items = _dedupe_items(items)
+    if len(items) < 2:
+        return items
+    numbered = [{"id": idx, "summary": item["summary"]} for idx, item in enumerate(items)]
+    groups: list[dict] = []
+    try:
+        async for line in _stream_chat_lines(client, REDUCE_SYSTEM_PROMPT, json.dumps(numbered, ensure_ascii=False)):
+            parsed = _parse_stream_line(line)
+            if not parsed:
+                continue
+            groups.extend(parsed)
+            if on_progress:
+                merged = _apply_merge_groups(items, groups, keep_unmerged=False)
+                await on_progress(_format_digest(_expand_sources(merged, extra_sources or {})) + "\n…")
+    except Exception as e:
+        log.warning(f"Digest merge failed, using unmerged items: {e}")
+    if not groups:
+        return items
+    return _apply_merge_groups(items, groups)
+
+
+async def _build_fragments(
+    client: httpx.AsyncClient,
+    by_channel: dict[str, list[dict]],
+    on_progress: ProgressCallback | None = None,
+    extra_sources: dict[str, list[dict]] | None = None,
+) -> dict[str, list[dict]] | None:
+    """С on_progress пункты показываются по мере генерации (сводка по одному каналу, где нет reduce)."""
+    keys = {ch: fragment_key(ch, ch_posts) for ch, ch_posts in by_channel.items()}
+    fragments = await _load_fragments(keys)
+    missing = [ch for ch in by_channel if ch not in fragments]
+    if missing:
+        log.info(f"Digest: {len(fragments)} channel fragments cached, {len(missing)} to build")
+        on_item = None
+        if on_progress:
+            streamed: list[dict] = []
+
+            async def on_item(item: dict) -> None:
+                streamed.append(item)
+                await on_progress(_format_digest(_expand_sources(streamed, extra_sources or {})) + "\n…")
+
+        chunks = _chunk_posts([p for ch in missing for p in by_channel[ch]], DIGEST_CHUNK_TOKEN_BUDGET)
+        sem = asyncio.Semaphore(DIGEST_CONCURRENCY)
+        partial = await asyncio.gather(*(_summarize_chunk(client, sem, chunk, on_item) for chunk in chunks))
+        if all(items is None for items in partial):
+            return None
+        built: dict[str, list[dict]] = {}
+        failed: set[str] = set()
+        for chunk, items in zip(chunks, partial):
+            channels = list(dict.fromkeys(_channel_key(p.get("channel", "")) for p in chunk))
+            if items is None:
+                failed.update(channels)
+                continue
+            for ch, ch_items in split_items_by_channel(items, channels).items():
+                built.setdefault(ch, []).extend(ch_items)
+        # канал, часть которого не сжалась, не кэшируем — иначе фрагмент будет неполным
+        await _store_fragments({ch: (keys[ch], items) for ch, items in built.items() if ch not in failed})
+        fragments.update(built)
+    return fragments
+
+
+class DigestError(Exception):
+    """Сводка не получилась; текст исключения можно показать пользователю."""
+
+
+async def generate_digest(posts: list[dict], on_progress: ProgressCallback | None = None) -> str:
+    """
+    on_progress получает промежуточный текст сводки (HTML) по мере готовности:
+    по каждому пункту сжатия (один канал) или потокового слияния (несколько).
+    При неудаче бросает DigestError — такой результат нельзя кэшировать.
+    """
+    if not MISTRAL_API_KEY:
+        raise DigestError("Ключ MISTRAL_API_KEY не задан. Добавь его в .env.")
+
+    by_channel, extra_sources = collapse_by_channel(posts)
+    kept = sum(len(ch_posts) for ch_posts in by_channel.values())
+    if kept < len(posts):
+        log.info(f"Digest: collapsed {len(posts)} posts into {kept} clusters")
+    if not by_channel:
+        raise DigestError("Сводка не сформировалась (ошибка формата). Попробуй еще раз.")
+
+    async with httpx.AsyncClient(timeout=DIGEST_TIMEOUT_SEC) as client:
+        single = len(by_channel) == 1
+        fragments = await _build_fragments(
+            client, by_channel, on_progress if single else None, extra_sources
+        )
+        if fragments is None:
+            raise DigestError("Не удалось сгенерировать сводку. Попробуй позже.")
+        items = [item for ch in by_channel for item in fragments.get(ch, [])]
+        # персональная часть — только лёгкое слияние пунктов разных каналов
+        if not single:
+            if on_progress:
+                await on_progress(f"Собираю сводку: {len(items)} пунктов из {len(by_channel)} каналов... 📝")
+            items = await _reduce_items(client, items, on_progress, extra_sources)
+        if not items:
+            raise DigestError("Сводка не сформировалась (ошибка формата). Попробуй еще раз.")
+        return _format_digest(_expand_sources(items, extra_sources))
@@ -0,0 +1,160 @@
+import asyncio
+import logging
+import os
+import time
+import uuid
+from dataclasses import dataclass, field
+
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import Message
+
+from bot.api_client import get_digest_candidates
+from bot.composer import MESSAGE_LIMIT, split_html, visible_len
+from bot.digest import (
+    DIGEST_CHAR_BUDGET,
+    DIGEST_HOURS,
+    DIGEST_MAX_POSTS,
+    DIGEST_PER_CHANNEL,
+    DigestError,
+    generate_digest,
+)
+
+log = logging.getLogger(__name__)
+
+# Сводка готовится в фоне: обработчик команды только создаёт задачу.
+# Повторный /digest в течение окна получает ту же задачу (или её готовый
+# результат), а не новый вызов LLM.
+DIGEST_REPEAT_WINDOW_SEC = int(os.getenv("DIGEST_REPEAT_WINDOW_SEC", "300"))
+# Telegram плохо переносит частые правки одного сообщения
+EDIT_INTERVAL_SEC = 1.5
+
+
+def split_message(text: str, limit: int = MESSAGE_LIMIT) -> list[str]:
+    """
+    Режет HTML сводки по строкам на части не длиннее limit видимых UTF-16
+    единиц; слишком длинная строка режется split_html, не разрывая теги.
+    """
+    parts: list[str] = []
+    current = ""
+    for line in text.split("\n"):
+        pieces = split_html(line, limit) if visible_len(line) > limit else [line]
+        for piece in pieces:
+            candidate = f"{current}\n{piece}" if current else piece
+            if current and visible_len(candidate) > limit:
+                parts.append(current)
+                current = piece
+            else:
+                current = candidate
+    if current:
+        parts.append(current)
+    return parts or [""]
+
+
+@dataclass
+class DigestJob:
+    job_id: str
+    tg_user_id: int
+    messages: list[Message] = field(default_factory=list)
+    task: asyncio.Task | None = None
+    result: str | None = None
+    finished_at: float = 0.0
+    last_text: str = ""
+    last_edit_at: float = 0.0
+
+    @property
+    def done(self) -> bool:
+        return self.result is not None
+
+    async def _edit(self, message: Message, text: str) -> None:
+        try:
+            await message.edit_text(text, parse_mode="HTML", disable_web_page_preview=True)
+        except TelegramBadRequest as e:
+            if "message is not modified" not in str(e).lower():
+                log.warning(f"Digest job {self.job_id}: edit failed: {e}")
+        except TelegramRetryAfter as e:
+            log.warning(f"Digest job {self.job_id}: edit throttled for {e.retry_after}s")
+
+    async def progress(self, text: str) -> None:
+        now = time.monotonic()
+        if now - self.last_edit_at < EDIT_INTERVAL_SEC:
+            return
+        self.last_edit_at = now
+        self.last_text = split_message(text)[0]
+        for message in list(self.messages):
+            await self._edit(message, self.last_text)
+
+    async def deliver(self, message: Message) -> None:
+        parts = split_message(self.result or "")
+        await self._edit(message, parts[0])
+        for part in parts[1:]:
+            await message.answer(part, parse_mode="HTML", disable_web_page_preview=True)
+
+
+class DigestJobs:
+    def __init__(self, repeat_window_sec: int = DIGEST_REPEAT_WINDOW_SEC) -> None:
+        self.repeat_window_sec = repeat_window_sec
+        self._jobs: dict[int, DigestJob] = {}
+
+    def _expire(self) -> None:
+        now = time.monotonic()
+        for user_id, job in list(self._jobs.items()):
+            if job.done and now - job.finished_at > self.repeat_window_sec:
+                del self._jobs[user_id]
+
+    def current(self, tg_user_id: int) -> DigestJob | None:
+        self._expire()
+        return self._jobs.get(tg_user_id)
+
+    async def submit(self, tg_user_id: int, placeholder: Message) -> DigestJob:
+        """
+        Привязывает сообщение-заглушку к задаче пользователя: готовый результат
+        из окна повтора отдаётся сразу, идущая задача дополнительно обновляет
+        новую заглушку, иначе запускается новая задача.
+        """
+        job = self.current(tg_user_id)
+        if job and job.done:
+            log.info(f"Digest job {job.job_id}: served from cache for {tg_user_id}")
+            await job.deliver(placeholder)
+            return job
+        if job:
+            log.info(f"Digest job {job.job_id}: joined by repeat request from {tg_user_id}")
+            job.messages.append(placeholder)
+            if job.last_text:
+                await job._edit(placeholder, job.last_text)
+            return job
+
+        job = DigestJob(job_id=uuid.uuid4().hex[:12], tg_user_id=tg_user_id, messages=[placeholder])
+        self._jobs[tg_user_id] = job
+        job.task = asyncio.create_task(self._run(job))
+        return job
+
+    async def _run(self, job: DigestJob) -> None:
+        started = time.monotonic()
+        try:
+            recent = await get_digest_candidates(
+                job.tg_user_id,
+                hours=DIGEST_HOURS,
+                per_channel=DIGEST_PER_CHANNEL,
+                char_budget=DIGEST_CHAR_BUDGET,
+                limit=DIGEST_MAX_POSTS,
+            )
+            if not recent:
+                job.result = f"За последние {DIGEST_HOURS} часов нет постов для сводки."
+            else:
+                job.result = await generate_digest(recent, on_progress=job.progress)
+        except Exception as e:
+            if isinstance(e, DigestError):
+                log.warning(f"Digest job {job.job_id} failed: {e}")
+                job.result = str(e)
+            else:
+                log.exception(f"Digest job {job.job_id} failed: {e}")
+                job.result = "Не удалось сгенерировать сводку. Попробуй позже."
+            # ошибку не кэшируем: следующий /digest начнёт заново
+            self._jobs.pop(job.tg_user_id, None)
+        job.finished_at = time.monotonic()
+        log.info(f"Digest job {job.job_id} finished in {time.monotonic() - started:.1f}s")
+        for message in job.messages:
+            try:
+                await job.deliver(message)
+            except Exception as e:
+                log.warning(f"Digest job {job.job_id}: delivery failed: {e}")
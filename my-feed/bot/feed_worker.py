@@ -1,164 +1,424 @@
 import asyncio
 import os
 import logging
+from datetime import datetime, timezone
+from html import escape
 from pathlib import Path
-from bot.api_client import get_unsent_posts, mark_posts_sent, get_short_feed, get_broadcast_targets
-from bot.short_feed import summarize_to_one_sentence
+from bot.api_client import (
+    get_broadcast_targets,
+    get_unsent_posts,
+    mark_posts_sent,
+    report_delivery_failure,
+    wait_pending_users,
+)
+from bot.user_settings import load_settings
+from bot.composer import MESSAGE_LIMIT, build_source_line, compose_post, visible_len
+from common.extractive import summarize_extractive
+from common.llm_health import llm_degraded
+from common.notify import listen_new_posts
+from common.shard_leases import ShardLeases
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramEntityTooLarge,
+    TelegramForbiddenError,
+    TelegramNotFound,
+    TelegramRetryAfter,
+)
 from aiogram.types import FSInputFile, InputMediaDocument, InputMediaPhoto, InputMediaVideo
-from worker.tasks import summarize_text as summarize_text_task
 
 log = logging.getLogger(__name__)
 
 OWNER_TG_USER_ID = int(os.getenv("OWNER_TG_USER_ID", "0"))
-TARGET_GROUP = os.getenv("BROADCAST_GROUP", "all")
-INTERVAL = int(os.getenv("FEED_INTERVAL_SEC", "5"))
+# Страховочный обход — только по пользователям с включённой пересылкой
+TARGET_GROUP = os.getenv("BROADCAST_GROUP", "forwarding")
+# Доставка просыпается по уведомлениям о новых постах; полный обход всех
+# пользователей остаётся только страховкой на случай потерянных уведомлений.
+SAFETY_POLL_SEC = int(os.getenv("FEED_SAFETY_POLL_SEC", "60"))
+# redis — подписка на канал уведомлений, api — long-poll GET /posts/stream
+WAKE_SOURCE = os.getenv("FEED_WAKE_SOURCE", "redis")
+STREAM_TIMEOUT_SEC = float(os.getenv("FEED_STREAM_TIMEOUT_SEC", "25"))
+# Сколько пост может ждать сжатия из конвейера приёма, прежде чем уйти с
+# локальным сжатием; отсчёт — от приёма поста API, а не от публикации в канале
+SUMMARY_WAIT_SEC = int(os.getenv("FEED_SUMMARY_WAIT_SEC", "90"))
+BATCH_LIMIT = 10
+# В режиме склейки за проход берётся больше постов, чтобы серия ушла одним сообщением
+BUNDLE_BATCH_LIMIT = 50
+BUNDLE_SEPARATOR = "\n\n———\n\n"
 
-def build_source_line(p: dict) -> str:
-    channel = (p.get("channel") or "").lstrip("@")
-    channel_title = (p.get("channel_title") or "").strip()
-    msg_id = p.get("tg_message_id")
-    source_url = f"https://t.me/{channel}/{msg_id}" if channel and msg_id else None
-    source_name = channel_title or channel
-    if source_url:
-        return f'<b>Источник:</b> <a href="{source_url}">{source_name}</a>'
-    return f"<b>Источник:</b> {source_name}"
 
+class FeedWakeup:
+    def __init__(self, safety_poll_sec: float = SAFETY_POLL_SEC):
+        self.safety_poll_sec = safety_poll_sec
+        self.pending: set[int] = set()
+        self.full_pass = True
+        self.next_full_pass = 0.0
+        self.event = asyncio.Event()
 
-async def feed_loop(bot):
-    if OWNER_TG_USER_ID == 0:
-        raise RuntimeError("OWNER_TG_USER_ID is not set")
+    def notify(self, tg_user_ids) -> None:
+        self.pending.update(tg_user_ids)
+        self.event.set()
 
-    while True:
+    def request_full_pass(self) -> None:
+        self.full_pass = True
+        self.event.set()
+
+    def take(self) -> tuple[set[int], bool]:
+        now = asyncio.get_running_loop().time()
+        full_pass = self.full_pass or now >= self.next_full_pass
+        if full_pass:
+            self.next_full_pass = now + self.safety_poll_sec
+        pending = self.pending
+        self.pending = set()
+        self.full_pass = False
+        self.event.clear()
+        return pending, full_pass
+
+    async def wait(self) -> None:
+        timeout = max(0.0, self.next_full_pass - asyncio.get_running_loop().time())
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+def _summary_pending(p: dict) -> bool:
+    try:
+        ingested = datetime.fromisoformat(p.get("created_at") or "")
+    except ValueError:
+        return False
+    if ingested.tzinfo is None:
+        ingested = ingested.replace(tzinfo=timezone.utc)
+    age = (datetime.now(timezone.utc) - ingested).total_seconds()
+    return age < SUMMARY_WAIT_SEC
+
+
+def short_feed_bodies(posts: list[dict], defer_pending: bool = True) -> list[str]:
+    """
+    Тексты для краткой ленты берутся из сжатий, посчитанных при приёме поста.
+    Доставка никогда не ждёт LLM: если сжатие ещё не готово, пост и всё после
+    него откладываются до уведомления о готовом сжатии, а слишком старые посты
+    (или все, пока LLM недоступна) сжимаются локально.
+    """
+    bodies = []
+    for p in posts:
+        text_body = p.get("text", "")
+        if p.get("summary") or not text_body:
+            bodies.append(p.get("summary") or "")
+        elif defer_pending and _summary_pending(p):
+            break
+        else:
+            bodies.append(summarize_extractive(text_body))
+    return bodies
+
+
+async def send_post(bot, tg_user_id: int, p: dict, text_body: str) -> Exception | None:
+    """
+    Пост считается доставленным, как только ушла первая часть (медиа или
+    первое сообщение): ошибку продолжения только возвращаем, иначе повтор
+    отправил бы уже доставленные части ещё раз.
+    """
+    media_type = p.get("media_type")
+    media_paths = p.get("media_paths") or []
+    files = [Path(path) for path in media_paths if path]
+    files = [f for f in files if f.exists()]
+    composed = compose_post(p, text_body, with_media=bool(files))
+
+    if media_type == "media_group" and files:
+        media = []
+        for idx, f in enumerate(files):
+            suffix = f.suffix.lower()
+            if suffix in VIDEO_EXTS:
+                item = InputMediaVideo(media=FSInputFile(f))
+            elif suffix in IMAGE_EXTS:
+                item = InputMediaPhoto(media=FSInputFile(f))
+            else:
+                item = InputMediaDocument(media=FSInputFile(f))
+            if idx == 0:
+                item.caption = composed.caption
+                item.parse_mode = "HTML"
+            media.append(item)
+        await bot.send_media_group(tg_user_id, media)
+    elif media_type == "voice" and files:
+        await bot.send_voice(
+            tg_user_id,
+            voice=FSInputFile(files[0]),
+            caption=composed.caption,
+            parse_mode="HTML",
+        )
+    elif media_type == "video" and files:
+        if files[0].suffix.lower() in VIDEO_EXTS:
+            await bot.send_video(
+                tg_user_id,
+                video=FSInputFile(files[0]),
+                caption=composed.caption,
+                parse_mode="HTML",
+            )
+        else:
+            await bot.send_document(
+                tg_user_id,
+                document=FSInputFile(files[0]),
+                caption=composed.caption,
+                parse_mode="HTML",
+            )
+    elif files:
+        if files[0].suffix.lower() in IMAGE_EXTS:
+            await bot.send_photo(
+                tg_user_id,
+                photo=FSInputFile(files[0]),
+                caption=composed.caption,
+                parse_mode="HTML",
+            )
+        else:
+            await bot.send_document(
+                tg_user_id,
+                document=FSInputFile(files[0]),
+                caption=composed.caption,
+                parse_mode="HTML",
+            )
+
+    # текст, не поместившийся в подпись, и обычные текстовые посты
+    for idx, text in enumerate(composed.messages):
+        try:
+            await bot.send_message(
+                tg_user_id,
+                text,
+                parse_mode="HTML",
+                disable_web_page_preview=True,
+            )
+        except Exception as e:
+            if idx == 0 and not files:
+                raise
+            log.warning(f"Post {p.get('id')} to {tg_user_id}: follow-up part {idx + 1} not delivered: {e}")
+            return e
+    return None
+
+
+def classify_delivery_error(e: Exception) -> str:
+    """
+    blocked — пользователь недоступен (бот заблокирован, чат удалён);
+    permanent — Telegram отвергает само сообщение, повтор не поможет;
+    transient — сеть, сервер Telegram, flood control и всё неизвестное.
+    """
+    if isinstance(e, (TelegramForbiddenError, TelegramNotFound)):
+        return "blocked"
+    if isinstance(e, (TelegramBadRequest, TelegramEntityTooLarge)):
+        return "permanent"
+    return "transient"
+
+
+def _stops_user(e: Exception) -> bool:
+    # дальше по этому пользователю сейчас отправлять бессмысленно
+    return classify_delivery_error(e) == "blocked" or isinstance(e, TelegramRetryAfter)
+
+
+def bundle_entry(p: dict, text_body: str) -> str:
+    source_line = build_source_line(p)
+    return f"{source_line}\n\n{escape(text_body)}" if text_body else source_line
+
+
+def bundle_posts(posts: list[dict], bodies: list[str], mode: str, limit: int = MESSAGE_LIMIT) -> list[list[int]]:
+    """
+    Группы индексов постов для отправки одним сообщением. Склеиваются только
+    идущие подряд текстовые посты (в режиме channel — ещё и одного канала),
+    пока сообщение укладывается в limit; порядок ленты не меняется.
+    """
+    groups: list[list[int]] = []
+    current: list[int] = []
+    current_len = 0
+    current_key = None
+    for idx, (p, text_body) in enumerate(zip(posts, bodies)):
+        entry_len = visible_len(bundle_entry(p, text_body))
+        if mode == "off" or p.get("media_paths"):
+            key = None
+        else:
+            key = p.get("channel") if mode == "channel" else ""
+        fits = current_len + visible_len(BUNDLE_SEPARATOR) + entry_len <= limit
+        if current and key is not None and key == current_key and fits:
+            current.append(idx)
+            current_len += visible_len(BUNDLE_SEPARATOR) + entry_len
+            continue
+        if current:
+            groups.append(current)
+        current, current_len, current_key = [idx], entry_len, key
+    if current:
+        groups.append(current)
+    return groups
+
+
+async def deliver_user_posts(bot, tg_user_id: int) -> int:
+    settings = await load_settings(tg_user_id)
+    short_feed_on = settings.get("short_feed", False)
+    bundle_mode = settings.get("bundle_mode", "off")
+    posts = await get_unsent_posts(tg_user_id, limit=BUNDLE_BATCH_LIMIT if bundle_mode != "off" else BATCH_LIMIT)
+
+    if not posts:
+        return 0
+
+    engine = settings.get("short_feed_engine", "llm") if short_feed_on else None
+    if engine == "local":
+        bodies = [summarize_extractive(p.get("text", "")) for p in posts]
+    elif short_feed_on:
+        # готовое сжатие API присылает повторным уведомлением — здесь не ждём
+        bodies = short_feed_bodies(posts, defer_pending=not await llm_degraded())
+    else:
+        bodies = [p.get("text", "") for p in posts]
+
+    sent_ids = []
+    for group in bundle_posts(posts[: len(bodies)], bodies, bundle_mode):
+        ids = [posts[i]["id"] for i in group]
         try:
+            partial_error = None
+            if len(group) == 1:
+                partial_error = await send_post(bot, tg_user_id, posts[group[0]], bodies[group[0]])
+            else:
+                await bot.send_message(
+                    tg_user_id,
+                    BUNDLE_SEPARATOR.join(bundle_entry(posts[i], bodies[i]) for i in group),
+                    parse_mode="HTML",
+                    disable_web_page_preview=True,
+                )
+            sent_ids.extend(ids)
+            if partial_error is not None and _stops_user(partial_error):
+                break
+        except Exception as e:
+            kind = classify_delivery_error(e)
+            log.warning(f"Failed to deliver posts {ids} to {tg_user_id} ({kind}): {e}")
             try:
-                targets = await get_broadcast_targets(OWNER_TG_USER_ID, group=TARGET_GROUP)
-            except Exception as e:
-                log.exception(f"Failed to load broadcast targets: {e}")
-                targets = []
+                await report_delivery_failure(
+                    tg_user_id, ids, kind, str(e), retry_after=getattr(e, "retry_after", None)
+                )
+            except Exception as report_error:
+                log.warning(f"Failed to report delivery failure for {tg_user_id}: {report_error}")
+            if _stops_user(e):
+                break
+
+    if sent_ids:
+        await mark_posts_sent(sent_ids)
+        log.info(f"Sent {len(sent_ids)} posts to {tg_user_id}")
+    return len(sent_ids)
+
 
-            if not targets:
-                await asyncio.sleep(INTERVAL)
+async def _watch_new_posts(wakeup: FeedWakeup) -> None:
+    async for user_ids in listen_new_posts():
+        wakeup.notify(user_ids)
+
+
+async def _poll_stream(wakeup: FeedWakeup, leases: ShardLeases | None = None) -> None:
+    """
+    Long-poll уведомлений. С leases поток фильтруется по арендованным шардам;
+    при смене аренд текущий запрос прерывается и подписка пересобирается.
+    """
+    since = None
+    epoch = None
+    while True:
+        shards = None
+        if leases:
+            leases.changed.clear()
+            shards = sorted(leases.owned)
+            if not shards:
+                # пока шардов нет, чужие уведомления не нужны
+                await leases.changed.wait()
                 continue
+        request = asyncio.create_task(wait_pending_users(
+            since=since,
+            epoch=epoch,
+            shards=shards,
+            shard_count=leases.shards if leases else None,
+            timeout=STREAM_TIMEOUT_SEC,
+        ))
+        waiters = {request}
+        if leases:
+            waiters.add(asyncio.create_task(leases.changed.wait()))
+        try:
+            done, _ = await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in waiters:
+                if not task.done():
+                    task.cancel()
+        if request not in done:
+            continue
+        try:
+            res = request.result()
+        except Exception as e:
+            log.warning(f"Pending posts stream failed: {e}")
+            await asyncio.sleep(5)
+            continue
+        if res.get("resync"):
+            wakeup.request_full_pass()
+        if res.get("users"):
+            wakeup.notify(res["users"])
+        since = res.get("cursor")
+        epoch = res.get("epoch")
 
-            for tg_user_id in targets:
-                try:
-                    short_feed_on = await get_short_feed(tg_user_id)
-                    posts = await get_unsent_posts(tg_user_id, limit=10)
 
-                    if not posts:
+async def feed_loop(bot, leases: ShardLeases | None = None):
+    """
+    Цикл доставки. Без leases обслуживает всех пользователей; с leases —
+    только пользователей из шардов, арендованных этим процессом.
+    """
+    if OWNER_TG_USER_ID == 0:
+        raise RuntimeError("OWNER_TG_USER_ID is not set")
+
+    wakeup = FeedWakeup()
+    if WAKE_SOURCE == "api":
+        watch = _poll_stream(wakeup, leases)
+    else:
+        watch = _watch_new_posts(wakeup)
+    background = [asyncio.create_task(watch)]
+    if leases:
+        # новые шарды могли накопить посты, пока были ничьими
+        background.append(asyncio.create_task(leases.run(on_gain=wakeup.request_full_pass)))
+    owns_user = leases.owns_user if leases else (lambda tg_user_id: True)
+
+    try:
+        while True:
+            try:
+                targets, full_pass = wakeup.take()
+                if full_pass:
+                    try:
+                        targets.update(await get_broadcast_targets(OWNER_TG_USER_ID, group=TARGET_GROUP))
+                    except Exception as e:
+                        log.exception(f"Failed to load broadcast targets: {e}")
+
+                for tg_user_id in targets:
+                    if not owns_user(tg_user_id):
                         continue
+                    try:
+                        delivered = await deliver_user_posts(bot, tg_user_id)
+                        if delivered >= BATCH_LIMIT:
+                            # у пользователя остались посты — добираем следующим проходом без ожидания
+                            wakeup.notify([tg_user_id])
+                    except Exception as e:
+                        log.exception(f"feed_loop error for user {tg_user_id}: {e}")
 
-                    sent_ids = []
-                    for p in posts:
-                        try:
-                            text_body = p.get("text", "")
-                            if short_feed_on:
-                                try:
-                                    async_result = summarize_text_task.delay(text_body)
-                                    text_body = await asyncio.to_thread(async_result.get, timeout=10)
-                                except Exception:
-                                    text_body = await summarize_to_one_sentence(text_body)
-                            source_line = build_source_line(p)
-                            media_type = p.get("media_type")
-                            media_paths = p.get("media_paths") or []
-
-                            if media_paths:
-                                files = [Path(path) for path in media_paths if path]
-                                files = [f for f in files if f.exists()]
-                                if media_type == "media_group" and files:
-                                    media = []
-                                    for idx, f in enumerate(files):
-                                        suffix = f.suffix.lower()
-                                        if suffix in VIDEO_EXTS:
-                                            item = InputMediaVideo(media=FSInputFile(f))
-                                        elif suffix in IMAGE_EXTS:
-                                            item = InputMediaPhoto(media=FSInputFile(f))
-                                        else:
-                                            item = InputMediaDocument(media=FSInputFile(f))
-                                        if idx == 0:
-                                            caption = source_line
-                                            if text_body:
-                                                caption = f"{source_line}\n\n{text_body}"
-                                            item.caption = caption
-                                            item.parse_mode = "HTML"
-                                        media.append(item)
-                                    await bot.send_media_group(tg_user_id, media)
-                                elif media_type == "voice" and files:
-                                    caption = source_line
-                                    if text_body:
-                                        caption = f"{source_line}\n\n{text_body}"
-                                    await bot.send_voice(
-                                        tg_user_id,
-                                        voice=FSInputFile(files[0]),
-                                        caption=caption,
-                                        parse_mode="HTML",
-                                    )
-                                elif media_type == "video" and files:
-                                    caption = source_line
-                                    if text_body:
-                                        caption = f"{source_line}\n\n{text_body}"
-                                    if files[0].suffix.lower() in VIDEO_EXTS:
-                                        await bot.send_video(
-                                            tg_user_id,
-                                            video=FSInputFile(files[0]),
-                                            caption=caption,
-                                            parse_mode="HTML",
-                                        )
-                                    else:
-                                        await bot.send_document(
-                                            tg_user_id,
-                                            document=FSInputFile(files[0]),
-                                            caption=caption,
-                                            parse_mode="HTML",
-                                        )
-                                elif files:
-                                    caption = source_line
-                                    if text_body:
-                                        caption = f"{source_line}\n\n{text_body}"
-                                    if files[0].suffix.lower() in IMAGE_EXTS:
-                                        await bot.send_photo(
-                                            tg_user_id,
-                                            photo=FSInputFile(files[0]),
-                                            caption=caption,
-                                            parse_mode="HTML",
-                                        )
-                                    else:
-                                        await bot.send_document(
-                                            tg_user_id,
-                                            document=FSInputFile(files[0]),
-                                            caption=caption,
-                                            parse_mode="HTML",
-                                        )
-                                else:
-                                    text = f"{source_line}\n\n{text_body}" if text_body else source_line
-                                    await bot.send_message(
-                                        tg_user_id,
-                                        text,
-                                        parse_mode="HTML",
-                                        disable_web_page_preview=True,
-                                    )
-                            else:
-                                text = f"{source_line}\n\n{text_body}" if text_body else source_line
-                                await bot.send_message(
-                                    tg_user_id,
-                                    text,
-                                    parse_mode="HTML",
-                                    disable_web_page_preview=True,
-                                )
-                            sent_ids.append(p["id"])
-                        except Exception as e:
-                            log.exception(f"Failed to deliver post {p.get('id')} to {tg_user_id}: {e}")
-
-                    if sent_ids:
-                        await mark_posts_sent(sent_ids)
-                        log.info(f"Sent {len(sent_ids)} posts to {tg_user_id}")
-
-                except Exception as e:
-                    log.exception(f"feed_loop error for user {tg_user_id}: {e}")
+            except Exception as e:
+                log.exception(f"feed_loop error: {e}")
+
+            await wakeup.wait()
+    finally:
+        for task in background:
+            task.cancel()
+
+
+async def main():
+    logging.basicConfig(level=logging.INFO)
+    token = os.getenv("BOT_TOKEN")
+    if not token:
+        raise RuntimeError("BOT_TOKEN is not set in .env")
+    bot = Bot(token=token)
+    leases = ShardLeases()
+    log.info(f"Feed worker {leases.worker_id} started")
+    try:
+        await feed_loop(bot, leases)
+    finally:
+        await leases.release_all()
+        await bot.session.close()
 
-        except Exception as e:
-            log.exception(f"feed_loop error: {e}")
 
-        await asyncio.sleep(INTERVAL)
 IMAGE_EXTS = {".jpg", ".jpeg", ".png", ".webp"}
 VIDEO_EXTS = {".mp4", ".mov", ".mkv"}
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -3,11 +3,6 @@ import logging
 import os
 import uuid
 
-import httpx
-import qrcode
-import time
-from datetime import datetime, timezone
-from io import BytesIO
 from aiogram import Bot, Dispatcher, F
 from aiogram.exceptions import TelegramBadRequest, TelegramNetworkError
 from aiogram.filters import Command
@@ -22,24 +17,16 @@ from aiogram.types import (
     PreCheckoutQuery,
 )
 from bot.api_client import (
-    add_channel,
-    delete_all_channels,
-    delete_channel,
+    create_payment_intent,
     get_forwarding,
-    get_latest_posts,
-    get_vip_status,
-    get_short_feed,
-    get_spam_filter,
+    get_payment_intent,
     first_start,
-    list_channels,
-    extend_vip,
     upsert_user_profile,
     set_forwarding,
-    set_short_feed,
-    set_spam_filter,
 )
-from bot.digest import select_recent_posts, generate_digest
-from bot.feed_worker import feed_loop
+from bot.cache import TTLCache
+from bot.channel_cache import add_channel, delete_all_channels, delete_channel, get_channels
+from bot.digest_jobs import DigestJobs
 from bot.keyboards.delete import build_delete_kb, DelCb
 from bot.keyboards.subscriptions import build_subscriptions_kb
 from bot.keyboards.vip import (
@@ -50,103 +37,24 @@ from bot.keyboards.vip import (
     get_tariff,
 )
 from bot.parsers import extract_channels
+from bot import yookassa
+from bot.user_settings import invalidate_settings, load_settings, toggle_setting
+from bot.payments import (
+    credit_payment,
+    format_vip_until,
+    payment_success_text,
+    plan_days,
+    render_qr_png,
+)
 from bot.admin_commands import register_admin_commands
 
 OWNER_TG_USER_ID = int(os.getenv("OWNER_TG_USER_ID", "0"))
-STARS_POLL_INTERVAL_SEC = int(os.getenv("STARS_POLL_INTERVAL_SEC", "20"))
-
-
-class YkBadRequestError(Exception):
-    pass
-
-
-async def yk_create_payment(
-    user_id: int,
-    plan: str,
-    confirmation_type: str = "redirect",
-    payment_method_data: dict | None = None,
-) -> tuple[str, dict]:
-    shop_id = os.getenv("YOOKASSA_SHOP_ID")
-    secret_key = os.getenv("YOOKASSA_SECRET_KEY")
-    tax_system_code = int(os.getenv("YOOKASSA_TAX_SYSTEM_CODE", "1"))
-    if not shop_id or not secret_key:
-        raise RuntimeError("YOOKASSA_SHOP_ID/YOOKASSA_SECRET_KEY are not set in .env")
-    receipt_email = os.getenv("YOOKASSA_RECEIPT_EMAIL") or f"user{user_id}@example.com"
-
-    tariff = get_tariff(plan)
-    amount_value = f"{tariff['price']:.2f}"
-    return_url = os.getenv("YOOKASSA_RETURN_URL", "https://t.me")
-    idempotence_key = str(uuid.uuid4())
-
-    confirmation = {"type": confirmation_type, "return_url": return_url}
-    payload = {
-        "amount": {"value": amount_value, "currency": "RUB"},
-        "confirmation": confirmation,
-        "capture": True,
-        "description": f"VIP на {tariff['title']}",
-        "metadata": {"user_id": user_id, "plan": plan},
-        "receipt": {
-            "customer": {"email": receipt_email},
-            "tax_system_code": tax_system_code,
-            "items": [
-                {
-                    "description": f"VIP на {tariff['title']}",
-                    "quantity": "1.00",
-                    "amount": {"value": amount_value, "currency": "RUB"},
-                    "vat_code": 1,
-                    "payment_subject": "service",
-                    "payment_mode": "full_prepayment",
-                }
-            ],
-        },
-    }
-    if payment_method_data:
-        payload["payment_method_data"] = payment_method_data
-
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        try:
-            resp = await client.post(
-                "https://api.yookassa.ru/v3/payments",
-                auth=(shop_id, secret_key),
-                headers={"Idempotence-Key": idempotence_key},
-                json=payload,
-            )
-            resp.raise_for_status()
-        except httpx.HTTPStatusError as e:
-            detail = e.response.text.strip()
-            if e.response.status_code == 400:
-                raise YkBadRequestError(detail) from e
-            raise RuntimeError(f"YooKassa error: {detail}") from e
-        data = resp.json()
-        return data["id"], data["confirmation"]
-
-
-async def yk_check_payment(payment_id: str) -> str:
-    shop_id = os.getenv("YOOKASSA_SHOP_ID")
-    secret_key = os.getenv("YOOKASSA_SECRET_KEY")
-    if not shop_id or not secret_key:
-        raise RuntimeError("YOOKASSA_SHOP_ID/YOOKASSA_SECRET_KEY are not set in .env")
-
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        resp = await client.get(
-            f"https://api.yookassa.ru/v3/payments/{payment_id}",
-            auth=(shop_id, secret_key),
-        )
-        resp.raise_for_status()
-        data = resp.json()
-        return data.get("status", "unknown")
-
-
-def format_vip_until(iso_value: str | None) -> str | None:
-    if not iso_value:
-        return None
-    try:
-        dt = datetime.fromisoformat(iso_value)
-    except ValueError:
-        return None
-    if dt.tzinfo is None:
-        dt = dt.replace(tzinfo=timezone.utc)
-    return dt.astimezone(timezone.utc).strftime("%d.%m.%Y")
+# Платёж YooKassa без оплаты отменяется примерно через час
+YK_INTENT_TTL_SEC = int(os.getenv("YK_INTENT_TTL_SEC", "3600"))
+# Профиль пишется в API только при изменении имени или раз в TTL
+PROFILE_SYNC_TTL_SEC = int(os.getenv("PROFILE_SYNC_TTL_SEC", "3600"))
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", "50000"))
+profile_hashes = TTLCache(maxsize=PROFILE_CACHE_SIZE, ttl=PROFILE_SYNC_TTL_SEC)
 
 
 def build_vip_screen_text(vip_until_iso: str | None) -> str:
@@ -167,86 +75,37 @@ def build_vip_screen_text(vip_until_iso: str | None) -> str:
     )
 
 
-def get_tariff_days(plan: str, tariff: dict) -> int | None:
-    days = tariff.get("days")
-    if days:
-        return int(days)
-    fallback = {"7d": 7, "1m": 30, "12m": 365}
-    return fallback.get(plan)
-
-
-async def ensure_vip(msg: Message, feature_name: str, feature_desc: str) -> bool:
-    status = await get_vip_status(msg.from_user.id)
-    if status.get("active"):
-        return True
-    text = (
+def build_vip_locked_text(feature_name: str, feature_desc: str) -> str:
+    return (
         "🔒 Эта функция доступна только для VIP-пользователей.\n\n"
         f"{feature_name} — {feature_desc}\n\n"
         "🚀 Оформите подписку через команду /vip — и получите доступ к функциям."
     )
-    await msg.answer(text)
+
+
+async def ensure_vip(msg: Message, feature_name: str, feature_desc: str) -> bool:
+    settings = await load_settings(msg.from_user.id)
+    if settings.get("vip_active"):
+        return True
+    await msg.answer(build_vip_locked_text(feature_name, feature_desc))
     return False
 
 
 async def sync_user_profile(msg: Message) -> None:
+    user = msg.from_user
+    profile_hash = hash((user.username, user.first_name, user.last_name))
+    if profile_hashes.get(user.id) == profile_hash:
+        return
     try:
         await upsert_user_profile(
-            tg_user_id=msg.from_user.id,
-            username=msg.from_user.username,
-            first_name=msg.from_user.first_name,
-            last_name=msg.from_user.last_name,
+            tg_user_id=user.id,
+            username=user.username,
+            first_name=user.first_name,
+            last_name=user.last_name,
         )
     except Exception:
-        pass
-
-
-async def stars_poll_loop(bot: Bot, pending: dict[str, dict], processed: set[str]) -> None:
-    while True:
-        if not pending:
-            await asyncio.sleep(STARS_POLL_INTERVAL_SEC)
-            continue
-        try:
-            txs = await bot.get_star_transactions(limit=100)
-            for tx in txs.transactions:
-                if tx.id in processed:
-                    continue
-                src = tx.source
-                if not src:
-                    continue
-                invoice_payload = getattr(src, "invoice_payload", None)
-                user = getattr(src, "user", None)
-                if not invoice_payload or not user:
-                    continue
-                info = pending.get(invoice_payload)
-                if not info:
-                    continue
-                if int(user.id) != int(info["user_id"]):
-                    continue
-                plan = info["plan"]
-                tariff = get_tariff(plan)
-                days = get_tariff_days(plan, tariff)
-                if not days:
-                    processed.add(tx.id)
-                    pending.pop(invoice_payload, None)
-                    continue
-                vip_res = await extend_vip(int(user.id), int(days))
-                vip_date = format_vip_until(vip_res.get("vip_until"))
-                if vip_date:
-                    await bot.send_message(
-                        int(user.id),
-                        f"✅ Оплата прошла успешно. Подписка активна до {vip_date}.",
-                    )
-                else:
-                    await bot.send_message(
-                        int(user.id),
-                        "✅ Оплата прошла успешно. Доступ к VIP включён.",
-                    )
-                processed.add(tx.id)
-                pending.pop(invoice_payload, None)
-        except Exception:
-            pass
-        await asyncio.sleep(STARS_POLL_INTERVAL_SEC)
-
+        return
+    profile_hashes.set(user.id, profile_hash)
 
 
 async def setup_commands(bot: Bot):
@@ -254,6 +113,8 @@ async def setup_commands(bot: Bot):
         BotCommand(command="subscriptions", description="Ваши подписки 📋"),
         BotCommand(command="digest", description="Сводка ✍️"),
         BotCommand(command="switch_feed", description="Краткая лента 🗒️"),
+        BotCommand(command="short_engine", description="Сжатие краткой ленты: ИИ или локально ⚙️"),
+        BotCommand(command="bundle", description="Склеивать короткие посты в одно сообщение 📦"),
         BotCommand(command="spam", description="Отключить рекламу и партнерские посты каналов 🚫📣"),
         BotCommand(command="start", description="Активировать пересылку ✅"),
         BotCommand(command="stop", description="Остановить пересылку ⛔"),
@@ -279,21 +140,22 @@ async def setup_commands(bot: Bot):
                 return
             await asyncio.sleep(min(2 * attempt, 10))
 
-async def main():
-    logging.basicConfig(level=logging.INFO)
+
+def create_bot() -> Bot:
     token = os.getenv("BOT_TOKEN")
     if not token:
         raise RuntimeError("BOT_TOKEN is not set in .env")
-    bot = Bot(token=token)
-    asyncio.create_task(feed_loop(bot))
+    return Bot(token=token)
+
+
+def create_dispatcher() -> Dispatcher:
+    """
+    Диспетчер со всеми обработчиками. Общий для long polling (main) и
+    вебхука (bot.webhook), поэтому не держит ссылку на конкретный Bot.
+    """
     dp = Dispatcher()
-    card_payments: dict[tuple[int, str], str] = {}
-    qr_payments: dict[tuple[int, str], str] = {}
-    stars_payloads: dict[str, dict] = {}
-    stars_last_plan: dict[int, str] = {}
-    stars_processed: set[str] = set()
-    await setup_commands(bot)
-    asyncio.create_task(stars_poll_loop(bot, stars_payloads, stars_processed))
+    digest_jobs = DigestJobs()
+
     @dp.message(Command("help"))
     async def cmd_help(msg: Message):
         await sync_user_profile(msg)
@@ -305,6 +167,8 @@ async def main():
             "• /subscriptions — список твоих подписок.\n"
             "• /digest — ИИ-сводка по всем каналам в одно сообщение.\n"
             "• /switch_feed — включить режим Краткой ленты: только текст, только суть.\n"
+            "• /short_engine — чем сжимать Краткую ленту: ИИ или быстрым локальным алгоритмом.\n"
+            "• /bundle — склеивать серии текстовых постов в одно сообщение: все вместе, по каналам или выключить.\n"
             "• /spam – Отключить рекламные и партнерские посты каналов.\n"
             "• /start — включить доставку постов с каналов.\n"
             "• /stop — приостановить пересылку.\n"
@@ -319,7 +183,7 @@ async def main():
     @dp.message(Command("subscriptions"))
     async def cmd_subscriptions(msg: Message):
         await sync_user_profile(msg)
-        channels = await list_channels(msg.from_user.id)
+        channels = await get_channels(msg.from_user.id)
         if not channels:
             await msg.answer("Подписок пока нет. Пришли @username или ссылку на канал — я добавлю ✅")
             return
@@ -331,7 +195,7 @@ async def main():
     @dp.message(Command("delete"))
     async def cmd_delete(msg: Message):
         await sync_user_profile(msg)
-        channels = await list_channels(msg.from_user.id)
+        channels = await get_channels(msg.from_user.id)
         if not channels:
             await msg.answer("Подписок пока нет. /subscriptions — посмотреть список")
             return
@@ -362,6 +226,7 @@ async def main():
         except Exception:
             logging.exception("Failed to process first_start for user %s", user_id)
         await set_forwarding(user_id, True)
+        invalidate_settings(user_id)
         await msg.answer("Пересылка сообщений активирована ✅")
 
     @dp.message(Command("stop"))
@@ -369,6 +234,7 @@ async def main():
         await sync_user_profile(msg)
         user_id = msg.from_user.id
         await set_forwarding(user_id, False)
+        invalidate_settings(user_id)
         await msg.answer("Пересылка сообщений остановлена ⛔️")
 
 
@@ -377,25 +243,18 @@ async def main():
         await sync_user_profile(msg)
         if not await ensure_vip(msg, "Digest", "умная сводка новостей."):
             return
-        await msg.answer("Готовлю сводку... 📝")
-        posts = await get_latest_posts(msg.from_user.id, limit=50)
-        recent = select_recent_posts(posts, hours=12, limit=20)
-        if not recent:
-            await msg.answer("За последние 12 часов нет постов для сводки.")
-            return
-        digest = await generate_digest(recent)
-        await msg.answer(digest, parse_mode="HTML", disable_web_page_preview=True)
+        placeholder = await msg.answer("Готовлю сводку... 📝")
+        await digest_jobs.submit(msg.from_user.id, placeholder)
 
     @dp.message(Command("spam"))
     async def cmd_spam(msg: Message):
         await sync_user_profile(msg)
-        if not await ensure_vip(msg, "Spam", "фильтр, скрывающий рекламные публикации."):
+        # проверка VIP и переключение — один атомарный запрос
+        ok, settings = await toggle_setting(msg.from_user.id, "spam_filter", require_vip=True)
+        if not ok:
+            await msg.answer(build_vip_locked_text("Spam", "фильтр, скрывающий рекламные публикации."))
             return
-        user_id = msg.from_user.id
-        enabled = await get_spam_filter(user_id)
-        new_state = not enabled
-        await set_spam_filter(user_id, new_state)
-        if new_state:
+        if settings["spam_filter"]:
             await msg.answer("✅ Фильтр рекламы включён. Партнёрские/рекламные посты больше не будут приходить.")
         else:
             await msg.answer("✅ Фильтр рекламы выключен. Буду присылать все посты.")
@@ -403,22 +262,48 @@ async def main():
     @dp.message(Command("switch_feed"))
     async def cmd_switch_feed(msg: Message):
         await sync_user_profile(msg)
-        if not await ensure_vip(msg, "Switch Feed", "переключение между полной и краткой лентой."):
+        ok, settings = await toggle_setting(msg.from_user.id, "short_feed", require_vip=True)
+        if not ok:
+            await msg.answer(
+                build_vip_locked_text("Switch Feed", "переключение между полной и краткой лентой.")
+            )
             return
-        user_id = msg.from_user.id
-        enabled = await get_short_feed(user_id)
-        new_state = not enabled
-        await set_short_feed(user_id, new_state)
-        if new_state:
+        if settings["short_feed"]:
             await msg.answer("✅ Включён режим «Для тех, кто ценит время».")
         else:
             await msg.answer("✅ Обычный режим ленты снова активен.")
 
+    @dp.message(Command("short_engine"))
+    async def cmd_short_engine(msg: Message):
+        await sync_user_profile(msg)
+        ok, settings = await toggle_setting(msg.from_user.id, "short_feed_engine", require_vip=True)
+        if not ok:
+            await msg.answer(
+                build_vip_locked_text("Short Engine", "выбор способа сжатия краткой ленты.")
+            )
+            return
+        if settings["short_feed_engine"] == "local":
+            await msg.answer("✅ Краткая лента сжимается локально: мгновенно, без ИИ.")
+        else:
+            await msg.answer("✅ Краткая лента снова сжимается с помощью ИИ.")
+
+    @dp.message(Command("bundle"))
+    async def cmd_bundle(msg: Message):
+        await sync_user_profile(msg)
+        _, settings = await toggle_setting(msg.from_user.id, "bundle_mode")
+        new_mode = settings["bundle_mode"]
+        if new_mode == "all":
+            await msg.answer("📦 Текстовые посты теперь приходят пачками в одном сообщении.")
+        elif new_mode == "channel":
+            await msg.answer("📦 Текстовые посты склеиваются в сообщения отдельно по каждому каналу.")
+        else:
+            await msg.answer("✅ Склейка выключена: каждый пост приходит отдельным сообщением.")
+
     @dp.message(Command("vip"))
     async def cmd_vip(msg: Message):
         await sync_user_profile(msg)
-        status = await get_vip_status(msg.from_user.id)
-        text = build_vip_screen_text(status.get("vip_until"))
+        settings = await load_settings(msg.from_user.id)
+        text = build_vip_screen_text(settings.get("vip_until"))
         await msg.answer(text, reply_markup=build_vip_tariffs_kb())
 
     register_admin_commands(dp, OWNER_TG_USER_ID)
@@ -468,7 +353,7 @@ async def main():
     async def cb_subs_page(cb: CallbackQuery):
         page = int(cb.data.split(":")[1])
 
-        channels = await list_channels(cb.from_user.id)
+        channels = await get_channels(cb.from_user.id)
         text = "Ваши подписки:"
         kb = build_subscriptions_kb(channels, page=page)
 
@@ -482,8 +367,8 @@ async def main():
 
     @dp.callback_query(DelCb.filter())
     async def cb_delete(cb: CallbackQuery, callback_data: DelCb):
-        channels = await list_channels(cb.from_user.id)
         if callback_data.action == "page":
+            channels = await get_channels(cb.from_user.id)
             page = max(0, callback_data.page)
             text = "Выберите канал для удаления:"
             kb = build_delete_kb(channels, page=page)
@@ -499,7 +384,8 @@ async def main():
         if callback_data.action == "ch" and callback_data.username:
             username = callback_data.username
             await delete_channel(cb.from_user.id, username)
-            channels = await list_channels(cb.from_user.id)
+            # после удаления кэш уже обновлён по ревизии — без повторного запроса списка
+            channels = await get_channels(cb.from_user.id)
             if not channels:
                 await cb.message.edit_text("✅ Все каналы удалены.\n\nТеперь список пуст.")
                 await cb.answer()
@@ -561,8 +447,8 @@ async def main():
             return
 
         if callback_data.action == "back":
-            status = await get_vip_status(cb.from_user.id)
-            text = build_vip_screen_text(status.get("vip_until"))
+            settings = await load_settings(cb.from_user.id)
+            text = build_vip_screen_text(settings.get("vip_until"))
             await cb.message.edit_text(text, reply_markup=build_vip_tariffs_kb())
             await cb.answer()
             return
@@ -570,16 +456,18 @@ async def main():
         if callback_data.action == "pay_card" and callback_data.plan:
             plan = callback_data.plan
             try:
-                payment_id, confirmation = await yk_create_payment(cb.from_user.id, plan)
+                payment_id, confirmation = await yookassa.create_payment(cb.from_user.id, plan)
                 confirmation_url = confirmation.get("confirmation_url")
                 if not confirmation_url:
                     raise RuntimeError("Не удалось получить ссылку на оплату.")
+                await create_payment_intent(
+                    payment_id, cb.from_user.id, "card", plan, days=plan_days(plan), ttl_sec=YK_INTENT_TTL_SEC
+                )
             except Exception as e:
                 await cb.message.edit_text(f"❌ Не удалось создать платёж: {e}")
                 await cb.answer()
                 return
 
-            card_payments[(cb.from_user.id, plan)] = payment_id
             tariff = get_tariff(plan)
             kb = [
                 [InlineKeyboardButton(text=f"💳 Оплатить {tariff['price']}₽", url=confirmation_url)],
@@ -596,13 +484,13 @@ async def main():
         if callback_data.action == "pay_qr" and callback_data.plan:
             plan = callback_data.plan
             try:
-                payment_id, confirmation = await yk_create_payment(
+                payment_id, confirmation = await yookassa.create_payment(
                     cb.from_user.id,
                     plan,
                     confirmation_type="qr",
                     payment_method_data={"type": "sbp"},
                 )
-            except YkBadRequestError as e:
+            except yookassa.YkBadRequestError as e:
                 await cb.message.edit_text(
                     "❌ Не удалось создать платёж СБП. Проверьте, что СБП включён в YooKassa "
                     "и доступен для вашего магазина.\n\n"
@@ -621,7 +509,14 @@ async def main():
                 await cb.message.edit_text("❌ Не удалось получить данные для оплаты по СБП.")
                 await cb.answer()
                 return
-            qr_payments[(cb.from_user.id, plan)] = payment_id
+            try:
+                await create_payment_intent(
+                    payment_id, cb.from_user.id, "qr", plan, days=plan_days(plan), ttl_sec=YK_INTENT_TTL_SEC
+                )
+            except Exception as e:
+                await cb.message.edit_text(f"❌ Не удалось создать платёж: {e}")
+                await cb.answer()
+                return
             tariff = get_tariff(plan)
             kb = [
                 [InlineKeyboardButton(text="✅ Проверить оплату", callback_data=VipCb(action="check_qr", plan=plan).pack())],
@@ -638,15 +533,10 @@ async def main():
                     disable_web_page_preview=True,
                 )
             else:
-                qr = qrcode.QRCode(border=2, box_size=6)
-                qr.add_data(confirmation_data)
-                qr.make(fit=True)
-                img = qr.make_image(fill_color="black", back_color="white")
-                buf = BytesIO()
-                img.save(buf, format="PNG")
-                buf.seek(0)
+                # рендер QR — CPU-работа, не держим ею цикл событий
+                qr_png = await asyncio.to_thread(render_qr_png, confirmation_data)
                 await cb.message.answer_photo(
-                    BufferedInputFile(buf.getvalue(), filename="sbp_qr.png"),
+                    BufferedInputFile(qr_png, filename="sbp_qr.png"),
                     caption=f"Отсканируйте QR для оплаты {tariff['price']}₽ по СБП.",
                     reply_markup=InlineKeyboardMarkup(inline_keyboard=kb),
                 )
@@ -663,14 +553,11 @@ async def main():
 
             provider_token = os.getenv("STARS_PROVIDER_TOKEN", "STARS")
             payload = f"vip:{callback_data.plan}:{uuid.uuid4()}"
-            stars_payloads[payload] = {
-                "user_id": cb.from_user.id,
-                "plan": callback_data.plan,
-                "created_at": time.time(),
-            }
-            stars_last_plan[cb.from_user.id] = callback_data.plan
 
             try:
+                await create_payment_intent(
+                    payload, cb.from_user.id, "stars", callback_data.plan, days=plan_days(callback_data.plan)
+                )
                 invoice_url = await cb.bot.create_invoice_link(
                     title="VIP-подписка",
                     description=f"VIP на {tariff['title']}",
@@ -700,61 +587,27 @@ async def main():
             return
 
 
-        if callback_data.action == "check_card" and callback_data.plan:
-            plan = callback_data.plan
-            payment_id = card_payments.get((cb.from_user.id, plan))
-            if not payment_id:
-                await cb.answer("Платёж не найден. Нажмите «Оплатить» ещё раз.", show_alert=True)
-                return
-
+        if callback_data.action in ("check_card", "check_qr") and callback_data.plan:
+            provider = "card" if callback_data.action == "check_card" else "qr"
             try:
-                status = await yk_check_payment(payment_id)
+                result, vip_until = await yookassa.check_intent(cb.from_user.id, provider, callback_data.plan)
             except Exception as e:
                 await cb.answer(f"❌ Ошибка проверки: {e}", show_alert=True)
                 return
-
-            if status == "succeeded":
-                tariff = get_tariff(plan)
-                days = get_tariff_days(plan, tariff)
-                if not days:
-                    await cb.message.edit_text("⚠️ Не удалось активировать VIP: отсутствует срок тарифа.")
-                    return
-                vip_res = await extend_vip(cb.from_user.id, int(days))
-                vip_date = format_vip_until(vip_res.get("vip_until"))
-                if vip_date:
-                    await cb.message.edit_text(f"✅ Оплата прошла успешно. Подписка активна до {vip_date}.")
+            if result == "not_found":
+                if provider == "card":
+                    await cb.answer("Платёж не найден. Нажмите «Оплатить» ещё раз.", show_alert=True)
                 else:
-                    await cb.message.edit_text("✅ Оплата прошла успешно. Доступ к VIP включён.")
-            else:
-                await cb.answer("⏳ Платёж ещё не завершён. Попробуйте позже.", show_alert=True)
-            return
-
-        if callback_data.action == "check_qr" and callback_data.plan:
-            plan = callback_data.plan
-            payment_id = qr_payments.get((cb.from_user.id, plan))
-            if not payment_id:
-                await cb.answer("Платёж не найден. Попробуйте создать QR ещё раз.", show_alert=True)
+                    await cb.answer("Платёж не найден. Попробуйте создать QR ещё раз.", show_alert=True)
                 return
-            try:
-                status = await yk_check_payment(payment_id)
-            except Exception as e:
-                await cb.answer(f"❌ Ошибка проверки: {e}", show_alert=True)
+            if result == "pending":
+                await cb.answer("⏳ Платёж ещё не завершён. Попробуйте позже.", show_alert=True)
                 return
-
-            if status == "succeeded":
-                tariff = get_tariff(plan)
-                days = get_tariff_days(plan, tariff)
-                if not days:
-                    await cb.message.answer("⚠️ Не удалось активировать VIP: отсутствует срок тарифа.")
-                    return
-                vip_res = await extend_vip(cb.from_user.id, int(days))
-                vip_date = format_vip_until(vip_res.get("vip_until"))
-                if vip_date:
-                    await cb.message.answer(f"✅ Оплата прошла успешно. Подписка активна до {vip_date}.")
-                else:
-                    await cb.message.answer("✅ Оплата прошла успешно. Доступ к VIP включён.")
+            # под фото с QR текст не отредактировать — отвечаем новым сообщением
+            if provider == "card":
+                await cb.message.edit_text(payment_success_text(vip_until))
             else:
-                await cb.answer("⏳ Платёж ещё не завершён. Попробуйте позже.", show_alert=True)
+                await cb.message.answer(payment_success_text(vip_until))
             return
 
         await cb.answer("Неизвестное действие", show_alert=True)
@@ -765,41 +618,40 @@ async def main():
 
     @dp.message(F.successful_payment)
     async def on_successful_payment(msg: Message):
+        # VIP начисляется только через намерение (credit_payment): если API
+        # недоступно, платёж зачтёт воркер Stars — повторного продления не будет
         payload = msg.successful_payment.invoice_payload
-        plan = None
-        if payload:
-            if payload.startswith("vip:"):
-                parts = payload.split(":")
-                if len(parts) >= 2:
-                    plan = parts[1]
-            elif payload.startswith("vip_stars_"):
-                plan = payload.split("vip_stars_", 1)[1]
-        if not plan and payload:
-            info = stars_payloads.get(payload)
-            if isinstance(info, dict):
-                plan = info.get("plan")
-        if not plan:
-            plan = stars_last_plan.get(msg.from_user.id)
-        if plan:
-            try:
-                tariff = get_tariff(plan)
-            except KeyError:
-                await msg.answer("✅ Оплата прошла успешно. Доступ к VIP включён.")
-                return
-            days = get_tariff_days(plan, tariff)
-            if not days:
-                await msg.answer("⚠️ Не удалось активировать VIP: отсутствует срок тарифа.")
-                return
-            vip_res = await extend_vip(msg.from_user.id, int(days))
-            text = build_vip_screen_text(vip_res.get("vip_until"))
-            await msg.answer(text, reply_markup=build_vip_tariffs_kb())
+        try:
+            intent = await get_payment_intent(payload) if payload else None
+            if not intent:
+                raise LookupError("payment intent not found")
+            credited = await credit_payment(
+                payload, tx_id=msg.successful_payment.telegram_payment_charge_id
+            )
+            if credited:
+                vip_until = credited["vip_until"]
+            else:
+                # платёж уже зачёл воркер Stars — показываем текущий статус без повторного начисления
+                invalidate_settings(msg.from_user.id)
+                vip_until = (await load_settings(msg.from_user.id)).get("vip_until")
+        except Exception as e:
+            logging.warning(f"Payment {payload}: not credited on successful_payment, left to reconciler: {e}")
+            await msg.answer("✅ Оплата получена. VIP будет активирован в течение нескольких минут.")
             return
-        await msg.answer("✅ Оплата прошла успешно. Доступ к VIP включён.")
+        await msg.answer(build_vip_screen_text(vip_until), reply_markup=build_vip_tariffs_kb())
 
+    return dp
 
 
+async def main():
+    logging.basicConfig(level=logging.INFO)
+    # Процесс бота только обрабатывает апдейты: доставка ленты и сверка
+    # платежей Stars — отдельные сервисы bot.feed_worker и bot.stars_worker.
+    # За балансировщиком вместо long polling — bot.webhook.
+    bot = create_bot()
+    dp = create_dispatcher()
+    await setup_commands(bot)
     await dp.start_polling(bot)
-    
 
 if __name__ == "__main__":
     asyncio.run(main())
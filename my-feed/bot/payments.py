@@ -0,0 +1,67 @@
+from datetime import datetime, timezone
+from io import BytesIO
+
+import qrcode
+
+from bot.api_client import complete_payment_intent
+from bot.keyboards.vip import get_tariff
+from bot.user_settings import invalidate_settings
+
+
+def format_vip_until(iso_value: str | None) -> str | None:
+    if not iso_value:
+        return None
+    try:
+        dt = datetime.fromisoformat(iso_value)
+    except ValueError:
+        return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc).strftime("%d.%m.%Y")
+
+
+def get_tariff_days(plan: str, tariff: dict) -> int | None:
+    days = tariff.get("days")
+    if days:
+        return int(days)
+    fallback = {"7d": 7, "1m": 30, "12m": 365}
+    return fallback.get(plan)
+
+
+def render_qr_png(data: str) -> bytes:
+    qr = qrcode.QRCode(border=2, box_size=6)
+    qr.add_data(data)
+    qr.make(fit=True)
+    img = qr.make_image(fill_color="black", back_color="white")
+    buf = BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def payment_success_text(vip_until_iso: str | None) -> str:
+    vip_date = format_vip_until(vip_until_iso)
+    if vip_date:
+        return f"✅ Оплата прошла успешно. Подписка активна до {vip_date}."
+    return "✅ Оплата прошла успешно. Доступ к VIP включён."
+
+
+def plan_days(plan: str) -> int | None:
+    try:
+        return get_tariff_days(plan, get_tariff(plan))
+    except KeyError:
+        return None
+
+
+async def credit_payment(payload: str, tx_id: str | None) -> dict | None:
+    """
+    Переводит намерение в paid и продлевает VIP — одним запросом, в одной
+    транзакции API. None — платёж уже зачтён другим обработчиком (событие
+    оплаты, сверка, повторная проверка) или намерения нет: VIP продлевается
+    ровно один раз.
+    """
+    res = await complete_payment_intent(payload, tx_id=tx_id)
+    if not res.get("completed"):
+        return None
+    tg_user_id = int(res["tg_user_id"])
+    invalidate_settings(tg_user_id)
+    return {"tg_user_id": tg_user_id, "plan": res["plan"], "vip_until": res.get("vip_until")}
@@ -1,8 +1,13 @@
 import logging
 import os
+import time
 
 import httpx
 
+from common.extractive import summarize_extractive
+from common.llm_health import allow_llm_call, arecord_llm_call
+from common.summary_cache import aget_cached_summary, astore_summary
+
 log = logging.getLogger(__name__)
 
 MISTRAL_API_KEY = os.getenv("MISTRAL_API_KEY")
@@ -27,6 +32,11 @@ async def summarize_to_one_sentence(text: str) -> str:
         return ""
     if not MISTRAL_API_KEY:
         return _first_sentence(text)
+    cached = await aget_cached_summary(text, MISTRAL_MODEL)
+    if cached:
+        return cached
+    if not await allow_llm_call():
+        return summarize_extractive(text)
 
     payload = {
         "model": MISTRAL_MODEL,
@@ -46,13 +56,19 @@ async def summarize_to_one_sentence(text: str) -> str:
     url = f"{MISTRAL_BASE_URL}/v1/chat/completions"
     headers = {"Authorization": f"Bearer {MISTRAL_API_KEY}"}
 
+    start = time.monotonic()
     async with httpx.AsyncClient(timeout=20) as client:
         try:
             r = await client.post(url, json=payload, headers=headers)
             r.raise_for_status()
             data = r.json()
             result = data["choices"][0]["message"]["content"].strip()
-            return result or _first_sentence(text)
         except Exception as e:
             log.exception(f"Short feed summarize failed: {e}")
+            await arecord_llm_call(time.monotonic() - start, ok=False)
             return _first_sentence(text)
+    await arecord_llm_call(time.monotonic() - start, ok=True)
+    if not result:
+        return _first_sentence(text)
+    await astore_summary(text, MISTRAL_MODEL, result)
+    return result
@@ -0,0 +1,103 @@
+import asyncio
+import logging
+import os
+import time
+
+from aiogram import Bot
+
+from bot.api_client import cleanup_payment_intents, get_payment_intent
+from bot.payments import credit_payment, payment_success_text
+from common.redis_client import get_async_redis
+
+log = logging.getLogger(__name__)
+
+# Основной путь зачисления Stars — событие successful_payment в боте; этот
+# воркер — страховочная сверка. getStarTransactions отдаёт транзакции в
+# хронологическом порядке, поэтому курсор (число уже просмотренных
+# транзакций) хранится в Redis и каждый проход читает только новые.
+STARS_POLL_INTERVAL_SEC = int(os.getenv("STARS_POLL_INTERVAL_SEC", "20"))
+STARS_PAGE_SIZE = 100
+STARS_CURSOR_KEY = "stars:tx_offset"
+# Индекс обработанных транзакций на случай сброса курсора; записи старше
+# срока хранения вычищаются, поэтому индекс не растёт бесконечно
+STARS_PROCESSED_KEY = "stars:processed"
+STARS_PROCESSED_RETENTION_SEC = int(os.getenv("STARS_PROCESSED_RETENTION_SEC", str(90 * 86400)))
+INTENT_CLEANUP_INTERVAL_SEC = 3600
+
+
+async def credit_stars_payment(bot: Bot, intent: dict, tx_id: str) -> bool:
+    credited = await credit_payment(intent["payload"], tx_id)
+    if not credited:
+        return False
+    await bot.send_message(credited["tg_user_id"], payment_success_text(credited["vip_until"]))
+    return True
+
+
+async def handle_transaction(bot: Bot, tx) -> bool:
+    src = tx.source
+    invoice_payload = getattr(src, "invoice_payload", None) if src else None
+    user = getattr(src, "user", None) if src else None
+    if not invoice_payload or not user:
+        return False
+    intent = await get_payment_intent(invoice_payload)
+    if not intent or intent["status"] == "paid" or int(user.id) != int(intent["tg_user_id"]):
+        return False
+    return await credit_stars_payment(bot, intent, tx.id)
+
+
+async def reconcile_stars(bot: Bot) -> int:
+    """Один проход сверки с сохранённого курсора. Возвращает число новых транзакций."""
+    client = get_async_redis()
+    offset = int(await client.get(STARS_CURSOR_KEY) or 0)
+    seen = 0
+    while True:
+        page = await bot.get_star_transactions(offset=offset, limit=STARS_PAGE_SIZE)
+        txs = page.transactions
+        for tx in txs:
+            if await client.zscore(STARS_PROCESSED_KEY, tx.id) is not None:
+                continue
+            await handle_transaction(bot, tx)
+            await client.zadd(STARS_PROCESSED_KEY, {tx.id: time.time()})
+        offset += len(txs)
+        seen += len(txs)
+        await client.set(STARS_CURSOR_KEY, offset)
+        if len(txs) < STARS_PAGE_SIZE:
+            break
+    await client.zremrangebyscore(STARS_PROCESSED_KEY, "-inf", time.time() - STARS_PROCESSED_RETENTION_SEC)
+    return seen
+
+
+async def stars_poll_loop(bot: Bot) -> None:
+    next_cleanup = 0.0
+    while True:
+        try:
+            seen = await reconcile_stars(bot)
+            if seen:
+                log.info(f"Stars reconciliation: {seen} new transactions")
+        except Exception as e:
+            log.warning(f"Stars poll failed: {e}")
+        if time.monotonic() >= next_cleanup:
+            try:
+                res = await cleanup_payment_intents()
+                if res.get("expired") or res.get("deleted"):
+                    log.info(f"Payment intents: {res.get('expired')} expired, {res.get('deleted')} deleted")
+                next_cleanup = time.monotonic() + INTENT_CLEANUP_INTERVAL_SEC
+            except Exception as e:
+                log.warning(f"Payment intent cleanup failed: {e}")
+        await asyncio.sleep(STARS_POLL_INTERVAL_SEC)
+
+
+async def main():
+    logging.basicConfig(level=logging.INFO)
+    token = os.getenv("BOT_TOKEN")
+    if not token:
+        raise RuntimeError("BOT_TOKEN is not set in .env")
+    bot = Bot(token=token)
+    try:
+        await stars_poll_loop(bot)
+    finally:
+        await bot.session.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,36 @@
+import os
+
+from bot import api_client
+from bot.cache import TTLCache
+
+# Настройки и VIP-статус пользователя живут в кэше бота недолго: запись
+# бота сразу кладёт в кэш ответ API, а изменения из других процессов
+# (продление VIP воркером платежей) становятся видны через TTL.
+SETTINGS_CACHE_TTL_SEC = int(os.getenv("SETTINGS_CACHE_TTL_SEC", "30"))
+SETTINGS_CACHE_SIZE = int(os.getenv("SETTINGS_CACHE_SIZE", "50000"))
+settings_cache = TTLCache(maxsize=SETTINGS_CACHE_SIZE, ttl=SETTINGS_CACHE_TTL_SEC)
+
+
+async def load_settings(tg_user_id: int) -> dict:
+    settings = settings_cache.get(tg_user_id)
+    if settings is None:
+        settings = await api_client.get_user_settings(tg_user_id)
+        settings_cache.set(tg_user_id, settings)
+    return settings
+
+
+async def toggle_setting(tg_user_id: int, setting: str, require_vip: bool = False) -> tuple[bool, dict]:
+    """Один запрос к API: (переключено ли, все настройки после операции)."""
+    res = await api_client.toggle_user_setting(tg_user_id, setting, require_vip=require_vip)
+    settings_cache.set(tg_user_id, res["settings"])
+    return bool(res.get("ok")), res["settings"]
+
+
+def invalidate_settings(tg_user_id: int) -> None:
+    settings_cache.pop(tg_user_id)
+
+
+async def extend_vip(tg_user_id: int, days: int) -> dict:
+    res = await api_client.extend_vip(tg_user_id, days)
+    invalidate_settings(tg_user_id)
+    return res
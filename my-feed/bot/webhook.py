@@ -0,0 +1,106 @@
+import asyncio
+import hmac
+import logging
+import os
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from fastapi import FastAPI, HTTPException, Request
+
+from bot.main import create_bot, create_dispatcher, setup_commands
+from bot.yookassa import close_client, create_notification_router
+
+log = logging.getLogger(__name__)
+
+# Вебхук вместо long polling: getUpdates — один поток апдейтов на процесс,
+# а вебхук можно поставить за балансировщик и раздать на несколько реплик.
+# Запуск: uvicorn bot.webhook:app --host 0.0.0.0 --port 8080
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+# Сверх лимита отвечаем 503 — Telegram повторит доставку позже
+WEBHOOK_MAX_INFLIGHT = int(os.getenv("WEBHOOK_MAX_INFLIGHT", "200"))
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def secret_matches(received: str | None, expected: str) -> bool:
+    if not expected:
+        return False
+    return hmac.compare_digest((received or "").encode(), expected.encode())
+
+
+def create_app(
+    bot: Bot | None = None,
+    dp: Dispatcher | None = None,
+    secret: str = WEBHOOK_SECRET,
+    max_inflight: int = WEBHOOK_MAX_INFLIGHT,
+) -> FastAPI:
+    """
+    ASGI-приложение вебхука. Запрос проверяется по секретному заголовку,
+    апдейт ставится в фоновую задачу, ответ 200 уходит сразу — Telegram
+    не ждёт обработчиков и не шлёт повторы из-за медленных ответов.
+    """
+    app = FastAPI(title="MyFeed bot webhook")
+    app.state.bot = bot
+    app.state.dp = dp
+    app.state.pending = set()
+    # уведомления YooKassa принимает тот же сервис, что стоит за балансировщиком
+    app.include_router(create_notification_router())
+
+    async def _process(update: Update) -> None:
+        try:
+            await app.state.dp.feed_update(app.state.bot, update)
+        except Exception as e:
+            log.exception(f"Update {update.update_id} failed: {e}")
+
+    @app.on_event("startup")
+    async def on_startup():
+        # без секрета любой, кто знает адрес, может прислать поддельный апдейт
+        if not secret:
+            raise RuntimeError("WEBHOOK_SECRET is not set in .env")
+        if app.state.bot is None:
+            app.state.bot = create_bot()
+        if app.state.dp is None:
+            app.state.dp = create_dispatcher()
+        if WEBHOOK_BASE_URL:
+            # set_webhook идемпотентен, поэтому его могут вызывать все реплики
+            await app.state.bot.set_webhook(
+                f"{WEBHOOK_BASE_URL.rstrip('/')}{WEBHOOK_PATH}",
+                secret_token=secret,
+                allowed_updates=app.state.dp.resolve_used_update_types(),
+            )
+            await setup_commands(app.state.bot)
+
+    @app.on_event("shutdown")
+    async def on_shutdown():
+        await drain(app)
+        await close_client()
+        if app.state.bot is not None:
+            await app.state.bot.session.close()
+
+    @app.get("/health")
+    async def health():
+        return {"ok": True, "inflight": len(app.state.pending)}
+
+    @app.post(WEBHOOK_PATH)
+    async def telegram_webhook(request: Request):
+        if not secret_matches(request.headers.get(SECRET_HEADER), secret):
+            raise HTTPException(401, "bad secret token")
+        if len(app.state.pending) >= max_inflight:
+            raise HTTPException(503, "too many updates in flight")
+        update = Update.model_validate(await request.json(), context={"bot": app.state.bot})
+        task = asyncio.create_task(_process(update))
+        app.state.pending.add(task)
+        task.add_done_callback(app.state.pending.discard)
+        return {"ok": True}
+
+    return app
+
+
+async def drain(app: FastAPI) -> None:
+    """Дожидается апдейтов, принятых до остановки реплики."""
+    if app.state.pending:
+        await asyncio.gather(*list(app.state.pending), return_exceptions=True)
+
+
+app = create_app()
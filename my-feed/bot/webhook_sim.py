@@ -0,0 +1,79 @@
+import argparse
+import asyncio
+import itertools
+import time
+
+import httpx
+
+from bot.webhook import SECRET_HEADER, WEBHOOK_PATH, WEBHOOK_SECRET
+
+# Локальный имитатор Telegram: шлёт в вебхук апдейты того же вида, что и
+# Bot API. Работает и с запущенным сервером, и напрямую с ASGI-приложением
+# (для тестов), например:
+#   python -m bot.webhook_sim --url http://localhost:8080 --user 1 "/help"
+
+
+class WebhookSimulator:
+    def __init__(
+        self,
+        app=None,
+        base_url: str = "http://webhook.local",
+        secret: str = WEBHOOK_SECRET,
+        path: str = WEBHOOK_PATH,
+    ) -> None:
+        transport = httpx.ASGITransport(app=app) if app is not None else None
+        self.client = httpx.AsyncClient(transport=transport, base_url=base_url, timeout=10)
+        self.secret = secret
+        self.path = path
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    def message_update(self, tg_user_id: int, text: str) -> dict:
+        user = {"id": tg_user_id, "is_bot": False, "first_name": f"user{tg_user_id}"}
+        return {
+            "update_id": next(self._update_ids),
+            "message": {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": tg_user_id, "type": "private", "first_name": user["first_name"]},
+                "from": user,
+                "text": text,
+            },
+        }
+
+    async def send(self, update: dict, secret: str | None = None) -> httpx.Response:
+        headers = {}
+        token = self.secret if secret is None else secret
+        if token:
+            headers[SECRET_HEADER] = token
+        return await self.client.post(self.path, json=update, headers=headers)
+
+    async def send_text(self, tg_user_id: int, text: str) -> httpx.Response:
+        return await self.send(self.message_update(tg_user_id, text))
+
+    async def close(self) -> None:
+        await self.client.aclose()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Send fake Telegram updates to the bot webhook")
+    parser.add_argument("--url", default="http://localhost:8080")
+    parser.add_argument("--user", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("text", nargs="+")
+    args = parser.parse_args()
+
+    sim = WebhookSimulator(base_url=args.url)
+    try:
+        started = time.perf_counter()
+        for _ in range(args.repeat):
+            for text in args.text:
+                r = await sim.send_text(args.user, text)
+                print(r.status_code, r.text)
+        print(f"sent {args.repeat * len(args.text)} updates in {time.perf_counter() - started:.2f}s")
+    finally:
+        await sim.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,264 @@
+import asyncio
+import logging
+import os
+import time
+import uuid
+
+import httpx
+from aiogram import Bot
+from fastapi import APIRouter, Request
+
+from bot.api_client import cancel_payment_intent, list_payment_intents
+from bot.cache import TTLCache
+from bot.keyboards.vip import get_tariff
+from bot.payments import credit_payment, payment_success_text
+from bot.user_settings import invalidate_settings, load_settings
+
+log = logging.getLogger(__name__)
+
+YOOKASSA_API_URL = os.getenv("YOOKASSA_API_URL", "https://api.yookassa.ru/v3")
+YOOKASSA_WEBHOOK_PATH = os.getenv("YOOKASSA_WEBHOOK_PATH", "/yookassa/webhook")
+YK_PROVIDERS = ("card", "qr")
+# Фоновая сверка: все ожидающие платежи (и недавно истёкшие — оплата могла
+# прийти поздно) читаются постранично; каждый платёж проверяется с растущей
+# паузой (свежие часто, давние редко), ошибка по платежу откладывает только
+# его. Пауза для всей сверки растёт, лишь если не удалось прочитать список.
+YK_RECONCILE_INTERVAL_SEC = float(os.getenv("YK_RECONCILE_INTERVAL_SEC", "10"))
+YK_RECONCILE_BATCH = int(os.getenv("YK_RECONCILE_BATCH", "100"))
+YK_RECONCILE_EXPIRED_SEC = int(os.getenv("YK_RECONCILE_EXPIRED_SEC", "86400"))
+YK_RECONCILE_CONCURRENCY = int(os.getenv("YK_RECONCILE_CONCURRENCY", "10"))
+YK_CHECK_DELAY_SEC = 15.0
+YK_CHECK_MAX_DELAY_SEC = 600.0
+YK_ERROR_MAX_BACKOFF_SEC = 300.0
+
+_client: httpx.AsyncClient | None = None
+
+
+class YkBadRequestError(Exception):
+    pass
+
+
+def get_client() -> httpx.AsyncClient:
+    """Общий клиент с keep-alive: запросы к YooKassa не открывают новое соединение."""
+    global _client
+    if _client is None:
+        shop_id = os.getenv("YOOKASSA_SHOP_ID")
+        secret_key = os.getenv("YOOKASSA_SECRET_KEY")
+        if not shop_id or not secret_key:
+            raise RuntimeError("YOOKASSA_SHOP_ID/YOOKASSA_SECRET_KEY are not set in .env")
+        _client = httpx.AsyncClient(
+            base_url=YOOKASSA_API_URL,
+            auth=(shop_id, secret_key),
+            timeout=30.0,
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+        )
+    return _client
+
+
+async def close_client() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def create_payment(
+    user_id: int,
+    plan: str,
+    confirmation_type: str = "redirect",
+    payment_method_data: dict | None = None,
+) -> tuple[str, dict]:
+    tax_system_code = int(os.getenv("YOOKASSA_TAX_SYSTEM_CODE", "1"))
+    receipt_email = os.getenv("YOOKASSA_RECEIPT_EMAIL") or f"user{user_id}@example.com"
+
+    tariff = get_tariff(plan)
+    amount_value = f"{tariff['price']:.2f}"
+    return_url = os.getenv("YOOKASSA_RETURN_URL", "https://t.me")
+    idempotence_key = str(uuid.uuid4())
+
+    confirmation = {"type": confirmation_type, "return_url": return_url}
+    payload = {
+        "amount": {"value": amount_value, "currency": "RUB"},
+        "confirmation": confirmation,
+        "capture": True,
+        "description": f"VIP на {tariff['title']}",
+        "metadata": {"user_id": user_id, "plan": plan},
+        "receipt": {
+            "customer": {"email": receipt_email},
+            "tax_system_code": tax_system_code,
+            "items": [
+                {
+                    "description": f"VIP на {tariff['title']}",
+                    "quantity": "1.00",
+                    "amount": {"value": amount_value, "currency": "RUB"},
+                    "vat_code": 1,
+                    "payment_subject": "service",
+                    "payment_mode": "full_prepayment",
+                }
+            ],
+        },
+    }
+    if payment_method_data:
+        payload["payment_method_data"] = payment_method_data
+
+    try:
+        resp = await get_client().post(
+            "/payments",
+            headers={"Idempotence-Key": idempotence_key},
+            json=payload,
+        )
+        resp.raise_for_status()
+    except httpx.HTTPStatusError as e:
+        detail = e.response.text.strip()
+        if e.response.status_code == 400:
+            raise YkBadRequestError(detail) from e
+        raise RuntimeError(f"YooKassa error: {detail}") from e
+    data = resp.json()
+    return data["id"], data["confirmation"]
+
+
+async def get_payment_status(payment_id: str) -> str:
+    resp = await get_client().get(f"/payments/{payment_id}")
+    resp.raise_for_status()
+    return resp.json().get("status", "unknown")
+
+
+async def check_intent(tg_user_id: int, provider: str, plan: str) -> tuple[str, str | None]:
+    """
+    Проверка платежа по кнопке: not_found, pending или paid (с датой
+    окончания VIP). Зачисление идёт через намерение, поэтому повторное
+    нажатие «Проверить оплату» не продлит VIP второй раз.
+    """
+    intents = await list_payment_intents(provider, status="", tg_user_id=tg_user_id, plan=plan, limit=1)
+    if not intents:
+        return "not_found", None
+    intent = intents[0]
+    if intent["status"] != "paid":
+        if await get_payment_status(intent["payload"]) != "succeeded":
+            return "pending", None
+        credited = await credit_payment(intent["payload"], tx_id=intent["payload"])
+        if credited:
+            return "paid", credited["vip_until"]
+    invalidate_settings(tg_user_id)
+    return "paid", (await load_settings(tg_user_id)).get("vip_until")
+
+
+async def settle_payment(bot: Bot, payment_id: str, status: str) -> bool:
+    """Применяет итоговый статус платежа. True — VIP зачислен этим вызовом."""
+    if status == "canceled":
+        await cancel_payment_intent(payment_id)
+        return False
+    if status != "succeeded":
+        return False
+    credited = await credit_payment(payment_id, tx_id=payment_id)
+    if not credited:
+        return False
+    try:
+        await bot.send_message(credited["tg_user_id"], payment_success_text(credited["vip_until"]))
+    except Exception as e:
+        log.warning(f"YooKassa payment {payment_id}: credited, but notification failed: {e}")
+    return True
+
+
+class YooKassaReconciler:
+    def __init__(self, bot: Bot) -> None:
+        self.bot = bot
+        # payment_id -> (время следующей проверки, текущая пауза); размер ограничен
+        self.schedule = TTLCache(maxsize=50000, ttl=YK_CHECK_MAX_DELAY_SEC * 4)
+        self.error_backoff = 0.0
+
+    def _due(self, payment_id: str, now: float) -> bool:
+        entry = self.schedule.get(payment_id)
+        return entry is None or entry[0] <= now
+
+    def _postpone(self, payment_id: str, now: float) -> None:
+        entry = self.schedule.get(payment_id)
+        delay = YK_CHECK_DELAY_SEC if entry is None else min(entry[1] * 2, YK_CHECK_MAX_DELAY_SEC)
+        self.schedule.set(payment_id, (now + delay, delay))
+
+    async def reconcile_once(self) -> int:
+        """Один проход по ожидающим платежам. Возвращает число зачислений."""
+        now = time.monotonic()
+        due: list[str] = []
+        for provider in YK_PROVIDERS:
+            after_id = 0
+            while True:
+                page = await list_payment_intents(
+                    provider,
+                    limit=YK_RECONCILE_BATCH,
+                    after_id=after_id,
+                    expired_within_sec=YK_RECONCILE_EXPIRED_SEC,
+                )
+                due.extend(i["payload"] for i in page if self._due(i["payload"], now))
+                if len(page) < YK_RECONCILE_BATCH:
+                    break
+                after_id = page[-1]["id"]
+        sem = asyncio.Semaphore(YK_RECONCILE_CONCURRENCY)
+
+        async def check(payment_id: str) -> bool:
+            try:
+                async with sem:
+                    status = await get_payment_status(payment_id)
+                if status in ("succeeded", "canceled"):
+                    credited = await settle_payment(self.bot, payment_id, status)
+                    self.schedule.pop(payment_id)
+                    return credited
+            except Exception as e:
+                log.warning(f"YooKassa payment {payment_id}: check failed: {e}")
+            self._postpone(payment_id, now)
+            return False
+
+        results = await asyncio.gather(*(check(pid) for pid in due))
+        return sum(results)
+
+    async def run(self) -> None:
+        while True:
+            try:
+                credited = await self.reconcile_once()
+                if credited:
+                    log.info(f"YooKassa reconciliation: {credited} payments credited")
+                self.error_backoff = 0.0
+            except Exception as e:
+                self.error_backoff = min(
+                    YK_ERROR_MAX_BACKOFF_SEC, max(YK_RECONCILE_INTERVAL_SEC, self.error_backoff * 2)
+                )
+                log.warning(f"YooKassa reconciliation failed, backing off {self.error_backoff:.0f}s: {e}")
+            await asyncio.sleep(YK_RECONCILE_INTERVAL_SEC + self.error_backoff)
+
+
+def create_notification_router() -> APIRouter:
+    """
+    Приём уведомлений YooKassa. Телу уведомления не доверяем: статус
+    платежа перечитывается из API, поэтому поддельный запрос ничего не
+    зачислит. Ответ 200 — YooKassa перестаёт повторять уведомление.
+    """
+    router = APIRouter()
+
+    @router.post(YOOKASSA_WEBHOOK_PATH)
+    async def yookassa_notification(request: Request):
+        data = await request.json()
+        payment_id = (data.get("object") or {}).get("id")
+        if not payment_id or not str(data.get("event", "")).startswith("payment."):
+            return {"ok": True}
+        status = await get_payment_status(payment_id)
+        await settle_payment(request.app.state.bot, payment_id, status)
+        return {"ok": True}
+
+    return router
+
+
+async def main():
+    logging.basicConfig(level=logging.INFO)
+    token = os.getenv("BOT_TOKEN")
+    if not token:
+        raise RuntimeError("BOT_TOKEN is not set in .env")
+    bot = Bot(token=token)
+    try:
+        await YooKassaReconciler(bot).run()
+    finally:
+        await close_client()
+        await bot.session.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,68 @@
+import uuid
+
+import httpx
+from fastapi import FastAPI, Header, HTTPException
+
+# Локальная имитация API YooKassa для тестов и ручной проверки оплаты:
+#   uvicorn bot.yookassa_fake:app --port 8090
+#   YOOKASSA_API_URL=http://localhost:8090/v3
+# Статус платежа меняется через POST /v3/_fake/payments/{id}/{status};
+# если задан notify_url, сервер шлёт туда уведомление, как настоящая YooKassa.
+
+
+def create_fake_yookassa(notify_transport: httpx.AsyncBaseTransport | None = None) -> FastAPI:
+    app = FastAPI(title="Fake YooKassa")
+    app.state.payments = {}
+    app.state.idempotence = {}
+    app.state.requests = 0
+
+    def _payment(payment_id: str) -> dict:
+        payment = app.state.payments.get(payment_id)
+        if not payment:
+            raise HTTPException(404, "payment not found")
+        return payment
+
+    @app.post("/v3/payments")
+    async def create_payment(body: dict, idempotence_key: str = Header(..., alias="Idempotence-Key")):
+        app.state.requests += 1
+        if idempotence_key in app.state.idempotence:
+            return app.state.payments[app.state.idempotence[idempotence_key]]
+        if not body.get("amount") or not body.get("confirmation"):
+            raise HTTPException(400, "amount and confirmation are required")
+        payment_id = str(uuid.uuid4())
+        confirmation = dict(body["confirmation"])
+        if confirmation.get("type") == "qr":
+            confirmation["confirmation_data"] = f"https://qr.nspk.ru/fake/{payment_id}"
+        else:
+            confirmation["confirmation_url"] = f"https://yoomoney.ru/checkout/fake/{payment_id}"
+        payment = {
+            "id": payment_id,
+            "status": "pending",
+            "amount": body["amount"],
+            "metadata": body.get("metadata") or {},
+            "confirmation": confirmation,
+        }
+        app.state.payments[payment_id] = payment
+        app.state.idempotence[idempotence_key] = payment_id
+        return payment
+
+    @app.get("/v3/payments/{payment_id}")
+    async def get_payment(payment_id: str):
+        app.state.requests += 1
+        return _payment(payment_id)
+
+    @app.post("/v3/_fake/payments/{payment_id}/{status}")
+    async def set_status(payment_id: str, status: str, notify_url: str | None = None):
+        payment = _payment(payment_id)
+        payment["status"] = status
+        if notify_url:
+            notification = {"type": "notification", "event": f"payment.{status}", "object": payment}
+            async with httpx.AsyncClient(transport=notify_transport) as client:
+                r = await client.post(notify_url, json=notification)
+                return {"ok": True, "notify_status": r.status_code}
+        return {"ok": True}
+
+    return app
+
+
+app = create_fake_yookassa()
@@ -0,0 +1,40 @@
+import numpy as np
+
+from common.textvec import hashed_counts, split_sentences, tfidf, tokenize
+
+MAX_SUMMARY_LEN = 400
+# Новостные посты обычно начинаются с главного — лёгкий бонус первым предложениям
+POSITION_WEIGHT = 0.15
+
+
+def score_sentences(sentences: list[str]) -> np.ndarray:
+    vectors = tfidf(hashed_counts([tokenize(s) for s in sentences]))
+    centroid = vectors.mean(axis=0)
+    norm = np.linalg.norm(centroid)
+    if norm == 0:
+        scores = np.zeros(len(sentences), dtype=np.float32)
+    else:
+        scores = vectors @ (centroid / norm)
+    positions = np.arange(len(sentences), dtype=np.float32)
+    return scores + POSITION_WEIGHT / (1.0 + positions)
+
+
+def summarize_extractive(text: str, max_sentences: int = 1) -> str:
+    """
+    Локальное экстрактивное сжатие: предложения взвешиваются по близости
+    к центроиду TF-IDF всего поста, берутся лучшие в исходном порядке.
+    Работает за миллисекунды и без сети.
+    """
+    sentences = split_sentences(text)
+    if not sentences:
+        return ""
+    if len(sentences) <= max_sentences:
+        selected = sentences
+    else:
+        scores = score_sentences(sentences)
+        top = np.argsort(-scores, kind="stable")[:max_sentences]
+        selected = [sentences[i] for i in sorted(top)]
+    summary = " ".join(selected)
+    if len(summary) > MAX_SUMMARY_LEN:
+        summary = summary[: MAX_SUMMARY_LEN - 1].rstrip() + "…"
+    return summary
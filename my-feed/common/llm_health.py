@@ -0,0 +1,164 @@
+import logging
+import os
+import time
+
+from common.redis_client import get_async_redis, get_redis
+
+log = logging.getLogger(__name__)
+
+# Общий для бота и воркеров автомат-предохранитель LLM: по последним вызовам
+# считается доля ошибок и p95 задержки; при превышении порогов LLM считается
+# недоступной и краткая лента сразу уходит в локальное сжатие. После паузы
+# один вызов пропускается как проба — успех закрывает предохранитель. Пробу
+# делает и фоновая задача probe_llm (Celery beat), поэтому предохранитель
+# закрывается, даже когда пользовательских запросов нет.
+WINDOW = int(os.getenv("LLM_HEALTH_WINDOW", "50"))
+MIN_SAMPLES = int(os.getenv("LLM_HEALTH_MIN_SAMPLES", "10"))
+MAX_ERROR_RATE = float(os.getenv("LLM_HEALTH_MAX_ERROR_RATE", "0.5"))
+MAX_P95_LATENCY_SEC = float(os.getenv("LLM_HEALTH_MAX_P95_SEC", "8"))
+OPEN_SEC = int(os.getenv("LLM_HEALTH_OPEN_SEC", "60"))
+PROBE_LOCK_SEC = 30
+
+SAMPLES_KEY = "llm:health:samples"
+OPEN_KEY = "llm:health:open"
+PROBE_KEY = "llm:health:probe"
+
+
+def _encode_sample(latency_sec: float, ok: bool) -> str:
+    return f"{latency_sec:.3f}:{int(ok)}"
+
+
+def _decode_samples(raw: list[str]) -> list[tuple[float, bool]]:
+    samples = []
+    for item in raw or []:
+        try:
+            latency, ok = item.split(":")
+            samples.append((float(latency), ok == "1"))
+        except ValueError:
+            continue
+    return samples
+
+
+def _percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, max(0, round(q * (len(ordered) - 1))))
+    return ordered[idx]
+
+
+def health_stats(samples: list[tuple[float, bool]]) -> dict:
+    latencies = [latency for latency, _ in samples]
+    errors = sum(1 for _, ok in samples if not ok)
+    return {
+        "count": len(samples),
+        "error_rate": errors / len(samples) if samples else 0.0,
+        "p50": _percentile(latencies, 0.5),
+        "p95": _percentile(latencies, 0.95),
+    }
+
+
+def _transition(samples: list[tuple[float, bool]], opened_at: str | None, ok: bool) -> str | None:
+    if opened_at is not None:
+        return "close" if ok else "open"
+    stats = health_stats(samples)
+    if stats["count"] >= MIN_SAMPLES and (
+        stats["error_rate"] >= MAX_ERROR_RATE or stats["p95"] >= MAX_P95_LATENCY_SEC
+    ):
+        return "open"
+    return None
+
+
+def _cooling_down(opened_at: str) -> bool:
+    try:
+        return time.time() - float(opened_at) < OPEN_SEC
+    except ValueError:
+        return False
+
+
+def _record_pipeline(pipe, latency_sec: float, ok: bool):
+    pipe.lpush(SAMPLES_KEY, _encode_sample(latency_sec, ok))
+    pipe.ltrim(SAMPLES_KEY, 0, WINDOW - 1)
+    pipe.lrange(SAMPLES_KEY, 0, -1)
+    pipe.get(OPEN_KEY)
+    return pipe
+
+
+def _log_transition(action: str | None, samples: list[tuple[float, bool]], opened_at: str | None) -> None:
+    if action == "close":
+        log.info("LLM circuit closed")
+    elif action == "open" and opened_at is None:
+        log.warning(f"LLM circuit opened: {health_stats(samples)}")
+
+
+def llm_call_allowed() -> bool:
+    try:
+        client = get_redis()
+        opened_at = client.get(OPEN_KEY)
+        if opened_at is None:
+            return True
+        if _cooling_down(opened_at):
+            return False
+        # после паузы пропускается один пробный вызов
+        return bool(client.set(PROBE_KEY, "1", nx=True, ex=PROBE_LOCK_SEC))
+    except Exception as e:
+        log.warning(f"LLM health check failed: {e}")
+        return True
+
+
+def record_llm_call(latency_sec: float, ok: bool) -> None:
+    try:
+        client = get_redis()
+        _, _, raw, opened_at = _record_pipeline(client.pipeline(), latency_sec, ok).execute()
+        samples = _decode_samples(raw)
+        action = _transition(samples, opened_at, ok)
+        if action == "close":
+            client.delete(OPEN_KEY, PROBE_KEY, SAMPLES_KEY)
+        elif action == "open":
+            client.pipeline().set(OPEN_KEY, str(time.time())).delete(PROBE_KEY).execute()
+        _log_transition(action, samples, opened_at)
+    except Exception as e:
+        log.warning(f"LLM health record failed: {e}")
+
+
+async def allow_llm_call() -> bool:
+    try:
+        client = get_async_redis()
+        opened_at = await client.get(OPEN_KEY)
+        if opened_at is None:
+            return True
+        if _cooling_down(opened_at):
+            return False
+        return bool(await client.set(PROBE_KEY, "1", nx=True, ex=PROBE_LOCK_SEC))
+    except Exception as e:
+        log.warning(f"LLM health check failed: {e}")
+        return True
+
+
+async def arecord_llm_call(latency_sec: float, ok: bool) -> None:
+    try:
+        client = get_async_redis()
+        _, _, raw, opened_at = await _record_pipeline(client.pipeline(), latency_sec, ok).execute()
+        samples = _decode_samples(raw)
+        action = _transition(samples, opened_at, ok)
+        if action == "close":
+            await client.delete(OPEN_KEY, PROBE_KEY, SAMPLES_KEY)
+        elif action == "open":
+            await client.pipeline().set(OPEN_KEY, str(time.time())).delete(PROBE_KEY).execute()
+        _log_transition(action, samples, opened_at)
+    except Exception as e:
+        log.warning(f"LLM health record failed: {e}")
+
+
+def llm_circuit_open() -> bool:
+    try:
+        return get_redis().get(OPEN_KEY) is not None
+    except Exception:
+        return False
+
+
+async def llm_degraded() -> bool:
+    try:
+        return await get_async_redis().get(OPEN_KEY) is not None
+    except Exception:
+        return False
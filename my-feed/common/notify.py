@@ -0,0 +1,59 @@
+import asyncio
+import json
+import logging
+from typing import AsyncIterator, Iterable
+
+from common.redis_client import get_async_redis
+
+log = logging.getLogger(__name__)
+
+NEW_POSTS_CHANNEL = "myfeed:new_posts"
+
+
+def encode_users(tg_user_ids: Iterable[int]) -> str:
+    return json.dumps({"users": sorted({int(uid) for uid in tg_user_ids})})
+
+
+def decode_users(raw: str | bytes | None) -> list[int]:
+    if not raw:
+        return []
+    try:
+        data = json.loads(raw)
+        return [int(uid) for uid in data.get("users", [])]
+    except (ValueError, TypeError, AttributeError):
+        return []
+
+
+async def publish_new_posts(tg_user_ids: Iterable[int]) -> None:
+    message = encode_users(tg_user_ids)
+    try:
+        await get_async_redis().publish(NEW_POSTS_CHANNEL, message)
+    except Exception as e:
+        # доставка всё равно подхватит посты на страховочном опросе
+        log.warning(f"Failed to publish new posts notification: {e}")
+
+
+async def listen_new_posts() -> AsyncIterator[list[int]]:
+    backoff = 1.0
+    while True:
+        pubsub = get_async_redis().pubsub()
+        try:
+            await pubsub.subscribe(NEW_POSTS_CHANNEL)
+            backoff = 1.0
+            async for message in pubsub.listen():
+                if message.get("type") != "message":
+                    continue
+                user_ids = decode_users(message.get("data"))
+                if user_ids:
+                    yield user_ids
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.warning(f"New posts subscription lost: {e}")
+        finally:
+            try:
+                await pubsub.aclose()
+            except Exception:
+                pass
+        await asyncio.sleep(backoff)
+        backoff = min(backoff * 2, 30.0)
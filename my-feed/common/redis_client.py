@@ -0,0 +1,28 @@
+import os
+
+from redis import Redis
+from redis.asyncio import Redis as AsyncRedis
+
+REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
+REDIS_PORT = os.getenv("REDIS_PORT", "6379")
+# db 0 и 1 заняты брокером и бэкендом Celery
+REDIS_APP_DB = int(os.getenv("REDIS_APP_DB", "2"))
+REDIS_URL = f"redis://{REDIS_HOST}:{REDIS_PORT}/{REDIS_APP_DB}"
+
+_async_client: AsyncRedis | None = None
+_sync_client: Redis | None = None
+
+
+def get_async_redis() -> AsyncRedis:
+    global _async_client
+    if _async_client is None:
+        _async_client = AsyncRedis.from_url(REDIS_URL, decode_responses=True)
+    return _async_client
+
+
+def get_redis() -> Redis:
+    global _sync_client
+    if _sync_client is None:
+        _sync_client = Redis.from_url(REDIS_URL, decode_responses=True)
+    return _sync_client
+
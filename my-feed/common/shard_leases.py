@@ -0,0 +1,139 @@
+import asyncio
+import hashlib
+import logging
+import os
+import socket
+import time
+import uuid
+from typing import Callable
+
+from common.redis_client import get_async_redis
+from common.sharding import FEED_SHARDS, shard_for_user
+
+log = logging.getLogger(__name__)
+
+# Воркеры доставки делят пользователей по шардам. Живые воркеры пишут
+# heartbeat в ZSET; каждый по rendezvous-хэшированию вычисляет, какие шарды
+# его, и держит на них аренду в Redis. Если воркер умер, его heartbeat
+# устаревает, остальные пересчитывают раскладку и забирают шарды после
+# истечения аренды.
+HEARTBEAT_SEC = float(os.getenv("FEED_HEARTBEAT_SEC", "5"))
+LEASE_SEC = float(os.getenv("FEED_LEASE_SEC", "15"))
+WORKERS_KEY = "feed:workers"
+LEASE_KEY_PREFIX = "feed:shard:"
+
+# Продлить аренду может только её владелец; свободную — кто угодно
+ACQUIRE_LUA = """
+local owner = redis.call('GET', KEYS[1])
+if not owner or owner == ARGV[1] then
+    redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+    return 1
+end
+return 0
+"""
+RELEASE_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def _score(worker_id: str, shard: int) -> int:
+    digest = hashlib.blake2b(f"{worker_id}:{shard}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+
+def rendezvous_owner(shard: int, workers: list[str]) -> str | None:
+    """Владелец шарда — воркер с наибольшим хэшем пары (воркер, шард)."""
+    if not workers:
+        return None
+    return max(workers, key=lambda w: _score(w, shard))
+
+
+def assign_shards(worker_id: str, workers: list[str], shards: int = FEED_SHARDS) -> set[int]:
+    return {s for s in range(shards) if rendezvous_owner(s, workers) == worker_id}
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+
+class ShardLeases:
+    def __init__(
+        self,
+        shards: int = FEED_SHARDS,
+        worker_id: str | None = None,
+        heartbeat_sec: float = HEARTBEAT_SEC,
+        lease_sec: float = LEASE_SEC,
+    ) -> None:
+        self.shards = shards
+        self.worker_id = worker_id or default_worker_id()
+        self.heartbeat_sec = heartbeat_sec
+        self.lease_sec = lease_sec
+        self.owned: set[int] = set()
+        # выставляется при любом изменении owned — подписчики пересобирают фильтр шардов
+        self.changed = asyncio.Event()
+        self._last_ok = 0.0
+
+    def owns_user(self, tg_user_id: int) -> bool:
+        return shard_for_user(tg_user_id, self.shards) in self.owned
+
+    async def heartbeat(self) -> set[int]:
+        """Один цикл: heartbeat, пересчёт раскладки, аренды. Возвращает новые шарды."""
+        client = get_async_redis()
+        now = time.time()
+        async with client.pipeline(transaction=False) as pipe:
+            pipe.zadd(WORKERS_KEY, {self.worker_id: now})
+            pipe.zremrangebyscore(WORKERS_KEY, "-inf", now - self.lease_sec)
+            pipe.zrange(WORKERS_KEY, 0, -1)
+            _, _, workers = await pipe.execute()
+
+        desired = assign_shards(self.worker_id, workers, self.shards)
+        lease_ms = int(self.lease_sec * 1000)
+        async with client.pipeline(transaction=False) as pipe:
+            for shard in sorted(self.owned - desired):
+                pipe.eval(RELEASE_LUA, 1, f"{LEASE_KEY_PREFIX}{shard}", self.worker_id)
+            for shard in sorted(desired):
+                pipe.eval(ACQUIRE_LUA, 1, f"{LEASE_KEY_PREFIX}{shard}", self.worker_id, lease_ms)
+            results = await pipe.execute()
+        acquired = {shard for shard, ok in zip(sorted(desired), results[-len(desired):] if desired else []) if ok}
+
+        gained = acquired - self.owned
+        lost = self.owned - acquired
+        if gained or lost:
+            self.changed.set()
+            log.info(
+                f"Worker {self.worker_id}: {len(workers)} workers alive, "
+                f"owns {len(acquired)} shards (+{len(gained)} -{len(lost)})"
+            )
+        self.owned = acquired
+        self._last_ok = time.monotonic()
+        return gained
+
+    async def run(self, on_gain: Callable[[], None] | None = None) -> None:
+        while True:
+            try:
+                gained = await self.heartbeat()
+                if gained and on_gain:
+                    on_gain()
+            except Exception as e:
+                log.warning(f"Shard heartbeat failed: {e}")
+                # без связи с Redis аренды истекут и шарды уйдут другим — перестаём доставлять
+                if self.owned and time.monotonic() - self._last_ok > self.lease_sec:
+                    log.warning(f"Worker {self.worker_id}: leases expired, dropping {len(self.owned)} shards")
+                    self.owned = set()
+                    self.changed.set()
+            await asyncio.sleep(self.heartbeat_sec)
+
+    async def release_all(self) -> None:
+        try:
+            client = get_async_redis()
+            async with client.pipeline(transaction=False) as pipe:
+                for shard in self.owned:
+                    pipe.eval(RELEASE_LUA, 1, f"{LEASE_KEY_PREFIX}{shard}", self.worker_id)
+                pipe.zrem(WORKERS_KEY, self.worker_id)
+                await pipe.execute()
+        except Exception as e:
+            log.warning(f"Failed to release shard leases: {e}")
+        self.owned = set()
@@ -0,0 +1,9 @@
+import os
+import zlib
+
+FEED_SHARDS = int(os.getenv("FEED_SHARDS", "64"))
+
+
+def shard_for_user(tg_user_id: int, shards: int = FEED_SHARDS) -> int:
+    # crc32 стабилен между процессами, в отличие от встроенного hash()
+    return zlib.crc32(str(int(tg_user_id)).encode()) % max(1, shards)
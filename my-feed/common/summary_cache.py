@@ -0,0 +1,92 @@
+import hashlib
+import logging
+import os
+import time
+
+from common.redis_client import get_async_redis, get_redis
+
+log = logging.getLogger(__name__)
+
+# Меняется при любой правке промптов сжатия, чтобы не отдавать старые ответы
+SUMMARY_PROMPT_VERSION = "v1"
+CACHE_TTL_SEC = int(os.getenv("SUMMARY_CACHE_TTL_SEC", str(3 * 24 * 3600)))
+CACHE_MAX_ENTRIES = int(os.getenv("SUMMARY_CACHE_MAX_ENTRIES", "50000"))
+CACHE_MAX_SUMMARY_LEN = 2000
+KEY_PREFIX = "summary:"
+INDEX_KEY = "summary:index"
+
+
+def normalize_text(text: str) -> str:
+    return " ".join((text or "").split())
+
+
+def cache_key(text: str, model: str, prompt_version: str = SUMMARY_PROMPT_VERSION) -> str:
+    raw = f"{model}\n{prompt_version}\n{normalize_text(text)}"
+    return KEY_PREFIX + hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _cacheable(summary: str) -> bool:
+    return bool(summary) and len(summary) <= CACHE_MAX_SUMMARY_LEN
+
+
+def _expired_keys_cutoff() -> float:
+    return time.time() - CACHE_TTL_SEC
+
+
+def _store_pipeline(pipe, pairs: list[tuple[str, str]], model: str):
+    now = time.time()
+    for text, summary in pairs:
+        key = cache_key(text, model)
+        pipe.set(key, summary, ex=CACHE_TTL_SEC)
+        pipe.zadd(INDEX_KEY, {key: now})
+    pipe.zremrangebyscore(INDEX_KEY, "-inf", _expired_keys_cutoff())
+    pipe.zcard(INDEX_KEY)
+    return pipe
+
+
+def get_cached_summaries(texts: list[str], model: str) -> list[str | None]:
+    if not texts:
+        return []
+    try:
+        return get_redis().mget([cache_key(t, model) for t in texts])
+    except Exception as e:
+        log.warning(f"Summary cache read failed: {e}")
+        return [None] * len(texts)
+
+
+def store_summaries(pairs: list[tuple[str, str]], model: str) -> None:
+    pairs = [(t, s) for t, s in pairs if _cacheable(s)]
+    if not pairs:
+        return
+    try:
+        client = get_redis()
+        size = _store_pipeline(client.pipeline(), pairs, model).execute()[-1]
+        # сверх лимита вытесняются самые старые записи
+        if size > CACHE_MAX_ENTRIES:
+            evicted = client.zpopmin(INDEX_KEY, size - CACHE_MAX_ENTRIES)
+            if evicted:
+                client.delete(*[key for key, _ in evicted])
+    except Exception as e:
+        log.warning(f"Summary cache write failed: {e}")
+
+
+async def aget_cached_summary(text: str, model: str) -> str | None:
+    try:
+        return await get_async_redis().get(cache_key(text, model))
+    except Exception as e:
+        log.warning(f"Summary cache read failed: {e}")
+        return None
+
+
+async def astore_summary(text: str, model: str, summary: str) -> None:
+    if not _cacheable(summary):
+        return
+    try:
+        client = get_async_redis()
+        size = (await _store_pipeline(client.pipeline(), [(text, summary)], model).execute())[-1]
+        if size > CACHE_MAX_ENTRIES:
+            evicted = await client.zpopmin(INDEX_KEY, size - CACHE_MAX_ENTRIES)
+            if evicted:
+                await client.delete(*[key for key, _ in evicted])
+    except Exception as e:
+        log.warning(f"Summary cache write failed: {e}")
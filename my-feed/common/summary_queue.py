@@ -0,0 +1,100 @@
+import json
+import math
+import os
+import time
+
+from common.redis_client import get_async_redis, get_redis
+
+# Очередь постов, ждущих сжатия при приёме. API кладёт сюда пост и
+# планирует задачу summarize_pending с небольшой задержкой; задача забирает
+# всё накопившееся пачкой — один запрос к LLM на пачку, а не на каждый пост.
+QUEUE_KEY = "summary:queue"
+# Посты, ждущие повторной попытки: ZSET со временем, раньше которого их не
+# трогаем, — сброс забирает только наступившие и не гоняет остальные по кругу
+DEFERRED_KEY = "summary:deferred"
+# Пока ключ жив, задача сброса уже запланирована и новая не нужна
+FLUSH_KEY = "summary:flush"
+RETRY_FLUSH_KEY = "summary:flush:retry"
+BATCH_DELAY_SEC = float(os.getenv("SUMMARY_BATCH_DELAY_SEC", "2"))
+BATCH_MAX_POSTS = int(os.getenv("SUMMARY_BATCH_MAX_POSTS", "50"))
+FLUSH_LOCK_SEC = 60
+
+
+def encode_item(post_id: int, text: str, attempt: int = 0, not_before: float = 0.0) -> str:
+    return json.dumps(
+        {"id": int(post_id), "text": text, "attempt": attempt, "not_before": not_before},
+        ensure_ascii=False,
+    )
+
+
+def decode_item(raw: str | bytes | None) -> dict | None:
+    try:
+        item = json.loads(raw)
+        item["id"] = int(item["id"])
+    except (TypeError, ValueError, KeyError):
+        return None
+    item.setdefault("text", "")
+    item.setdefault("attempt", 0)
+    item.setdefault("not_before", 0.0)
+    return item
+
+
+async def push_pending(post_id: int, text: str) -> bool:
+    """Ставит пост в очередь. True — вызывающий должен запланировать сброс."""
+    client = get_async_redis()
+    await client.rpush(QUEUE_KEY, encode_item(post_id, text))
+    return bool(await client.set(FLUSH_KEY, "1", nx=True, ex=FLUSH_LOCK_SEC))
+
+
+async def release_flush_async() -> None:
+    await get_async_redis().delete(FLUSH_KEY)
+
+
+def pop_batch(limit: int = BATCH_MAX_POSTS, now: float | None = None) -> list[dict]:
+    """Наступившие повторы, затем новые посты — всего не больше limit."""
+    client = get_redis()
+    due = client.zrangebyscore(DEFERRED_KEY, "-inf", time.time() if now is None else now, start=0, num=limit)
+    taken = []
+    if due:
+        pipe = client.pipeline()
+        for member in due:
+            pipe.zrem(DEFERRED_KEY, member)
+        # параллельный сброс мог забрать часть раньше — берём только удалённые нами
+        taken = [member for member, removed in zip(due, pipe.execute()) if removed]
+    raw = []
+    if limit > len(taken):
+        pipe = client.pipeline()
+        pipe.lrange(QUEUE_KEY, 0, limit - len(taken) - 1)
+        pipe.ltrim(QUEUE_KEY, limit - len(taken), -1)
+        raw, _ = pipe.execute()
+    return [item for item in map(decode_item, taken + raw) if item]
+
+
+def defer(items: list[dict]) -> None:
+    if items:
+        get_redis().zadd(
+            DEFERRED_KEY,
+            {encode_item(i["id"], i["text"], i["attempt"], i["not_before"]): i["not_before"] for i in items},
+        )
+
+
+def next_deferred_at() -> float | None:
+    first = get_redis().zrange(DEFERRED_KEY, 0, 0, withscores=True)
+    return float(first[0][1]) if first else None
+
+
+def pending_count() -> int:
+    return int(get_redis().llen(QUEUE_KEY))
+
+
+def claim_flush() -> bool:
+    return bool(get_redis().set(FLUSH_KEY, "1", nx=True, ex=FLUSH_LOCK_SEC))
+
+
+def release_flush() -> None:
+    get_redis().delete(FLUSH_KEY)
+
+
+def claim_retry_flush(delay: float) -> bool:
+    # ключ живёт до запланированного запуска: раньше него второй не нужен
+    return bool(get_redis().set(RETRY_FLUSH_KEY, "1", nx=True, ex=max(1, math.ceil(delay))))
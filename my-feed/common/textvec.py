@@ -0,0 +1,103 @@
+import re
+import zlib
+
+import numpy as np
+
+TOKEN_RE = re.compile(r"[a-zа-яё0-9]+", re.IGNORECASE)
+SENTENCE_RE = re.compile(r"(?<=[.!?…])\s+")
+# Грубый стемминг: русские словоформы чаще всего различаются окончанием
+STEM_LEN = 5
+HASH_DIM = 2 ** 12
+
+STOP_WORDS = {
+    "и", "в", "во", "не", "что", "он", "на", "я", "с", "со", "как", "а", "то", "все", "она",
+    "так", "его", "но", "да", "ты", "к", "у", "же", "вы", "за", "бы", "по", "только", "ее",
+    "её", "мне", "было", "вот", "от", "меня", "еще", "ещё", "нет", "о", "из", "ему", "теперь",
+    "когда", "даже", "ну", "ли", "если", "уже", "или", "ни", "быть", "был", "него", "до",
+    "вас", "нибудь", "опять", "уж", "вам", "ведь", "там", "потом", "себя", "ничего", "ей",
+    "может", "они", "тут", "где", "есть", "надо", "ней", "для", "мы", "тебя", "их", "чем",
+    "была", "сам", "чтоб", "без", "будто", "чего", "раз", "тоже", "себе", "под", "будет",
+    "ж", "тогда", "кто", "этот", "того", "потому", "этого", "какой", "совсем", "ним",
+    "здесь", "этом", "один", "почти", "мой", "тем", "чтобы", "нее", "были", "куда", "зачем",
+    "всех", "никогда", "можно", "при", "наконец", "два", "об", "другой", "хоть", "после",
+    "над", "больше", "тот", "через", "эти", "нас", "про", "всего", "них", "какая", "много",
+    "разве", "три", "эту", "моя", "впрочем", "хорошо", "свою", "этой", "перед", "иногда",
+    "лучше", "чуть", "том", "нельзя", "такой", "им", "более", "всегда", "конечно", "всю",
+    "между", "это", "также", "которые", "который", "которая", "которое",
+    "the", "a", "an", "and", "or", "of", "to", "in", "on", "for", "with", "is", "are", "was",
+    "were", "be", "by", "at", "as", "it", "this", "that", "from", "but", "not", "have", "has",
+}
+
+
+def split_sentences(text: str) -> list[str]:
+    text = " ".join((text or "").split())
+    if not text:
+        return []
+    return [s.strip() for s in SENTENCE_RE.split(text) if s.strip()]
+
+
+def tokenize(text: str) -> list[str]:
+    tokens = []
+    for token in TOKEN_RE.findall((text or "").lower()):
+        if token in STOP_WORDS or len(token) < 2:
+            continue
+        tokens.append(token[:STEM_LEN])
+    return tokens
+
+
+def shingles(tokens: list[str], size: int = 2) -> list[str]:
+    """Слова плюс n-граммы: дубликаты совпадают и по формулировкам, а не только по словарю."""
+    return tokens + [" ".join(tokens[i : i + size]) for i in range(len(tokens) - size + 1)]
+
+
+def hashed_counts(docs: list[list[str]], dim: int = HASH_DIM) -> np.ndarray:
+    """Матрица частот (документы × хэш-признаки) без словаря."""
+    matrix = np.zeros((len(docs), dim), dtype=np.float32)
+    rows = []
+    cols = []
+    for row, tokens in enumerate(docs):
+        for token in tokens:
+            rows.append(row)
+            cols.append(zlib.crc32(token.encode("utf-8")) % dim)
+    if rows:
+        np.add.at(matrix, (np.array(rows), np.array(cols)), 1.0)
+    return matrix
+
+
+def tfidf(counts: np.ndarray) -> np.ndarray:
+    """TF-IDF с L2-нормировкой строк; idf считается по строкам самой матрицы."""
+    if counts.size == 0:
+        return counts
+    n_docs = counts.shape[0]
+    df = np.count_nonzero(counts, axis=0)
+    idf = np.log((1.0 + n_docs) / (1.0 + df)) + 1.0
+    weights = np.log1p(counts) * idf
+    norms = np.linalg.norm(weights, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return weights / norms
+
+
+def cluster_by_similarity(vectors: np.ndarray, threshold: float) -> list[list[int]]:
+    """
+    Группы строк с косинусной близостью не ниже threshold (строки уже
+    L2-нормированы). Связность транзитивная: union-find по парам выше порога.
+    """
+    n = vectors.shape[0]
+    parent = list(range(n))
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    if n > 1:
+        sim = np.triu(vectors @ vectors.T, k=1)
+        for i, j in np.argwhere(sim >= threshold):
+            ri, rj = find(int(i)), find(int(j))
+            if ri != rj:
+                parent[max(ri, rj)] = min(ri, rj)
+    groups: dict[int, list[int]] = {}
+    for i in range(n):
+        groups.setdefault(find(i), []).append(i)
+    return list(groups.values())
@@ -1,5 +1,6 @@
 import asyncio
 import csv
+import os
 import time
 from dataclasses import dataclass
 from pathlib import Path
@@ -7,6 +8,7 @@ from pathlib import Path
 import matplotlib.pyplot as plt
 
 from bot.short_feed import summarize_to_one_sentence
+from common.extractive import summarize_extractive
 
 
 @dataclass
@@ -16,8 +18,19 @@ class Result:
     input_len: int
     output_len: int
     reduction_pct: float
+    engine: str = "llm"
 
 
+async def extractive_summary(text: str) -> str:
+    return summarize_extractive(text)
+
+
+# llm — сетевой путь краткой ленты, extractive — локальный движок без сети
+ENGINES = {
+    "llm": summarize_to_one_sentence,
+    "extractive": extractive_summary,
+}
+
 CATEGORY_RANGES = {
     "short": (100, 200),
     "medium": (300, 700),
@@ -91,33 +104,33 @@ def build_tests(per_category: int) -> list[tuple[str, str]]:
     return tests
 
 
-async def process_text(category: str, text: str) -> tuple[str, Result]:
-    start = time.time()
-    output = await summarize_to_one_sentence(text)
-    duration = time.time() - start
+async def process_text(category: str, text: str, engine: str = "llm") -> tuple[str, Result]:
+    start = time.perf_counter()
+    output = await ENGINES[engine](text)
+    duration = time.perf_counter() - start
     input_len = len(text)
     output_len = len(output)
     reduction_pct = 0.0
     if input_len > 0:
         reduction_pct = (1.0 - (output_len / input_len)) * 100.0
-    return output, Result(category, duration, input_len, output_len, reduction_pct)
+    return output, Result(category, duration, input_len, output_len, reduction_pct, engine)
 
 
-async def run_tests(per_category: int) -> tuple[list[str], list[Result]]:
+async def run_tests(per_category: int, engine: str = "llm") -> tuple[list[str], list[Result]]:
     outputs: list[str] = []
     results: list[Result] = []
     for category, text in build_tests(per_category):
-        output, result = await process_text(category, text)
+        output, result = await process_text(category, text, engine)
         outputs.append(output)
         results.append(result)
     return outputs, results
 
 
 def write_log(results: list[Result], log_path: Path) -> None:
-    lines = ["category,time_sec,input_len,output_len,reduction_pct"]
+    lines = ["engine,category,time_sec,input_len,output_len,reduction_pct"]
     for r in results:
         lines.append(
-            f"{r.category},{r.duration_sec:.6f},{r.input_len},{r.output_len},{r.reduction_pct:.2f}"
+            f"{r.engine},{r.category},{r.duration_sec:.6f},{r.input_len},{r.output_len},{r.reduction_pct:.2f}"
         )
     log_path.write_text("\n".join(lines), encoding="utf-8")
 
@@ -125,10 +138,11 @@ def write_log(results: list[Result], log_path: Path) -> None:
 def write_csv(results: list[Result], csv_path: Path) -> None:
     with csv_path.open("w", newline="", encoding="utf-8") as f:
         writer = csv.writer(f)
-        writer.writerow(["category", "time_sec", "input_len", "output_len", "reduction_pct"])
+        writer.writerow(["engine", "category", "time_sec", "input_len", "output_len", "reduction_pct"])
         for r in results:
             writer.writerow(
                 [
+                    r.engine,
                     r.category,
                     f"{r.duration_sec:.6f}",
                     r.input_len,
@@ -138,26 +152,33 @@ def write_csv(results: list[Result], csv_path: Path) -> None:
             )
 
 
+def _engines(results: list[Result]) -> list[str]:
+    return list(dict.fromkeys(r.engine for r in results))
+
+
 def plot_processing_time(results: list[Result], path: Path) -> None:
-    x = list(range(1, len(results) + 1))
-    y = [r.duration_sec for r in results]
     plt.figure(figsize=(8, 4))
-    plt.plot(x, y, marker="o")
+    for engine in _engines(results):
+        y = [r.duration_sec for r in results if r.engine == engine]
+        plt.plot(list(range(1, len(y) + 1)), y, marker="o", label=engine)
     plt.title("Processing Time per Test")
     plt.xlabel("Test #")
     plt.ylabel("Time (sec)")
+    plt.yscale("log")
+    plt.legend()
     plt.tight_layout()
     plt.savefig(path)
     plt.close()
 
 
 def plot_text_lengths(results: list[Result], path: Path) -> None:
-    x = list(range(1, len(results) + 1))
-    y_input = [r.input_len for r in results]
-    y_output = [r.output_len for r in results]
+    engines = _engines(results)
+    y_input = [r.input_len for r in results if r.engine == engines[0]]
     plt.figure(figsize=(8, 4))
-    plt.plot(x, y_input, marker="o", label="Input length")
-    plt.plot(x, y_output, marker="o", label="Output length")
+    plt.plot(list(range(1, len(y_input) + 1)), y_input, marker="o", label="Input length")
+    for engine in engines:
+        y_output = [r.output_len for r in results if r.engine == engine]
+        plt.plot(list(range(1, len(y_output) + 1)), y_output, marker="o", label=f"Output length ({engine})")
     plt.title("Text Length Comparison")
     plt.xlabel("Test #")
     plt.ylabel("Length (chars)")
@@ -169,16 +190,22 @@ def plot_text_lengths(results: list[Result], path: Path) -> None:
 
 def plot_reduction_by_category(results: list[Result], path: Path) -> None:
     categories = ["short", "medium", "long"]
-    averages: list[float] = []
-    for category in categories:
-        values = [r.reduction_pct for r in results if r.category == category]
-        avg = sum(values) / len(values) if values else 0.0
-        averages.append(avg)
+    engines = _engines(results)
+    width = 0.8 / max(1, len(engines))
     plt.figure(figsize=(6, 4))
-    plt.bar(categories, averages)
+    for idx, engine in enumerate(engines):
+        averages: list[float] = []
+        for category in categories:
+            values = [r.reduction_pct for r in results if r.category == category and r.engine == engine]
+            avg = sum(values) / len(values) if values else 0.0
+            averages.append(avg)
+        x = [i + idx * width for i in range(len(categories))]
+        plt.bar(x, averages, width=width, label=engine)
+    plt.xticks([i + width * (len(engines) - 1) / 2 for i in range(len(categories))], categories)
     plt.title("Average Reduction by Category")
     plt.xlabel("Category")
     plt.ylabel("Reduction (%)")
+    plt.legend()
     plt.tight_layout()
     plt.savefig(path)
     plt.close()
@@ -214,8 +241,12 @@ def summarize(results: list[Result]) -> dict:
 
 async def main() -> None:
     per_category = 12
-    outputs, results = await run_tests(per_category)
-    _ = outputs
+    engines = [e.strip() for e in os.getenv("PERF_ENGINES", "llm,extractive").split(",") if e.strip()]
+    results: list[Result] = []
+    for engine in engines:
+        outputs, engine_results = await run_tests(per_category, engine)
+        _ = outputs
+        results.extend(engine_results)
 
     write_log(results, Path("performance.log"))
     write_csv(results, Path("performance.csv"))
@@ -224,21 +255,22 @@ async def main() -> None:
     plot_text_lengths(results, Path("text_compression.png"))
     plot_reduction_by_category(results, Path("reduction_by_category.png"))
 
-    summary = summarize(results)
-
     print("Performance report")
-    print(f"Total tests: {summary['total']}")
-    print(f"Average time: {summary['avg_time']:.6f} sec")
-    print(f"Min time: {summary['min_time']:.6f} sec")
-    print(f"Max time: {summary['max_time']:.6f} sec")
-    print(f"Average reduction: {summary['avg_reduction']:.2f}%")
-    print("By category:")
-    for category in ["short", "medium", "long"]:
-        cat = summary["by_category"].get(category, {})
-        print(
-            f"- {category}: avg time {cat.get('avg_time', 0.0):.6f} sec, "
-            f"avg reduction {cat.get('avg_reduction', 0.0):.2f}%"
-        )
+    for engine in engines:
+        summary = summarize([r for r in results if r.engine == engine])
+        print(f"Engine: {engine}")
+        print(f"Total tests: {summary['total']}")
+        print(f"Average time: {summary['avg_time']:.6f} sec")
+        print(f"Min time: {summary['min_time']:.6f} sec")
+        print(f"Max time: {summary['max_time']:.6f} sec")
+        print(f"Average reduction: {summary['avg_reduction']:.2f}%")
+        print("By category:")
+        for category in ["short", "medium", "long"]:
+            cat = summary["by_category"].get(category, {})
+            print(
+                f"- {category}: avg time {cat.get('avg_time', 0.0):.6f} sec, "
+                f"avg reduction {cat.get('avg_reduction', 0.0):.2f}%"
+            )
 
 
 if __name__ == "__main__":
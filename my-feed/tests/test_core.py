@@ -2,13 +2,48 @@ import asyncio
 import sys
 from pathlib import Path
 
+import pytest
+
 ROOT = Path(__file__).resolve().parents[1]
 if str(ROOT) not in sys.path:
     sys.path.insert(0, str(ROOT))
 
-from api.main import looks_like_ad, health
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from api.main import MAX_DELIVERY_ATTEMPTS, delivery_backoff, looks_like_ad, health, next_delivery_attempt
 from bot.parsers import extract_channels
 import bot.short_feed as short_feed
+from common.notify import decode_users, encode_users
+from api.notifications import NotificationIndex
+import worker.tasks as tasks
+from worker.tasks import _pack_batches, _parse_batch_response, summarize_batch
+from common.summary_cache import cache_key
+from bot.feed_worker import bundle_posts, classify_delivery_error, short_feed_bodies
+from common.llm_health import _transition, health_stats
+from common.shard_leases import assign_shards
+from common.extractive import summarize_extractive
+from bot.digest_jobs import split_message
+import bot.payments as payments
+import bot.stars_worker as stars_worker
+import bot.yookassa as yookassa
+from bot.yookassa_fake import create_fake_yookassa
+from bot.webhook import create_app, drain, secret_matches
+from bot.cache import TTLCache
+import bot.main as bot_main
+import bot.user_settings as user_settings
+import bot.channel_cache as channel_cache
+import bot.broadcast_worker as broadcast_worker
+from bot.webhook_sim import WebhookSimulator
+from bot.composer import CAPTION_LIMIT, MESSAGE_LIMIT, compose_post, split_html, utf16_len, visible_len
+from bot.digest import (
+    _apply_merge_groups,
+    _chunk_posts,
+    _expand_sources,
+    _parse_stream_line,
+    collapse_by_channel,
+    collapse_duplicates,
+    fragment_key,
+    split_items_by_channel,
+)
 
 
 def test_health_function():
@@ -31,3 +66,1118 @@ def test_summarize_fallback_first_sentence():
     text = "Первое предложение. Второе предложение."
     result = asyncio.run(short_feed.summarize_to_one_sentence(text))
     assert result.strip() == "Первое предложение."
+
+
+def test_new_posts_notification_roundtrip():
+    assert decode_users(encode_users([3, 1, 3])) == [1, 3]
+    assert decode_users("not json") == []
+    assert decode_users(None) == []
+
+
+def test_notification_index_long_poll():
+    async def scenario():
+        index = NotificationIndex(maxlen=3)
+        first = await index.wait(None, None, lambda uid: True, timeout=0)
+        assert first["resync"]
+
+        waiter = asyncio.create_task(
+            index.wait(first["cursor"], first["epoch"], lambda uid: uid == 7, timeout=5)
+        )
+        await asyncio.sleep(0)
+        index.mark([5])
+        index.mark([7])
+        res = await waiter
+        assert res["users"] == [7] and not res["resync"]
+
+        idle = await index.wait(res["cursor"], res["epoch"], lambda uid: True, timeout=0.01)
+        assert idle["users"] == [] and not idle["resync"]
+
+        index.mark([1, 2, 3, 4])
+        lagging = await index.wait(res["cursor"], res["epoch"], lambda uid: True, timeout=0)
+        assert lagging["resync"]
+
+    asyncio.run(scenario())
+
+
+def test_stream_subscription_follows_leased_shards(monkeypatch):
+    import bot.feed_worker as feed_worker
+    from common.shard_leases import ShardLeases
+
+    async def scenario():
+        requests = []
+        answered = asyncio.Event()
+
+        async def fake_wait(since=None, epoch=None, shards=None, shard_count=None, timeout=25.0):
+            requests.append((shards, shard_count))
+            if shards == [2]:
+                answered.set()
+                await asyncio.sleep(0)
+                return {"users": [42], "cursor": 1, "epoch": "e"}
+            await asyncio.sleep(3600)
+
+        monkeypatch.setattr(feed_worker, "wait_pending_users", fake_wait)
+        leases = ShardLeases(shards=4, worker_id="w1")
+        wakeup = feed_worker.FeedWakeup()
+        poller = asyncio.create_task(feed_worker._poll_stream(wakeup, leases))
+        await asyncio.sleep(0.01)
+        # без аренд поток не слушается вовсе
+        assert requests == []
+        leases.owned = {3, 1}
+        leases.changed.set()
+        await asyncio.sleep(0.01)
+        leases.owned = {2}
+        leases.changed.set()
+        await asyncio.wait_for(answered.wait(), timeout=1)
+        await asyncio.sleep(0.01)
+        poller.cancel()
+        return requests[:2], wakeup.pending
+
+    requests, pending = asyncio.run(scenario())
+    assert requests == [([1, 3], 4), ([2], 4)]
+    assert pending == {42}
+
+
+def test_summary_batches_respect_token_budget():
+    texts = ["а" * 30, "", "б" * 30, "в" * 90]
+    assert _pack_batches(texts, token_budget=25) == [[0, 2], [3]]
+
+
+def test_batch_summary_falls_back_per_item(monkeypatch):
+    monkeypatch.setenv("MISTRAL_API_KEY", "test")
+    monkeypatch.setattr("worker.tasks.get_cached_summaries", lambda texts, model: [None] * len(texts))
+    monkeypatch.setattr("worker.tasks.store_summaries", lambda pairs, model: None)
+    monkeypatch.setattr(
+        "worker.tasks._chat_completion",
+        lambda messages, json_mode=False: '{"summaries": [{"id": 1, "summary": "Коротко."}]}',
+    )
+    texts = ["Первое. Второе.", "Длинный текст. Ещё."]
+    assert summarize_batch(texts) == [None, "Коротко."]
+    assert _parse_batch_response("не json") == {}
+
+
+def test_ingest_summaries_are_flushed_in_one_batch(monkeypatch):
+    monkeypatch.setenv("MISTRAL_API_KEY", "test")
+    queue = [
+        {"id": 1, "text": "Первое. Второе.", "attempt": 0, "not_before": 0.0},
+        {"id": 2, "text": "Длинный текст. Ещё.", "attempt": 0, "not_before": 0.0},
+        {"id": 3, "text": "Последний шанс. Да.", "attempt": tasks.SUMMARY_MAX_RETRIES, "not_before": 0.0},
+    ]
+    batches, saved, requeued, flushes = [], [], [], []
+
+    def fake_summarize(texts):
+        batches.append(texts)
+        return [None, "Коротко.", None]
+
+    class Resp:
+        def raise_for_status(self):
+            pass
+
+    monkeypatch.setattr(tasks, "pop_batch", lambda limit, now: list(queue))
+    monkeypatch.setattr(tasks, "release_flush", lambda: None)
+    monkeypatch.setattr(tasks, "llm_circuit_open", lambda: False)
+    monkeypatch.setattr(tasks, "summarize_batch", fake_summarize)
+    monkeypatch.setattr(tasks, "defer", requeued.extend)
+    monkeypatch.setattr(tasks, "pending_count", lambda: 0)
+    monkeypatch.setattr(tasks, "schedule_retry_flush", lambda: flushes.append("retry"))
+    monkeypatch.setattr(tasks.httpx, "post", lambda url, json, timeout: saved.append(json) or Resp())
+
+    assert tasks.summarize_pending() == 2
+    # один вызов LLM на всю очередь
+    assert len(batches) == 1 and len(batches[0]) == 3
+    assert saved == [{"summaries": [
+        {"post_id": 2, "summary": "Коротко."},
+        {"post_id": 3, "summary": summarize_extractive("Последний шанс. Да.")},
+    ]}]
+    # несжатый пост отложен до следующей попытки, сброс разбудится к её сроку
+    assert [(i["id"], i["attempt"]) for i in requeued] == [(1, 1)]
+    assert requeued[0]["not_before"] > 0 and flushes == ["retry"]
+
+
+def test_deferred_summaries_are_popped_only_when_due(monkeypatch):
+    import common.summary_queue as summary_queue
+
+    fake = FakeSyncRedis()
+    monkeypatch.setattr(summary_queue, "get_redis", lambda: fake)
+    fake.rpush(summary_queue.QUEUE_KEY, summary_queue.encode_item(1, "Новый пост."))
+    summary_queue.defer([
+        {"id": 2, "text": "Повтор.", "attempt": 1, "not_before": 100.0},
+        {"id": 3, "text": "Позже.", "attempt": 2, "not_before": 200.0},
+    ])
+
+    assert [i["id"] for i in summary_queue.pop_batch(10, now=50.0)] == [1]
+    # до срока отложенные посты не покидают ZSET
+    assert summary_queue.pop_batch(10, now=60.0) == []
+    assert summary_queue.next_deferred_at() == 100.0
+    popped = summary_queue.pop_batch(10, now=150.0)
+    assert [(i["id"], i["attempt"]) for i in popped] == [(2, 1)]
+    assert summary_queue.next_deferred_at() == 200.0
+
+
+def test_summary_cache_key_normalises_text():
+    assert cache_key("Новость  дня.\n", "m") == cache_key(" Новость дня.", "m")
+    assert cache_key("Новость дня.", "m") != cache_key("Новость дня.", "other")
+    assert cache_key("Новость дня.", "m", "v1") != cache_key("Новость дня.", "m", "v2")
+
+
+def test_short_feed_defers_posts_waiting_for_ingest_summary():
+    from datetime import datetime, timedelta, timezone
+
+    now = datetime.now(timezone.utc)
+    old = (now - timedelta(hours=1)).isoformat()
+    # пост, опубликованный давно, но только что принятый, всё ещё ждёт сжатия
+    late = {"text": "Поздний пост. Детали.", "summary": None, "published_at": old, "created_at": now.isoformat()}
+    assert short_feed_bodies([late]) == []
+    posts = [
+        {"text": "Длинный пост. Детали.", "summary": "Кратко.", "created_at": now.isoformat()},
+        {"text": "Старый пост. Детали.", "summary": None, "created_at": old},
+        {"text": "", "summary": None, "created_at": now.isoformat()},
+        {"text": "Свежий пост. Детали.", "summary": None, "created_at": now.isoformat()},
+        {"text": "Следующий пост.", "summary": "Готово.", "created_at": now.isoformat()},
+    ]
+    assert short_feed_bodies(posts) == ["Кратко.", "Старый пост.", ""]
+
+
+def test_llm_circuit_transitions():
+    healthy = [(0.8, True)] * 20
+    failing = [(0.8, True)] * 10 + [(20.0, False)] * 10
+    slow = [(9.0, True)] * 20
+    assert health_stats(failing)["error_rate"] == 0.5
+    assert _transition(healthy, None, ok=True) is None
+    assert _transition(failing, None, ok=False) == "open"
+    assert _transition(slow, None, ok=True) == "open"
+    assert _transition(failing[:3], None, ok=False) is None
+    assert _transition(healthy, "1700000000", ok=True) == "close"
+    assert _transition(healthy, "1700000000", ok=False) == "open"
+
+
+class FakeSyncRedis:
+    def __init__(self):
+        self.values = {}
+        self.lists = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.values:
+            return None
+        self.values[key] = value
+        return True
+
+    def delete(self, *keys):
+        for key in keys:
+            self.values.pop(key, None)
+            self.lists.pop(key, None)
+
+    def lpush(self, key, value):
+        self.lists.setdefault(key, []).insert(0, value)
+
+    def rpush(self, key, *values):
+        self.lists.setdefault(key, []).extend(values)
+
+    def zadd(self, key, mapping):
+        self.values.setdefault(key, {}).update(mapping)
+
+    def zrem(self, key, member):
+        return 1 if self.values.get(key, {}).pop(member, None) is not None else 0
+
+    def zrangebyscore(self, key, low, high, start=0, num=None):
+        members = sorted(self.values.get(key, {}).items(), key=lambda kv: kv[1])
+        due = [m for m, score in members if score <= float(high)]
+        return due[start:start + num] if num is not None else due[start:]
+
+    def zrange(self, key, start, end, withscores=False):
+        members = sorted(self.values.get(key, {}).items(), key=lambda kv: kv[1])
+        members = members[start:] if end == -1 else members[start:end + 1]
+        return members if withscores else [m for m, _ in members]
+
+    def ltrim(self, key, start, end):
+        self.lists[key] = self.lists.get(key, [])[start:end + 1]
+
+    def lrange(self, key, start, end):
+        items = self.lists.get(key, [])
+        return items[start:] if end == -1 else items[start:end + 1]
+
+    def pipeline(self):
+        client = self
+
+        class Pipe:
+            def __init__(self):
+                self.calls = []
+
+            def __getattr__(self, name):
+                def queue(*a, **kw):
+                    self.calls.append(lambda: getattr(client, name)(*a, **kw))
+                    return self
+                return queue
+
+            def execute(self):
+                return [call() for call in self.calls]
+
+        return Pipe()
+
+
+
+class FakeAsyncRedis:
+    """Асинхронная обёртка над FakeSyncRedis с общим состоянием."""
+
+    def __init__(self, sync: FakeSyncRedis):
+        self.sync = sync
+
+    def __getattr__(self, name):
+        async def call(*a, **kw):
+            return getattr(self.sync, name)(*a, **kw)
+        return call
+
+    def pipeline(self):
+        pipe = self.sync.pipeline()
+
+        class Pipe:
+            def __getattr__(self, name):
+                def queue(*a, **kw):
+                    getattr(pipe, name)(*a, **kw)
+                    return self
+                return queue
+
+            async def execute(self):
+                return pipe.execute()
+
+        return Pipe()
+
+def test_llm_breaker_is_closed_by_background_probe(monkeypatch):
+    import common.llm_health as llm_health
+
+    fake = FakeSyncRedis()
+    monkeypatch.setattr(llm_health, "get_redis", lambda: fake)
+    monkeypatch.setenv("MISTRAL_API_KEY", "test")
+    for _ in range(llm_health.MIN_SAMPLES):
+        llm_health.record_llm_call(20.0, ok=False)
+    assert llm_health.llm_circuit_open()
+    assert not llm_health.llm_call_allowed()
+
+    probes = []
+
+    def fake_completion(messages, max_tokens=None):
+        if not llm_health.llm_call_allowed():
+            raise tasks.LlmUnavailableError("open")
+        probes.append(max_tokens)
+        llm_health.record_llm_call(0.5, ok=True)
+        return "pong"
+
+    monkeypatch.setattr(tasks, "_chat_completion", fake_completion)
+    # пауза не прошла — проба не идёт в LLM
+    assert tasks.probe_llm() == "open" and probes == []
+    fake.values[llm_health.OPEN_KEY] = "0"
+    assert tasks.probe_llm() == "closed" and probes == [1]
+    assert not llm_health.llm_circuit_open() and llm_health.llm_call_allowed()
+
+    # асинхронные версии для бота и API видят то же состояние
+    monkeypatch.setattr(llm_health, "get_async_redis", lambda: FakeAsyncRedis(fake))
+
+    async def scenario():
+        for _ in range(llm_health.MIN_SAMPLES):
+            await llm_health.arecord_llm_call(20.0, ok=False)
+        assert await llm_health.llm_degraded() and llm_health.llm_circuit_open()
+        assert not await llm_health.allow_llm_call()
+        fake.values[llm_health.OPEN_KEY] = "0"
+        assert await llm_health.allow_llm_call()
+        # проба уже занята — второй вызов ждёт её результата
+        assert not await llm_health.allow_llm_call()
+        await llm_health.arecord_llm_call(0.5, ok=True)
+        assert not await llm_health.llm_degraded()
+
+    asyncio.run(scenario())
+
+
+def test_extractive_summary_picks_central_sentence():
+    text = (
+        "Погода сегодня хорошая. "
+        "Центробанк повысил ключевую ставку до 18 процентов. "
+        "Повышение ставки центробанк объяснил ростом инфляции. "
+        "Ставка останется высокой до конца года."
+    )
+    summary = summarize_extractive(text)
+    assert "ставк" in summary.lower()
+    assert summary in text
+    assert summarize_extractive("") == ""
+
+
+def test_digest_chunks_and_merges_sources():
+    posts = [{"channel": "@a", "tg_message_id": i, "text": "x" * 300} for i in range(1, 11)]
+    chunks = _chunk_posts(posts, token_budget=250)
+    assert [len(c) for c in chunks] == [2, 2, 2, 2, 2]
+
+    items = [
+        {"summary": "ЦБ поднял ставку.", "sources": [{"title": "A", "link": "https://t.me/a/1"}]},
+        {"summary": "Банк России повысил ставку.", "sources": [{"title": "B", "link": "https://t.me/b/2"}]},
+        {"summary": "Курс рубля вырос.", "sources": [{"title": "C", "link": "https://t.me/c/3"}]},
+    ]
+    merged = _apply_merge_groups(items, [{"summary": "ЦБ повысил ставку.", "ids": [0, 1]}])
+    assert merged[0]["summary"] == "ЦБ повысил ставку."
+    assert [s["link"] for s in merged[0]["sources"]] == ["https://t.me/a/1", "https://t.me/b/2"]
+    assert merged[1]["summary"] == "Курс рубля вырос."
+
+
+def test_digest_collapses_near_duplicates_and_keeps_sources():
+    posts = [
+        {"channel": "@a", "channel_title": "A", "tg_message_id": 1,
+         "text": "Центробанк повысил ключевую ставку до 18 процентов годовых."},
+        {"channel": "@b", "channel_title": "B", "tg_message_id": 2,
+         "text": "Центробанк повысил ключевую ставку до 18 процентов годовых, сообщает регулятор."},
+        {"channel": "@c", "channel_title": "C", "tg_message_id": 3,
+         "text": "В Москве открылась новая станция метро."},
+    ]
+    reps, extra = collapse_duplicates(posts, threshold=0.6)
+    assert [p["tg_message_id"] for p in reps] == [2, 3]
+    items = [{"summary": "Ставка 18%.", "sources": [{"title": "B", "link": "https://t.me/b/2"}]}]
+    links = [s["link"] for s in _expand_sources(items, extra)[0]["sources"]]
+    assert links == ["https://t.me/b/2", "https://t.me/a/1"]
+
+
+def test_digest_fragments_are_shared_per_channel():
+    a = [{"channel": "@news", "channel_title": "News", "tg_message_id": 5, "text": "Новость дня."}]
+    b = [dict(a[0])]
+    assert fragment_key("news", a) == fragment_key("news", b)
+    assert fragment_key("news", a) != fragment_key("news", [dict(a[0], tg_message_id=6)])
+
+    items = [
+        {"summary": "Первое.", "sources": [{"title": "News", "link": "https://t.me/News/5"}]},
+        {"summary": "Второе.", "sources": [{"title": "Other", "link": "https://t.me/other/7"}]},
+        {"summary": "Без ссылки.", "sources": []},
+    ]
+    split = split_items_by_channel(items, ["news", "other"])
+    assert [i["summary"] for i in split["news"]] == ["Первое.", "Без ссылки."]
+    assert [i["summary"] for i in split["other"]] == ["Второе."]
+
+    # одна новость в двух каналах уходит в LLM один раз, источники сохраняются
+    text = "Центробанк повысил ключевую ставку до 18 процентов годовых."
+    news = [{"channel": "@news", "channel_title": "News", "tg_message_id": 5, "text": text}]
+    other = [{"channel": "@other", "channel_title": "Other", "tg_message_id": 9, "text": text + " Подробности."}]
+    mixed, extra = collapse_by_channel(news + other)
+    assert list(mixed) == ["other"] and len(mixed["other"]) == 1
+    items = [{"summary": "Ставка 18%.", "sources": [{"title": "Other", "link": "https://t.me/other/9"}]}]
+    links = [s["link"] for s in _expand_sources(items, extra)[0]["sources"]]
+    assert links == ["https://t.me/other/9", "https://t.me/news/5"]
+    # фрагмент представителя общий с подписчиком только этого канала
+    alone, _ = collapse_by_channel(other)
+    assert fragment_key("other", alone["other"]) == fragment_key("other", mixed["other"])
+
+
+def test_digest_stream_lines_and_message_split():
+    assert _parse_stream_line('{"summary": "A", "ids": [0, 1]},') == [{"summary": "A", "ids": [0, 1]}]
+    assert _parse_stream_line('[{"summary": "B", "ids": [2]}]') == [{"summary": "B", "ids": [2]}]
+    assert _parse_stream_line("```json") == []
+    assert _parse_stream_line('{"summary": "обрыв') == []
+
+    text = "\n".join(["• пункт " + "x" * 90] * 100)
+    parts = split_message(text, limit=1000)
+    assert all(len(p) <= 1000 for p in parts)
+    assert "\n".join(parts) == text
+
+    # длинная строка со ссылкой, сущностью и эмодзи: лимит в UTF-16, теги целы
+    line = '• Курс &amp; ставка 😀 <a href="https://t.me/news/1">' + "подробнее " * 60 + "</a>"
+    parts = split_message("Сводка\n" + line, limit=100)
+    assert len(parts) > 1 and all(visible_len(p) <= 100 for p in parts)
+    for part in parts:
+        assert part.count("<a ") == part.count("</a>")
+        assert "&amp" not in part or "&amp;" in part
+    assert parts[0] == "Сводка" and parts[1].endswith("</a>") and parts[2].startswith("<a ")
+    assert split_html("😀😀", 1) == ["😀", "😀"]
+
+
+def test_digest_failure_is_not_cached_and_single_channel_streams(monkeypatch):
+    import bot.digest as digest
+    import bot.digest_jobs as digest_jobs
+
+    class Placeholder:
+        def __init__(self):
+            self.edits = []
+
+        async def edit_text(self, text, **kwargs):
+            self.edits.append(text)
+
+        async def answer(self, text, **kwargs):
+            self.edits.append(text)
+
+    posts = [{"channel": "@news", "channel_title": "News", "tg_message_id": 5, "text": "Новость {дня}."}]
+    answer = [
+        '[\n  {"summary": "Первое {событие}.",',
+        '   "sources": [{"title": "News", "link": "https://t.me/news/5"}]},',
+        '  {"summary": "Второе.", "sources": [{"title": "News", "link": "https://t.me/news/5"}]}',
+        "]",
+    ]
+    calls = {"n": 0}
+
+    async def fake_stream(client, system, user):
+        calls["n"] += 1
+        if calls["n"] == 1:
+            raise RuntimeError("LLM timeout")
+        for line in answer:
+            yield line
+
+    async def no_fragments(keys):
+        return {}
+
+    async def store(fragments):
+        pass
+
+    async def candidates(tg_user_id, **kwargs):
+        return posts
+
+    monkeypatch.setattr(digest, "MISTRAL_API_KEY", "test")
+    monkeypatch.setattr(digest, "_stream_chat_lines", fake_stream)
+    monkeypatch.setattr(digest, "_load_fragments", no_fragments)
+    monkeypatch.setattr(digest, "_store_fragments", store)
+    monkeypatch.setattr(digest_jobs, "get_digest_candidates", candidates)
+    monkeypatch.setattr(digest_jobs, "EDIT_INTERVAL_SEC", 0)
+
+    async def scenario():
+        jobs = digest_jobs.DigestJobs()
+        first = Placeholder()
+        job = await jobs.submit(7, first)
+        await job.task
+        assert "Не удалось" in first.edits[-1]
+        # неудача не попала в окно повтора — второй /digest строит сводку заново
+        assert jobs.current(7) is None
+        second = Placeholder()
+        job = await jobs.submit(7, second)
+        await job.task
+        return second.edits
+
+    edits = asyncio.run(scenario())
+    # пункты одного канала показываются по мере генерации
+    assert "Первое {событие}." in edits[0] and "Второе." not in edits[0]
+    assert "Второе." in edits[-1] and not edits[-1].endswith("…")
+
+
+def test_digest_candidates_sql_applies_window_filters_and_budget():
+    from datetime import datetime, timedelta, timezone
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import Session
+    from api.db import Base
+    from api.main import digest_candidates_query
+    from api.models import Channel, DeadLetter, Post, User
+
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(
+        engine, tables=[User.__table__, Channel.__table__, Post.__table__, DeadLetter.__table__]
+    )
+    now = datetime.now(timezone.utc)
+    with Session(engine) as session:
+        session.add_all([User(id=1, tg_user_id=10), User(id=2, tg_user_id=20)])
+        session.add_all([
+            Channel(id=1, user_id=1, username="@loud"),
+            Channel(id=2, user_id=1, username="@quiet"),
+            Channel(id=3, user_id=2, username="@other"),
+        ])
+
+        def post(pid, channel_id, minutes_ago, text="x" * 10, is_sent=True):
+            return Post(id=pid, channel_id=channel_id, tg_message_id=pid, text=text, is_sent=is_sent,
+                        published_at=now - timedelta(minutes=minutes_ago), created_at=now)
+
+        session.add_all([post(i, 1, i) for i in range(1, 6)])
+        session.add_all([
+            post(10, 2, 30, text="y" * 500),
+            post(11, 2, 2, is_sent=False),
+            post(12, 2, 3, text="   "),
+            post(13, 2, 60 * 24),
+            post(14, 2, 4),
+            post(20, 3, 1),
+        ])
+        # недоставленный пост помечен is_sent, но в сводку не попадает
+        session.add(DeadLetter(post_id=14, tg_user_id=10, error="", attempts=5, created_at=now))
+        session.commit()
+
+        def ids(**kwargs):
+            params = dict(per_channel=3, char_budget=10000, max_text_len=100, limit=50)
+            params.update(kwargs)
+            query = digest_candidates_query(1, now - timedelta(hours=12), **params)
+            return [row.id for row in session.execute(query)]
+
+        # окно, только доставленные, не пустые, не больше per_channel с канала, свежие первыми
+        assert ids() == [1, 2, 3, 10]
+        # текст обрезается до max_text_len и в выдаче, и в бюджете
+        assert [len(row.text) for row in session.execute(
+            digest_candidates_query(1, now - timedelta(hours=12), 3, 10000, 100, 50))] == [10, 10, 10, 100]
+        # бюджет набирается по кругу: первый пост тихого канала не вытесняется шумным
+        assert ids(char_budget=120) == [1, 2, 10]
+        assert ids(limit=2) == [1, 2]
+
+
+def test_bundle_groups_consecutive_text_posts_within_limit():
+    posts = [
+        {"channel": "a", "tg_message_id": 1},
+        {"channel": "a", "tg_message_id": 2},
+        {"channel": "b", "tg_message_id": 3},
+        {"channel": "b", "tg_message_id": 4, "media_paths": ["/tmp/x.jpg"]},
+        {"channel": "b", "tg_message_id": 5},
+        {"channel": "b", "tg_message_id": 6},
+    ]
+    bodies = ["текст"] * len(posts)
+    assert bundle_posts(posts, bodies, "off") == [[0], [1], [2], [3], [4], [5]]
+    assert bundle_posts(posts, bodies, "all") == [[0, 1, 2], [3], [4, 5]]
+    assert bundle_posts(posts, bodies, "channel") == [[0, 1], [2], [3], [4, 5]]
+    long_bodies = ["x" * 3000] * len(posts)
+    assert bundle_posts(posts, long_bodies, "all") == [[0], [1], [2], [3], [4], [5]]
+
+
+def test_delivery_errors_are_classified_and_backed_off():
+    assert classify_delivery_error(TelegramForbiddenError(method=None, message="bot was blocked")) == "blocked"
+    assert classify_delivery_error(TelegramBadRequest(method=None, message="caption is too long")) == "permanent"
+    assert classify_delivery_error(TelegramRetryAfter(method=None, message="flood", retry_after=30)) == "transient"
+    assert classify_delivery_error(TimeoutError()) == "transient"
+
+    assert [delivery_backoff(n) for n in (1, 2, 3)] == [30, 60, 120]
+    assert delivery_backoff(20) == 3600
+    # flood control переносит пост, но не тратит попытку
+    assert next_delivery_attempt(2, "transient", retry_after=90) == (2, 90.0)
+    assert next_delivery_attempt(MAX_DELIVERY_ATTEMPTS - 1, "transient", retry_after=5) == (MAX_DELIVERY_ATTEMPTS - 1, 5.0)
+    assert next_delivery_attempt(0, "transient") == (1, 30)
+    assert next_delivery_attempt(MAX_DELIVERY_ATTEMPTS - 1, "transient") == (MAX_DELIVERY_ATTEMPTS, None)
+    assert next_delivery_attempt(0, "permanent", retry_after=5) == (1, None)
+
+
+
+def test_post_is_sent_once_its_first_part_is_delivered(monkeypatch):
+    from bot import feed_worker
+
+    sent, marked, reported = [], [], []
+    long_text = ("Длинный пост без медиа. " * 400).strip()
+    posts = [
+        {"id": 1, "channel": "@a", "tg_message_id": 1, "text": long_text},
+        {"id": 2, "channel": "@a", "tg_message_id": 2, "text": "Следующий пост."},
+    ]
+
+    class FloodBot:
+        async def send_message(self, chat_id, text, **kwargs):
+            if len(sent) == 1:
+                raise TelegramRetryAfter(method=None, message="flood", retry_after=5)
+            sent.append(text)
+
+    async def fake_settings(tg_user_id):
+        return {"short_feed": False, "bundle_mode": "off"}
+
+    async def fake_unsent(tg_user_id, limit=20):
+        return posts
+
+    async def fake_mark(ids):
+        marked.extend(ids)
+
+    async def fake_report(*args, **kwargs):
+        reported.append(args)
+
+    monkeypatch.setattr(feed_worker, "load_settings", fake_settings)
+    monkeypatch.setattr(feed_worker, "get_unsent_posts", fake_unsent)
+    monkeypatch.setattr(feed_worker, "mark_posts_sent", fake_mark)
+    monkeypatch.setattr(feed_worker, "report_delivery_failure", fake_report)
+
+    assert asyncio.run(feed_worker.deliver_user_posts(FloodBot(), 7)) == 1
+    # вторая часть упёрлась во flood control: пост не переотправится целиком,
+    # а следующий пост ждёт следующего прохода
+    assert len(sent) == 1 and marked == [1] and reported == []
+
+def test_composer_respects_telegram_limits_and_escapes_html():
+    assert utf16_len("a😀") == 3
+    post = {"channel": "@news", "channel_title": "A & B", "tg_message_id": 7}
+    body = ("Предложение с <тегом> и эмодзи 😀. " * 200).strip()
+
+    with_media = compose_post(post, body, with_media=True)
+    assert "A &amp; B" in with_media.caption
+    assert "&lt;тегом&gt;" in with_media.caption
+    assert visible_len(with_media.caption) <= CAPTION_LIMIT
+    assert with_media.messages
+    assert all(visible_len(m) <= MESSAGE_LIMIT for m in with_media.messages)
+
+    text_only = compose_post(post, body, with_media=False)
+    assert text_only.caption is None
+    assert all(visible_len(m) <= MESSAGE_LIMIT for m in text_only.messages)
+    assert compose_post(post, body, with_media=False) is text_only
+
+
+def test_shard_assignment_partitions_and_moves_minimally():
+    workers = ["w1", "w2", "w3"]
+    owned = {w: assign_shards(w, workers, shards=64) for w in workers}
+    assert set().union(*owned.values()) == set(range(64))
+    assert sum(len(v) for v in owned.values()) == 64
+
+    # при уходе воркера двигаются только его шарды
+    survivors = ["w1", "w3"]
+    after = {w: assign_shards(w, survivors, shards=64) for w in survivors}
+    for w in survivors:
+        assert owned[w] <= after[w]
+    assert after["w1"] | after["w3"] == set(range(64))
+
+
+def test_stars_payment_is_credited_once(monkeypatch):
+    intents = {"vip:1m:1": "pending"}
+    sent = []
+
+    async def fake_complete(payload, tx_id=None):
+        completed = intents.get(payload) == "pending"
+        intents[payload] = "paid"
+        return {"completed": completed, "tg_user_id": 7, "plan": "1m", "vip_until": "2030-01-01T00:00:00+00:00"}
+
+    class FakeBot:
+        async def send_message(self, chat_id, text):
+            sent.append((chat_id, text))
+
+    monkeypatch.setattr(payments, "complete_payment_intent", fake_complete)
+    intent = {"payload": "vip:1m:1", "tg_user_id": 7, "plan": "1m"}
+
+    async def scenario():
+        # поллер и successful_payment могут увидеть один платёж одновременно
+        return await asyncio.gather(
+            stars_worker.credit_stars_payment(FakeBot(), intent, "tx1"),
+            stars_worker.credit_stars_payment(FakeBot(), intent, "tx1"),
+        )
+
+    assert sorted(asyncio.run(scenario())) == [False, True]
+    assert sent == [(7, payments.payment_success_text("2030-01-01T00:00:00+00:00"))]
+    assert payments.plan_days("1m") == 30 and payments.plan_days("unknown") is None
+
+
+
+
+def test_payment_intent_is_completed_once_and_extends_vip_from_its_end():
+    from datetime import datetime, timedelta, timezone
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import Session
+    from api.db import Base
+    from api.main import complete_intent_stmt, vip_extended_until
+    from api.models import PaymentIntent
+
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine, tables=[PaymentIntent.__table__])
+    now = datetime.now(timezone.utc)
+    with Session(engine) as session:
+        session.add_all([
+            PaymentIntent(payload=p, tg_user_id=7, provider="stars", plan="1m", days=30,
+                          status=st, created_at=now)
+            for p, st in (("pending", "pending"), ("late", "expired"), ("canceled", "canceled"))
+        ])
+        session.commit()
+
+        def complete(payload):
+            row = session.execute(complete_intent_stmt(payload, "tx", now)).first()
+            session.commit()
+            return row
+
+        # поллер и successful_payment завершают намерение наперегонки — выигрывает один
+        assert tuple(complete("pending")) == (7, "1m", 30)
+        assert complete("pending") is None
+        # поздняя оплата истёкшего намерения зачитывается, отменённого — нет
+        assert complete("late") is not None
+        assert complete("canceled") is None
+
+    active = now + timedelta(days=5)
+    assert vip_extended_until(active, 30, now) == active + timedelta(days=30)
+    assert vip_extended_until(now - timedelta(days=5), 30, now) == now + timedelta(days=30)
+    assert vip_extended_until(None, 7, now) == now + timedelta(days=7)
+
+def test_successful_payment_is_left_to_reconciler_when_api_fails(monkeypatch):
+    from aiogram import Bot
+    from aiogram.types import Message, Update
+
+    answers = []
+    credited = []
+
+    async def failing_intent(payload):
+        raise RuntimeError("api down")
+
+    async def fake_credit(payload, tx_id):
+        credited.append(payload)
+
+    async def fake_answer(self, text, **kwargs):
+        answers.append(text)
+
+    monkeypatch.setattr(bot_main, "get_payment_intent", failing_intent)
+    monkeypatch.setattr(bot_main, "credit_payment", fake_credit)
+    monkeypatch.setattr(Message, "answer", fake_answer)
+    user = {"id": 7, "is_bot": False, "first_name": "u"}
+    update = Update.model_validate({
+        "update_id": 1,
+        "message": {
+            "message_id": 1,
+            "date": 0,
+            "chat": {"id": 7, "type": "private"},
+            "from": user,
+            "successful_payment": {
+                "currency": "XTR",
+                "total_amount": 100,
+                "invoice_payload": "vip:12m:x",
+                "telegram_payment_charge_id": "ch1",
+                "provider_payment_charge_id": "",
+            },
+        },
+    })
+
+    asyncio.run(bot_main.create_dispatcher().feed_update(Bot(token="123456:TEST"), update))
+    # без намерения VIP не продлевается — платёж зачтёт воркер Stars
+    assert credited == []
+    assert len(answers) == 1 and "нескольких минут" in answers[0]
+
+def test_webhook_checks_secret_and_acks_before_handling():
+    from aiogram import Bot, Dispatcher
+    from aiogram.types import Message
+
+    dp = Dispatcher()
+    handled = []
+    release = asyncio.Event()
+
+    @dp.message()
+    async def on_message(msg: Message):
+        await release.wait()
+        handled.append((msg.from_user.id, msg.text))
+
+    app = create_app(bot=Bot(token="123456:TEST"), dp=dp, secret="s3cret")
+
+    async def scenario():
+        sim = WebhookSimulator(app=app, secret="s3cret")
+        try:
+            bad = await sim.send(sim.message_update(1, "/help"), secret="wrong")
+            assert bad.status_code == 401
+            ok = await sim.send_text(1, "/help")
+            # ответ пришёл, пока обработчик ещё ждёт
+            assert ok.status_code == 200 and handled == []
+            release.set()
+            await drain(app)
+        finally:
+            await sim.close()
+
+    asyncio.run(scenario())
+    assert handled == [(1, "/help")]
+
+
+def test_webhook_without_secret_refuses_to_start():
+    from aiogram import Bot, Dispatcher
+    from fastapi.testclient import TestClient
+
+    app = create_app(bot=Bot(token="123456:TEST"), dp=Dispatcher(), secret="")
+    with pytest.raises(RuntimeError, match="WEBHOOK_SECRET"):
+        with TestClient(app):
+            pass
+    # и без запуска пустой секрет ничего не пропускает
+    assert not secret_matches("", "")
+
+
+def test_ttl_cache_expires_and_evicts_lru():
+    now = [0.0]
+    cache = TTLCache(maxsize=2, ttl=10, clock=lambda: now[0])
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)  # вытесняет b: к a обращались позже
+    assert cache.get("b") is None and cache.get("a") == 1
+    now[0] = 11
+    assert cache.get("a") is None and len(cache) == 1
+
+
+def test_profile_sync_is_debounced_by_profile_hash(monkeypatch):
+    from types import SimpleNamespace
+
+    calls = []
+
+    async def fake_upsert(**kwargs):
+        calls.append(kwargs)
+
+    monkeypatch.setattr(bot_main, "upsert_user_profile", fake_upsert)
+    monkeypatch.setattr(bot_main, "profile_hashes", TTLCache(maxsize=10, ttl=60))
+
+    def msg(first_name):
+        return SimpleNamespace(from_user=SimpleNamespace(id=5, username="u", first_name=first_name, last_name=None))
+
+    async def scenario():
+        for name in ("Ann", "Ann", "Ann", "Anna"):
+            await bot_main.sync_user_profile(msg(name))
+
+    asyncio.run(scenario())
+    assert [c["first_name"] for c in calls] == ["Ann", "Anna"]
+
+
+def test_settings_cache_is_refreshed_by_writes(monkeypatch):
+    calls = []
+    state = {"vip_active": True, "spam_filter": False}
+
+    async def fake_get(tg_user_id):
+        calls.append("get")
+        return dict(state)
+
+    async def fake_toggle(tg_user_id, setting, require_vip=False):
+        calls.append("toggle")
+        state[setting] = not state[setting]
+        return {"ok": True, "settings": dict(state)}
+
+    async def fake_extend(tg_user_id, days):
+        calls.append("extend")
+        return {"vip_until": None}
+
+    monkeypatch.setattr(user_settings.api_client, "get_user_settings", fake_get)
+    monkeypatch.setattr(user_settings.api_client, "toggle_user_setting", fake_toggle)
+    monkeypatch.setattr(user_settings.api_client, "extend_vip", fake_extend)
+    monkeypatch.setattr(user_settings, "settings_cache", TTLCache(maxsize=10, ttl=60))
+
+    async def scenario():
+        await user_settings.load_settings(1)
+        await user_settings.load_settings(1)
+        ok, settings = await user_settings.toggle_setting(1, "spam_filter", require_vip=True)
+        assert ok and settings["spam_filter"] is True
+        assert (await user_settings.load_settings(1))["spam_filter"] is True
+        await user_settings.extend_vip(1, 30)
+        await user_settings.load_settings(1)
+
+    asyncio.run(scenario())
+    assert calls == ["get", "toggle", "extend", "get"]
+
+
+
+def test_delivery_reads_settings_once_through_cache(monkeypatch):
+    from bot import feed_worker, user_settings
+    from bot.cache import TTLCache
+
+    calls = []
+
+    async def fake_get(tg_user_id):
+        calls.append("settings")
+        return {"short_feed": True, "short_feed_engine": "local", "bundle_mode": "channel"}
+
+    async def fake_unsent(tg_user_id, limit=20):
+        calls.append(("unsent", limit))
+        return []
+
+    monkeypatch.setattr(user_settings.api_client, "get_user_settings", fake_get)
+    monkeypatch.setattr(user_settings, "settings_cache", TTLCache(maxsize=10, ttl=60))
+    monkeypatch.setattr(feed_worker, "get_unsent_posts", fake_unsent)
+
+    async def scenario():
+        await feed_worker.deliver_user_posts(None, 1)
+        await feed_worker.deliver_user_posts(None, 1)
+
+    asyncio.run(scenario())
+    limit = feed_worker.BUNDLE_BATCH_LIMIT
+    assert calls == ["settings", ("unsent", limit), ("unsent", limit)]
+
+def test_channel_cache_applies_revisions_locally(monkeypatch):
+    api = {"rev": 3, "channels": ["@a", "@b", "@c"]}
+    fetches = []
+
+    async def fake_list(tg_user_id):
+        fetches.append(tg_user_id)
+        return {"rev": api["rev"], "channels": list(api["channels"])}
+
+    async def fake_delete(tg_user_id, username):
+        api["channels"].remove(username)
+        api["rev"] += 1
+        return {"ok": True, "deleted": True, "rev": api["rev"]}
+
+    async def fake_add(tg_user_id, username):
+        api["channels"].append(username)
+        api["rev"] += 2  # список менялся ещё и в другом месте
+        return {"ok": True, "rev": api["rev"]}
+
+    monkeypatch.setattr(channel_cache.api_client, "get_channel_list", fake_list)
+    monkeypatch.setattr(channel_cache.api_client, "delete_channel", fake_delete)
+    monkeypatch.setattr(channel_cache.api_client, "add_channel", fake_add)
+    monkeypatch.setattr(channel_cache, "channels_cache", TTLCache(maxsize=10, ttl=60))
+
+    async def scenario():
+        assert await channel_cache.get_channels(1) == ["@a", "@b", "@c"]
+        await channel_cache.delete_channel(1, "@b")
+        assert await channel_cache.get_channels(1) == ["@a", "@c"]
+        assert fetches == [1]
+        await channel_cache.add_channel(1, "@d")
+        assert await channel_cache.get_channels(1) == ["@a", "@c", "@d"]
+        assert fetches == [1, 1]
+
+    asyncio.run(scenario())
+
+
+def test_broadcast_resumes_without_duplicates(monkeypatch):
+    # 1 уже получил сообщение, 2 был «в полёте» при падении воркера
+    recipients = {1: "sent", 2: "sending", 3: "pending", 4: "pending", 5: "pending"}
+    job = {"id": 9, "text": "hi", "status": "running", "total": 5, "sent": 1, "failed": 0}
+    delivered = []
+    flooded = []
+
+    async def fake_recover(job_id):
+        stuck = [uid for uid, st in recipients.items() if st == "sending"]
+        for uid in stuck:
+            recipients[uid] = "unknown"
+        job["failed"] += len(stuck)
+        return {"ok": True, "unknown": len(stuck)}
+
+    async def fake_claim(job_id, limit):
+        ids = [uid for uid, st in recipients.items() if st == "pending"][:limit]
+        for uid in ids:
+            recipients[uid] = "sending"
+        return ids
+
+    async def fake_results(job_id, sent, failed, blocked):
+        for status, ids in (("sent", sent), ("failed", failed), ("blocked", blocked)):
+            for uid in ids:
+                recipients[uid] = status
+        job["sent"] += len(sent)
+        job["failed"] += len(failed) + len(blocked)
+        if not any(st in ("pending", "sending") for st in recipients.values()):
+            job["status"] = "done"
+        return dict(job)
+
+    class FakeBot:
+        async def send_message(self, chat_id, text):
+            if chat_id == 3 and not flooded:
+                flooded.append(chat_id)
+                raise TelegramRetryAfter(method=None, message="flood", retry_after=0)
+            if chat_id == 4:
+                raise TelegramForbiddenError(method=None, message="bot was blocked")
+            delivered.append(chat_id)
+
+    monkeypatch.setattr(broadcast_worker, "recover_broadcast", fake_recover)
+    monkeypatch.setattr(broadcast_worker, "claim_broadcast_recipients", fake_claim)
+    monkeypatch.setattr(broadcast_worker, "report_broadcast_results", fake_results)
+    monkeypatch.setattr(broadcast_worker, "BROADCAST_BATCH", 2)
+
+    limiter = broadcast_worker.RateLimiter(1000)
+    result = asyncio.run(broadcast_worker.run_job(FakeBot(), dict(job), limiter))
+    assert sorted(delivered) == [3, 5]
+    assert recipients == {1: "sent", 2: "unknown", 3: "sent", 4: "blocked", 5: "sent"}
+    assert result["status"] == "done" and result["sent"] == 3 and result["failed"] == 2
+
+
+def test_stars_reconciliation_reads_only_new_transactions(monkeypatch):
+    from types import SimpleNamespace
+
+    class FakeRedis:
+        def __init__(self):
+            self.values = {}
+            self.zsets = {}
+
+        async def get(self, key):
+            return self.values.get(key)
+
+        async def set(self, key, value):
+            self.values[key] = str(value)
+
+        async def zscore(self, key, member):
+            return self.zsets.get(key, {}).get(member)
+
+        async def zadd(self, key, mapping):
+            self.zsets.setdefault(key, {}).update(mapping)
+
+        async def zremrangebyscore(self, key, low, high):
+            zset = self.zsets.get(key, {})
+            for member in [m for m, score in zset.items() if score <= high]:
+                del zset[member]
+
+    def tx(tx_id, payload):
+        user = SimpleNamespace(id=7)
+        return SimpleNamespace(id=tx_id, source=SimpleNamespace(invoice_payload=payload, user=user))
+
+    ledger = [tx("t1", "vip:1m:a"), tx("t2", "vip:1m:b")]
+    offsets = []
+    credited = []
+
+    class FakeBot:
+        async def get_star_transactions(self, offset, limit):
+            offsets.append(offset)
+            return SimpleNamespace(transactions=ledger[offset:offset + limit])
+
+    async def fake_intent(payload):
+        return {"payload": payload, "tg_user_id": 7, "plan": "1m", "status": "pending"}
+
+    async def fake_credit(bot, intent, tx_id):
+        credited.append(tx_id)
+        return True
+
+    redis = FakeRedis()
+    monkeypatch.setattr(stars_worker, "get_async_redis", lambda: redis)
+    monkeypatch.setattr(stars_worker, "get_payment_intent", fake_intent)
+    monkeypatch.setattr(stars_worker, "credit_stars_payment", fake_credit)
+
+    async def scenario():
+        assert await stars_worker.reconcile_stars(FakeBot()) == 2
+        ledger.append(tx("t3", "vip:1m:c"))
+        assert await stars_worker.reconcile_stars(FakeBot()) == 1
+        # курсор потерян — обработанные транзакции не зачитываются повторно
+        redis.values.clear()
+        assert await stars_worker.reconcile_stars(FakeBot()) == 3
+
+    asyncio.run(scenario())
+    assert offsets == [0, 2, 0]
+    assert credited == ["t1", "t2", "t3"]
+
+
+def test_yookassa_reconciler_and_webhook_credit_once(monkeypatch):
+    import httpx
+    from aiogram import Dispatcher
+
+    intents = {}
+    credited = []
+    notified = []
+
+    async def fake_list(provider, status="pending", tg_user_id=None, plan=None, limit=500,
+                        after_id=None, expired_within_sec=0):
+        statuses = ("pending", "expired") if expired_within_sec else (status,)
+        rows = [
+            {"id": n, "payload": pid, "tg_user_id": 7, "plan": "1m", "status": st}
+            for n, (pid, (prov, st)) in enumerate(intents.items(), start=1)
+            if prov == provider and st in statuses and n > (after_id or 0)
+        ]
+        return rows[:limit]
+
+    async def fake_credit(payload, tx_id):
+        if intents.get(payload, (None, None))[1] not in ("pending", "expired"):
+            return None
+        intents[payload] = (intents[payload][0], "paid")
+        credited.append(payload)
+        return {"tg_user_id": 7, "plan": "1m", "vip_until": None}
+
+    class FakeBot:
+        async def send_message(self, chat_id, text):
+            notified.append(chat_id)
+
+    bot = FakeBot()
+    webhook_app = create_app(bot=bot, dp=Dispatcher(), secret="s3cret")
+    fake_yk = create_fake_yookassa(notify_transport=httpx.ASGITransport(app=webhook_app))
+    monkeypatch.setattr(yookassa, "list_payment_intents", fake_list)
+    monkeypatch.setattr(yookassa, "credit_payment", fake_credit)
+    monkeypatch.setattr(
+        yookassa,
+        "_client",
+        httpx.AsyncClient(transport=httpx.ASGITransport(app=fake_yk), base_url="http://yookassa.local/v3"),
+    )
+
+    async def scenario():
+        payment_id, confirmation = await yookassa.create_payment(7, "1m")
+        assert confirmation["confirmation_url"]
+        intents[payment_id] = ("card", "pending")
+        reconciler = yookassa.YooKassaReconciler(bot)
+        assert await reconciler.reconcile_once() == 0
+        requests = fake_yk.state.requests
+        # следующая проверка этого платежа отложена — повторного запроса нет
+        assert await reconciler.reconcile_once() == 0
+        assert fake_yk.state.requests == requests
+
+        # оплата прошла: YooKassa шлёт уведомление в вебхук бота
+        r = await yookassa.get_client().post(
+            f"/_fake/payments/{payment_id}/succeeded",
+            params={"notify_url": f"http://webhook.local{yookassa.YOOKASSA_WEBHOOK_PATH}"},
+        )
+        assert r.json()["notify_status"] == 200
+        # платёж уже зачислен по уведомлению; сверка его больше не видит
+        reconciler.schedule.clear()
+        assert await reconciler.reconcile_once() == 0
+
+        # список читается постранично, ошибка по одному платежу (404) не
+        # мешает остальным, истёкшее намерение с поздней оплатой зачисляется
+        monkeypatch.setattr(yookassa, "YK_RECONCILE_BATCH", 1)
+        intents["missing"] = ("card", "pending")
+        late_id, _ = await yookassa.create_payment(7, "1m")
+        intents[late_id] = ("card", "expired")
+        await yookassa.get_client().post(f"/_fake/payments/{late_id}/succeeded")
+        assert await reconciler.reconcile_once() == 1
+        assert intents[late_id][1] == "paid"
+        assert reconciler.schedule.get("missing")[1] == yookassa.YK_CHECK_DELAY_SEC
+        assert reconciler.schedule.get(late_id) is None
+        await yookassa.close_client()
+
+    asyncio.run(scenario())
+    assert len(credited) == 2 and notified == [7, 7]
@@ -11,5 +11,12 @@ celery = Celery(
 )
 
 celery.conf.broker_connection_retry_on_startup = True
+# Периодические задачи; запускаются сервисом beat
+celery.conf.beat_schedule = {
+    "llm-health-probe": {
+        "task": "worker.tasks.probe_llm",
+        "schedule": float(os.getenv("LLM_HEALTH_PROBE_SEC", "30")),
+    },
+}
 
 celery.autodiscover_tasks(["worker"])
@@ -1,57 +1,257 @@
-import asyncio
+import json
+import logging
 import os
+import time
 import httpx
 
+from common.extractive import summarize_extractive
+from common.llm_health import llm_call_allowed, llm_circuit_open, record_llm_call
+from common.summary_cache import get_cached_summaries, store_summaries
+from common.summary_queue import (
+    BATCH_DELAY_SEC,
+    BATCH_MAX_POSTS,
+    claim_flush,
+    claim_retry_flush,
+    defer,
+    next_deferred_at,
+    pending_count,
+    pop_batch,
+    release_flush,
+)
 from worker.celery_app import celery
 
+log = logging.getLogger(__name__)
+
+BATCH_SYSTEM_PROMPT = (
+    "Тебе дан JSON-массив постов вида {\"id\": номер, \"text\": текст}. "
+    "Сократи КАЖДЫЙ текст до ОДНОГО предложения на русском. "
+    "Без эмодзи, без добавления фактов. "
+    "Верни ТОЛЬКО JSON-объект вида "
+    "{\"summaries\": [{\"id\": номер, \"summary\": \"одно предложение\"}]} "
+    "с одним элементом на каждый пост и теми же id."
+)
+# Грубая оценка: для русского текста ~3 символа на токен
+CHARS_PER_TOKEN = 3
+BATCH_TOKEN_BUDGET = int(os.getenv("SUMMARY_BATCH_TOKEN_BUDGET", "3000"))
+API_URL = os.getenv("API_URL", "http://api:8000")
+# Лимит сбросов очереди на один воркер Celery; повторы с экспоненциальной
+# задержкой укладываются в окно, которое доставка ждёт сжатие (FEED_SUMMARY_WAIT_SEC)
+SUMMARY_RATE_LIMIT = os.getenv("SUMMARY_RATE_LIMIT", "60/m")
+SUMMARY_MAX_RETRIES = int(os.getenv("SUMMARY_MAX_RETRIES", "3"))
+SUMMARY_RETRY_BASE_SEC = 5
+SUMMARY_RETRY_MAX_SEC = 30
+
+
+class LlmUnavailableError(Exception):
+    pass
+
+
 @celery.task
 def ping():
     return "pong"
 
-def _first_sentence(text: str) -> str:
-    text = " ".join((text or "").split())
-    if not text:
-        return ""
-    for sep in (". ", "! ", "? ", "… "):
-        idx = text.find(sep)
-        if idx != -1:
-            return text[: idx + 1]
-    return text
-
 
 @celery.task
-def summarize_text(text: str) -> str:
-    text = " ".join((text or "").split())
-    if not text:
-        return ""
+def probe_llm() -> str:
+    """
+    Фоновая проба для открытого предохранителя LLM (расписание — Celery beat).
+    Минимальный запрос проходит как пробный вызов: успех закрывает
+    предохранитель, не дожидаясь пользовательских запросов.
+    """
+    if not os.getenv("MISTRAL_API_KEY") or not llm_circuit_open():
+        return "closed"
+    try:
+        _chat_completion([{"role": "user", "content": "ping"}], max_tokens=1)
+    except LlmUnavailableError:
+        # пауза ещё не прошла или пробу уже выполняет кто-то другой
+        return "open"
+    except Exception as e:
+        log.warning(f"LLM health probe failed: {e}")
+        return "open"
+    return "closed" if not llm_circuit_open() else "open"
+
+def _estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def _pack_batches(texts: list[str], token_budget: int) -> list[list[int]]:
+    batches: list[list[int]] = []
+    current: list[int] = []
+    used = 0
+    for idx, text in enumerate(texts):
+        if not text:
+            continue
+        cost = _estimate_tokens(text)
+        if current and used + cost > token_budget:
+            batches.append(current)
+            current, used = [], 0
+        current.append(idx)
+        used += cost
+    if current:
+        batches.append(current)
+    return batches
+
+
+def _parse_batch_response(content: str) -> dict[int, str]:
+    cleaned = (content or "").strip()
+    if cleaned.startswith("```"):
+        cleaned = cleaned.strip("`").strip()
+        if cleaned.startswith("json"):
+            cleaned = cleaned[4:].strip()
+    try:
+        data = json.loads(cleaned)
+    except json.JSONDecodeError:
+        return {}
+    items = data.get("summaries") if isinstance(data, dict) else data
+    if not isinstance(items, list):
+        return {}
+    result: dict[int, str] = {}
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        try:
+            idx = int(item.get("id"))
+        except (TypeError, ValueError):
+            continue
+        summary = " ".join(str(item.get("summary") or "").split())
+        if summary:
+            result[idx] = summary
+    return result
+
+
+def _model() -> str:
+    return os.getenv("MISTRAL_MODEL", "mistral-small-latest")
+
+
+def _chat_completion(messages: list[dict], json_mode: bool = False, max_tokens: int | None = None) -> str:
+    if not llm_call_allowed():
+        raise LlmUnavailableError("LLM circuit is open")
     mistral_key = os.getenv("MISTRAL_API_KEY")
-    mistral_model = os.getenv("MISTRAL_MODEL", "mistral-small-latest")
+    mistral_model = _model()
     base_url = os.getenv("MISTRAL_BASE_URL", "https://api.mistral.ai")
-    if not mistral_key:
-        return _first_sentence(text)
 
     payload = {
         "model": mistral_model,
         "temperature": 0.2,
-        "messages": [
-            {
-                "role": "system",
-                "content": (
-                    "Сократи текст до ОДНОГО предложения на русском. "
-                    "Без эмодзи, без добавления фактов."
-                ),
-            },
-            {"role": "user", "content": text},
-        ],
+        "messages": messages,
     }
+    if json_mode:
+        payload["response_format"] = {"type": "json_object"}
+    if max_tokens:
+        payload["max_tokens"] = max_tokens
     headers = {"Authorization": f"Bearer {mistral_key}"}
     url = f"{base_url}/v1/chat/completions"
 
+    start = time.monotonic()
     try:
         r = httpx.post(url, json=payload, headers=headers, timeout=20)
         r.raise_for_status()
         data = r.json()
-        result = data["choices"][0]["message"]["content"].strip()
-        return result or _first_sentence(text)
+        content = data["choices"][0]["message"]["content"].strip()
     except Exception:
-        return _first_sentence(text)
+        record_llm_call(time.monotonic() - start, ok=False)
+        raise
+    record_llm_call(time.monotonic() - start, ok=True)
+    return content
+
+
+def summarize_batch(texts: list[str]) -> list[str | None]:
+    """
+    Сжимает несколько постов за один запрос к LLM: посты упаковываются в
+    пачки по BATCH_TOKEN_BUDGET, ответ — JSON с summary по id. Для постов,
+    которые не удалось сжать (ошибка LLM, пост пропал из ответа), — None.
+    """
+    texts = [" ".join((t or "").split()) for t in texts]
+    results: list[str | None] = [None] * len(texts)
+
+    # одинаковые посты (один канал у многих подписчиков) сжимаются один раз
+    missing = list(texts)
+    for idx, cached in enumerate(get_cached_summaries(texts, _model())):
+        if cached:
+            results[idx] = cached
+            missing[idx] = ""
+
+    for batch in _pack_batches(missing, BATCH_TOKEN_BUDGET):
+        items = [{"id": idx, "text": texts[idx]} for idx in batch]
+        try:
+            content = _chat_completion(
+                [
+                    {"role": "system", "content": BATCH_SYSTEM_PROMPT},
+                    {"role": "user", "content": json.dumps(items, ensure_ascii=False)},
+                ],
+                json_mode=True,
+            )
+        except LlmUnavailableError:
+            break
+        except Exception as e:
+            log.warning(f"Batch summary of {len(batch)} posts failed: {e}")
+            continue
+        summaries = _parse_batch_response(content)
+        fresh = []
+        for idx in batch:
+            if idx in summaries:
+                results[idx] = summaries[idx]
+                fresh.append((texts[idx], summaries[idx]))
+        store_summaries(fresh, _model())
+    return results
+
+
+def schedule_summary_flush(countdown: float = BATCH_DELAY_SEC) -> None:
+    if claim_flush():
+        summarize_pending.apply_async(countdown=countdown)
+
+
+def schedule_retry_flush() -> None:
+    """Будит сброс к сроку ближайшего отложенного поста."""
+    due_at = next_deferred_at()
+    if due_at is None:
+        return
+    delay = max(BATCH_DELAY_SEC, due_at - time.time())
+    if claim_retry_flush(delay):
+        summarize_pending.apply_async(countdown=delay)
+
+
+@celery.task(rate_limit=SUMMARY_RATE_LIMIT)
+def summarize_pending() -> int:
+    """
+    Стадия конвейера приёма постов: забирает из очереди накопившиеся посты,
+    сжимает их пачкой и сохраняет результаты одним запросом к API. Посты,
+    которые LLM не сжала, возвращаются в очередь с растущей паузой; после
+    исчерпания попыток или при открытом предохранителе сохраняется локальное
+    экстрактивное сжатие. Возвращает число сохранённых сжатий.
+    """
+    # новые посты, пришедшие во время обработки, запланируют следующий сброс
+    release_flush()
+    now = time.time()
+    ready = pop_batch(BATCH_MAX_POSTS, now)
+    later = []
+    texts = [" ".join((i["text"] or "").split()) for i in ready]
+
+    llm_on = bool(os.getenv("MISTRAL_API_KEY"))
+    summaries = summarize_batch(texts) if llm_on else [None] * len(texts)
+    retry_allowed = llm_on and not llm_circuit_open()
+    results = []
+    for item, text_value, summary in zip(ready, texts, summaries):
+        if not summary and text_value and retry_allowed and item["attempt"] < SUMMARY_MAX_RETRIES:
+            delay = min(SUMMARY_RETRY_MAX_SEC, SUMMARY_RETRY_BASE_SEC * 2 ** item["attempt"])
+            later.append({**item, "attempt": item["attempt"] + 1, "not_before": now + delay})
+            continue
+        results.append({"post_id": item["id"], "summary": summary or summarize_extractive(text_value)})
+
+    if results:
+        try:
+            r = httpx.post(f"{API_URL}/posts/summaries", json={"summaries": results}, timeout=10)
+            r.raise_for_status()
+        except httpx.HTTPError as e:
+            # сжатия уже в кэше, повторный проход не пойдёт в LLM
+            log.warning(f"Failed to save {len(results)} summaries: {e}")
+            saved = {res["post_id"] for res in results}
+            later.extend({**i, "not_before": now + SUMMARY_RETRY_BASE_SEC} for i in ready if i["id"] in saved)
+            results = []
+
+    defer(later)
+    if pending_count():
+        schedule_summary_flush()
+    else:
+        schedule_retry_flush()
+    return len(results)